@@ -20,5 +20,12 @@ class ProcessError(Error):
     """Exception raised for failure in the some sra-tools call."""
     pass
 
+class DownloadError(Error):
+    """Exception raised for failed HTTP downloads."""
+    
+    def __init__(self, message, status = None):
+        super().__init__(message)
+        self.status = status
+
 
 
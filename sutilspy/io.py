@@ -2,82 +2,1654 @@
 # Copyright (C) 2017 Sur Herrera Paredes
 
 import subprocess
+import array
+import atexit
+import bz2
+import collections
+import collections.abc
 import csv
+import errno
+import hashlib
+import heapq
+import http.client
+import itertools
+import json
+import math
+import mmap
 import os
-from subprocess import CalledProcessError
-import shutil
+import queue
+import re
+import shlex
+import signal
+import stat
+import string
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from io import BytesIO, StringIO
+from sutilspy.all import DownloadError
 
-def clean_dirs(dirs, location = None):
+# Size of the chunks copied per system call by concatenate_files
+COPY_BUFFER_SIZE = 64 * 1024 * 1024
+
+# Bytes of a table scanned at a time by return_column and friends
+COLUMN_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Extension of the files in a column cache directory. See return_column.
+COLUMN_CACHE_SUFFIX = ".colcache"
+
+# Rows formatted at a time by write_table, and size of its file buffer
+TABLE_CHUNK_ROWS = 10000
+TABLE_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Environment variable with the name of a JSONL file where every command
+# run by run_command and run_commands is recorded. See set_trace.
+TRACE_ENV = "SUTILSPY_TRACE"
+
+# Threads used by clean_dirs and remove_tree to delete files
+REMOVE_THREADS = 16
+
+# Bytes read per chunk when streaming HTTP downloads
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Suffix of the partial files written while downloading
+PART_SUFFIX = ".part"
+
+# Name of the trash directories used by clean_dirs in background mode
+TRASH_NAME = ".sutilspy_trash"
+
+# Uncompressed bytes per bz2 stream written by BZ2BlockWriter. Same as the
+# block size of bzip2 -9.
+BZ2_BLOCK_SIZE = 900000
+
+# Errors that mean a kernel-side copy is not supported for a given pair
+# of files, in which case the next copy method is tried.
+_COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                         errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EPERM)
+
+# Layout of the binary cache sidecars: magic, format version, size and
+# mtime of the source file, length of the key and number of sections.
+_SIDECAR_MAGIC = b'SUTILSPY'
+_SIDECAR_VERSION = 1
+_SIDECAR_HEADER = struct.Struct('<8sIQqII')
+
+def _atomic_write(path, chunks):
+    """Writes a list of bytes objects to a file atomically
+    
+    Data is written to a temporary file in the same directory, which is
+    then renamed to *path*, so concurrent readers see either the old or
+    the new file, never a partial one.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir = dirname,
+                               prefix = '.' + os.path.basename(path) + '.',
+                               suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            for chunk in chunks:
+                fh.write(chunk)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+def _read_sidecar(path, source, key):
+    """Reads a binary cache sidecar written by :py:func:`_write_sidecar`
+    
+    Returns:
+        A list of memoryviews over a read-only memory map of the
+        file, one per section, or None if the sidecar does not exist,
+        is corrupt, was written with a different *key*, or the
+        size or modification time of *source* changed.
+    """
+    try:
+        st = os.stat(source)
+        with open(path, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return(None)
+    
+    key = key.encode()
+    try:
+        (magic, version, size, mtime_ns,
+         key_len, nsections) = _SIDECAR_HEADER.unpack_from(mm, 0)
+        pos = _SIDECAR_HEADER.size
+        if (magic != _SIDECAR_MAGIC or version != _SIDECAR_VERSION or
+                size != st.st_size or mtime_ns != st.st_mtime_ns or
+                mm[pos:pos + key_len] != key):
+            return(None)
+        pos += key_len
+        lengths = struct.unpack_from('<{}Q'.format(nsections), mm, pos)
+        pos += 8 * nsections
+        if pos + sum(lengths) != len(mm):
+            return(None)
+    except struct.error:
+        return(None)
+    
+    view = memoryview(mm)
+    sections = []
+    for length in lengths:
+        sections.append(view[pos:pos + length])
+        pos += length
+    return(sections)
+
+def _write_sidecar(path, source, key, sections):
+    """Writes a binary cache sidecar for a source file
+    
+    The sidecar stores the size and modification time of *source*
+    so :py:func:`_read_sidecar` can tell when it is stale. Failure to
+    write it is reported but not raised, since the cache is optional.
+    
+    Args:
+        path (str): Name of the sidecar file.
+        source (str): Name of the file the cache was built from.
+        key (str): Description of how the cache was built, e.g. the
+            columns parsed. A sidecar is only valid for the same key.
+        sections (list): List of bytes objects to store.
+    
+    Returns:
+        True if the sidecar was written.
+    """
+    st = os.stat(source)
+    key = key.encode()
+    head = _SIDECAR_HEADER.pack(_SIDECAR_MAGIC, _SIDECAR_VERSION, st.st_size,
+                                st.st_mtime_ns, len(key), len(sections))
+    lengths = struct.pack('<{}Q'.format(len(sections)),
+                          *[len(section) for section in sections])
+    try:
+        _atomic_write(path, [head, key, lengths] + list(sections))
+    except OSError as error:
+        print("\tWARNING: Could not write cache {} ({})".format(path, error))
+        return(False)
+    return(True)
+
+class ConcatenationResult(object):
+    """Summary of a call to :py:func:`concatenate_files`
+    
+    Attributes:
+        outfile (str): Name of the file created.
+        nfiles (int): Number of input files concatenated.
+        nbytes (int): Total number of bytes copied.
+        seconds (float): Wall-clock time spent copying.
+        returncode (int): Always 0. Kept so code that checked the
+            :py:class:`subprocess.CompletedProcess` returned by
+            previous versions keeps working.
+    """
+    
+    returncode = 0
+    
+    def __init__(self, outfile, nfiles, nbytes, seconds):
+        self.outfile = outfile
+        self.nfiles = nfiles
+        self.nbytes = nbytes
+        self.seconds = seconds
+    
+    @property
+    def throughput(self):
+        """Bytes copied per second"""
+        if self.seconds <= 0:
+            return(float(self.nbytes))
+        return(self.nbytes / self.seconds)
+    
+    def __repr__(self):
+        return("ConcatenationResult(outfile={!r}, nfiles={}, nbytes={}, "
+               "seconds={:.3f})".format(self.outfile, self.nfiles,
+                                        self.nbytes, self.seconds))
+
+class CompressionResult(ConcatenationResult):
+    """Summary of a call to :py:func:`bzip2_files`
+    
+    Same as :py:class:`ConcatenationResult`, where *nbytes* is the
+    number of uncompressed bytes compressed. Inputs appended without
+    recompressing are not counted.
+    
+    Attributes:
+        compressed_bytes (int): Size of the output file.
+    """
+    
+    def __init__(self, outfile, nfiles, nbytes, seconds, compressed_bytes):
+        super(CompressionResult, self).__init__(outfile, nfiles, nbytes, seconds)
+        self.compressed_bytes = compressed_bytes
+    
+    def __repr__(self):
+        return("CompressionResult(outfile={!r}, nfiles={}, nbytes={}, "
+               "seconds={:.3f}, compressed_bytes={})".format(self.outfile,
+                                                             self.nfiles,
+                                                             self.nbytes,
+                                                             self.seconds,
+                                                             self.compressed_bytes))
+
+class BZ2BlockWriter(object):
+    """Writes a multi-stream bz2 file compressing blocks in parallel
+    
+    Data written is split in blocks of *block_size* bytes and every
+    block is compressed into an independent bz2 stream by a pool of
+    processes, in the style of pbzip2. Streams are written in order,
+    so the output can be read by bzip2, :py:mod:`bz2` or any other
+    tool that supports multi-stream files.
+    
+    It can be used as a context manager, and the file is complete
+    only after :py:meth:`close` is called.
+    
+    Args:
+        outfile (str): Name of the file to create. It will overwrite
+            any existing file with that name.
+        processes (int): Number of compression processes. If None,
+            uses the number of CPUs. With 1, blocks are compressed
+            in the calling process.
+        block_size (int): Uncompressed bytes per block.
+        compresslevel (int): bz2 compression level (1-9).
+        executor: A :py:class:`concurrent.futures.ProcessPoolExecutor`
+            to share between writers, with *processes* workers. It is
+            not shut down on close.
+    """
+    
+    def __init__(self, outfile, processes = None, block_size = BZ2_BLOCK_SIZE,
+                 compresslevel = 9, executor = None):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.outfile = outfile
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.nbytes = 0
+        self._fh = open(outfile, 'wb')
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._max_pending = 2 * processes
+        self._executor = executor
+        self._own_executor = False
+        if executor is None and processes > 1:
+            self._executor = ProcessPoolExecutor(processes)
+            self._own_executor = True
+    
+    def __enter__(self):
+        return(self)
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def write(self, data):
+        """Adds uncompressed data and returns the number of bytes added"""
+        self._buffer += data
+        self.nbytes += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return(len(data))
+    
+    def write_bz2_file(self, infile):
+        """Appends the streams of an already compressed bz2 file unchanged"""
+        self._flush_buffer()
+        self._drain(0)
+        self._fh.flush()
+        with open(infile, 'rb', buffering = 0) as in_fh:
+            _copy_fd(in_fh.fileno(), self._fh.fileno(),
+                     os.fstat(in_fh.fileno()).st_size)
+    
+    def close(self):
+        """Compresses any remaining data and closes the file"""
+        if self._fh.closed:
+            return
+        try:
+            self._flush_buffer()
+            self._drain(0)
+        finally:
+            self._fh.close()
+            if self._own_executor:
+                self._executor.shutdown()
+    
+    def _flush_buffer(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+    
+    def _submit(self, block):
+        if self._executor is None:
+            self._fh.write(bz2.compress(block, self.compresslevel))
+            return
+        self._pending.append(self._executor.submit(bz2.compress, block,
+                                                   self.compresslevel))
+        self._drain(self._max_pending)
+    
+    def _drain(self, max_pending):
+        # Write finished blocks in order, waiting for the oldest ones
+        # while more than max_pending are in flight.
+        while self._pending:
+            if len(self._pending) <= max_pending and not self._pending[0].done():
+                break
+            self._fh.write(self._pending.popleft().result())
+
+class RunIndex(collections.abc.Mapping):
+    """Compact map of runs per sample
+    
+    Read-only mapping from sample ID to the list of its runs, as
+    returned by :py:func:`process_run_list`. Sample IDs are interned
+    and stored once, and the runs of all samples are kept in a single
+    list grouped by sample, with the start of each sample stored in an
+    array of offsets. Samples keep the order in which they first
+    appear in the file, and runs keep their order within each sample.
+    
+    Attributes:
+        samples (list): Sample IDs.
+        runs (list): Run IDs, grouped by sample.
+        offsets (array.array): Position in *runs* of the first run of
+            every sample, plus the total number of runs at the end.
+    """
+    
+    def __init__(self, samples, runs, offsets):
+        self.samples = samples
+        self.runs = runs
+        self.offsets = offsets
+        self._sample_index = {sample: i for i, sample in enumerate(samples)}
+        self._run_index = None
+    
+    @classmethod
+    def from_file(cls, file, sample_col, run_col, header = True, cache = None):
+        """Builds the index from a tab-delimited file
+        
+        Args:
+            file: File name containing the table.
+            sample_col: 0-indexed column with the sample IDs.
+            run_col: 0-indexed column with the run IDs.
+            header: Whether to skip the first line of the file.
+            cache: If True, the index is stored in a binary sidecar
+                named *file*.runidx, and loaded from it in later calls
+                as long as the size and modification time of *file*
+                do not change. It can also be the name of the sidecar
+                to use. If None or False, no cache is used.
+        
+        Returns:
+            A :py:class:`RunIndex`.
+        """
+        if cache is True:
+            cache = file + ".runidx"
+        key = "RunIndex:{}:{}:{}:{}".format(sample_col, run_col, bool(header),
+                                            sys.byteorder)
+        if cache:
+            sections = _read_sidecar(cache, file, key)
+            if sections is not None:
+                return(cls._from_sections(sections))
+        
+        samples = []
+        sample_index = {}
+        codes = array.array('L')
+        rows = []
+        with open(file, 'r') as fh:
+            if header is True:
+                fh.readline()
+            for line in fh:
+                line = line.rstrip('\r\n')
+                if not line:
+                    continue
+                fields = line.split('\t')
+                sample = fields[sample_col]
+                code = sample_index.get(sample)
+                if code is None:
+                    code = len(samples)
+                    sample_index[sample] = code
+                    samples.append(sys.intern(sample))
+                codes.append(code)
+                rows.append(fields[run_col])
+        
+        # Counting sort of the runs by sample, which keeps the order of
+        # the runs within each sample.
+        offsets = array.array('Q', bytes(8 * (len(samples) + 1)))
+        for code in codes:
+            offsets[code + 1] += 1
+        for i in range(len(samples)):
+            offsets[i + 1] += offsets[i]
+        positions = array.array('Q', offsets[:-1])
+        runs = [None] * len(rows)
+        for code, run in zip(codes, rows):
+            runs[positions[code]] = run
+            positions[code] += 1
+        
+        index = cls(samples, runs, offsets)
+        if cache:
+            _write_sidecar(cache, file, key, index._to_sections())
+        return(index)
+    
+    @classmethod
+    def _from_sections(cls, sections):
+        samples, runs, offsets_bytes = sections
+        offsets = array.array('Q')
+        offsets.frombytes(offsets_bytes)
+        samples = [sys.intern(s) for s in _split_blob(samples)]
+        return(cls(samples, _split_blob(runs), offsets))
+    
+    def _to_sections(self):
+        return([_join_blob(self.samples), _join_blob(self.runs),
+                self.offsets.tobytes()])
+    
+    def __getitem__(self, sample):
+        i = self._sample_index[sample]
+        return(self.runs[self.offsets[i]:self.offsets[i + 1]])
+    
+    def __iter__(self):
+        return(iter(self.samples))
+    
+    def __len__(self):
+        return(len(self.samples))
+    
+    def __contains__(self, sample):
+        return(sample in self._sample_index)
+    
+    @property
+    def nruns(self):
+        """Total number of runs"""
+        return(len(self.runs))
+    
+    def sample_of(self, run):
+        """Returns the sample of a run
+        
+        Raises:
+            KeyError: If the run is not in the index.
+        """
+        if self._run_index is None:
+            run_index = {}
+            for i in range(len(self.samples)):
+                for run_i in range(self.offsets[i], self.offsets[i + 1]):
+                    run_index[self.runs[run_i]] = i
+            self._run_index = run_index
+        return(self.samples[self._run_index[run]])
+    
+    def to_dict(self):
+        """Returns a dictionary with a list of runs per sample"""
+        return({sample: self[sample] for sample in self.samples})
+
+def _join_blob(strings):
+    return("\n".join(strings).encode())
+
+def _split_blob(blob):
+    if len(blob) == 0:
+        return([])
+    return(bytes(blob).decode().split("\n"))
+
+def bzip2_files(infiles, outfile, processes = None, block_size = BZ2_BLOCK_SIZE,
+                compresslevel = 9, recompress = False, verbose = True):
+    """Compresses and concatenates files into a multi-stream bz2 file
+    
+    Takes a list of file names and writes their concatenation as a
+    bz2 file, compressing blocks in parallel with a
+    :py:class:`BZ2BlockWriter`. Inputs whose names end in '.bz2' are
+    appended as they are, unless *recompress* is True.
+    
+    Args:
+        infiles: List (or any iterable) of file names.
+        outfile (str): Name of the bz2 file to create. It will overwrite
+            any existing file with that name.
+        processes (int): Number of compression processes. If None, uses
+            the number of CPUs.
+        block_size (int): Uncompressed bytes per block.
+        compresslevel (int): bz2 compression level (1-9).
+        recompress (bool): Whether to decompress and compress again
+            the '.bz2' inputs, instead of appending their streams.
+        verbose (bool): Whether to print a summary to STDOUT.
+    
+    Returns:
+        A :py:class:`CompressionResult`.
+    """
+    
+    start = time.perf_counter()
+    nfiles = 0
+    with BZ2BlockWriter(outfile, processes = processes, block_size = block_size,
+                        compresslevel = compresslevel) as writer:
+        for infile in infiles:
+            nfiles += 1
+            if infile.endswith('.bz2') and not recompress:
+                writer.write_bz2_file(infile)
+                continue
+            if infile.endswith('.bz2'):
+                in_fh = bz2.open(infile, 'rb')
+            else:
+                in_fh = open(infile, 'rb')
+            with in_fh:
+                for chunk in iter(lambda: in_fh.read(block_size), b''):
+                    writer.write(chunk)
+    
+    res = CompressionResult(outfile, nfiles, writer.nbytes,
+                            time.perf_counter() - start,
+                            os.path.getsize(outfile))
+    if verbose:
+        print("\tCompressed {} files into {}".format(nfiles, outfile))
+        print("\t\t{} bytes into {} in {:.2f}s ({:.1f} MB/s)".format(res.nbytes,
+                                                                  res.compressed_bytes,
+                                                                  res.seconds,
+                                                                  res.throughput / 1e6))
+    
+    return(res)
+
+def _cached_column(infile, col, separator, header, cache, max_bytes = None):
+    """Returns a column of a file, going through a binary cache
+    
+    See the *cache* argument of :py:func:`return_column`. The cache is
+    written atomically, so concurrent calls never see partial files.
+    """
+    
+    key = "column:{}:{!r}:{}".format(col, separator, bool(header))
+    if cache is True:
+        path = "{}.col{}.cache".format(infile, col)
+    else:
+        os.makedirs(cache, exist_ok = True)
+        digest = hashlib.sha1((os.path.abspath(infile) + "\0" + key).encode())
+        path = os.path.join(cache, "{}.{}{}".format(os.path.basename(infile),
+                                                    digest.hexdigest()[:16],
+                                                    COLUMN_CACHE_SUFFIX))
+    
+    sections = _read_sidecar(path, infile, key)
+    if sections is not None:
+        try:
+            # Most recently used caches are evicted last
+            os.utime(path)
+        except OSError:
+            pass
+        nvalues = struct.unpack('<Q', sections[0])[0]
+        if nvalues == 0:
+            return([])
+        return(str(sections[1], 'utf-8').split('\n'))
+    
+    values = []
+    for block in _column_blocks(infile, [col - 1], separator, header):
+        values.extend(block[0])
+    blob = "\n".join(values).encode()
+    if values and blob.count(b'\n') != len(values) - 1:
+        print("\tWARNING: Column has values with newlines. Not caching it")
+        return(values)
+    if _write_sidecar(path, infile, key, [struct.pack('<Q', len(values)), blob]):
+        if max_bytes is not None and cache is not True:
+            _evict_cache(cache, max_bytes, COLUMN_CACHE_SUFFIX, keep = path)
+    
+    return(values)
+
+def _evict_cache(cache_dir, max_bytes, suffix, keep = None):
+    """Removes least recently used cache files until they fit in max_bytes
+    
+    Only files ending in *suffix* are considered. Files that other
+    processes remove at the same time are ignored.
+    """
+    
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(suffix):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, entry.path, st.st_size))
+            total += st.st_size
+    
+    entries.sort()
+    for mtime, path, size in entries:
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+            continue
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+class _Reaper(object):
+    """Deletes directories moved to the trash from a background thread"""
+    
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._thread = None
+    
+    def submit(self, path):
+        with self._condition:
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, daemon = True)
+                self._thread.start()
+        self._queue.put(path)
+    
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            try:
+                remove_tree(path)
+                # Leave the trash directory if it is still in use
+                with _trash_lock:
+                    os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+            finally:
+                with self._condition:
+                    self._pending -= 1
+                    self._condition.notify_all()
+    
+    def wait(self, timeout = None):
+        with self._condition:
+            return(self._condition.wait_for(lambda: self._pending == 0, timeout))
+
+_reaper = _Reaper()
+_trash_dirs = {}
+_trash_lock = threading.Lock()
+# Script run by a detached process to delete directories in the trash
+_REAP_SCRIPT = ("import os, shutil, sys\n"
+                "for path in sys.argv[1:]:\n"
+                "    shutil.rmtree(path, ignore_errors = True)\n"
+                "    try:\n"
+                "        os.rmdir(os.path.dirname(path))\n"
+                "    except OSError:\n"
+                "        pass\n")
+
+def _move_to_trash(path):
+    """Renames a directory into the trash of its filesystem
+    
+    Every filesystem gets one trash directory, named TRASH_NAME, in the
+    parent of the first directory moved from it, so moving is a rename
+    that does not copy any data. Each directory is moved into its own
+    subdirectory of the trash.
+    
+    Returns:
+        The subdirectory of the trash that holds the directory.
+    
+    Raises:
+        OSError: If the directory cannot be renamed.
+    """
+    path = os.path.abspath(path)
+    parent = os.path.dirname(path)
+    dev = os.stat(parent).st_dev
+    with _trash_lock:
+        trash = _trash_dirs.get(dev)
+        if trash is None or not os.path.isdir(os.path.dirname(trash)):
+            trash = _trash_dirs[dev] = os.path.join(parent, TRASH_NAME)
+        # The trash is removed by the reaper once it is empty
+        os.makedirs(trash, exist_ok = True)
+        holder = tempfile.mkdtemp(prefix = os.path.basename(path) + ".",
+                                  dir = trash)
+    try:
+        os.rename(path, os.path.join(holder, os.path.basename(path)))
+    except OSError:
+        os.rmdir(holder)
+        raise
+    return(holder)
+
+def wait_for_reaps(timeout = None):
+    """Waits for directories removed by clean_dirs in the background
+    
+    Waits until the background thread has deleted every directory that
+    :py:func:`clean_dirs` moved to the trash with *background* set.
+    Directories handed to a detached process are not waited for.
+    This is called automatically when the interpreter exits.
+    
+    Args:
+        timeout (float): Maximum seconds to wait. If None, waits until
+            all are deleted.
+    
+    Returns:
+        True if nothing is left to delete.
+    """
+    return(_reaper.wait(timeout))
+
+atexit.register(wait_for_reaps)
+
+def clean_dirs(dirs, location = None, threads = REMOVE_THREADS,
+               dry_run = False, stats = False, background = False,
+               detach = False):
     """Takes a set of directories and  removes them
     
-    Removes a list of directories
+    Removes a list of directories with :py:func:`remove_tree`, which
+    deletes the files of every directory from a pool of threads.
+    
+    In background mode, every directory is instead renamed into a
+    trash directory on its filesystem and the function returns right
+    away. The trash is deleted by a background thread (see
+    :py:func:`wait_for_reaps`), or by a detached process that keeps
+    running after this one exits. Directories that cannot be renamed
+    are removed in the foreground.
     
     Args:
         dirs: Either a single directory name, a file that has a
             list of directories (one per line) to be removed, or a
             list of directories
         location: Base path for the directories to be removed
+        threads (int): Number of threads deleting files.
+        dry_run (bool): If True, nothing is removed, and the
+            returned list and statistics show what would be removed.
+        stats (bool): Whether to also return the number of files and
+            bytes removed. Directories removed in background mode are
+            not counted.
+        background (bool): Whether to move the directories to the trash
+            and delete them in the background.
+        detach (bool): In background mode, whether to delete the trash
+            from a detached process instead of a thread.
     
-    Returns: List of removed directory
+    Returns: List of removed directory. If *stats* is True, a tuple
+        with that list and a :py:class:`RemovalStats` for all of them.
     """
     
+    totals = RemovalStats()
     if isinstance(dirs, list):
         print("== Removing directories")
         removed = []
-        for dir in dirs:
-            if location is not None:
-                dir = location + "/" + dir
-            
-            if os.path.isdir(dir):
-                print("\tRemoving {}".format(dir))
-                shutil.rmtree(dir)
-                removed.append(dir)
-            else:
-                print("\tDirectory {} not found. SKIPPING".format(dir))
+        trashed = []
+        with ThreadPoolExecutor(threads) as executor:
+            for dir in dirs:
+                if location is not None:
+                    dir = location + "/" + dir
+                
+                if os.path.isdir(dir):
+                    if background and not dry_run:
+                        try:
+                            trashed.append(_move_to_trash(dir))
+                            print("\tMoved {} to trash".format(dir))
+                            removed.append(dir)
+                            continue
+                        except OSError as error:
+                            print("\tCould not move {} to trash ({})".format(dir, error))
+                    print("\tRemoving {}".format(dir))
+                    totals += remove_tree(dir, dry_run = dry_run,
+                                          executor = executor)
+                    removed.append(dir)
+                else:
+                    print("\tDirectory {} not found. SKIPPING".format(dir))
+        if trashed and detach:
+            subprocess.Popen([sys.executable, '-c', _REAP_SCRIPT] + trashed,
+                             stdin = subprocess.DEVNULL,
+                             stdout = subprocess.DEVNULL,
+                             stderr = subprocess.DEVNULL,
+                             start_new_session = True)
+        else:
+            for path in trashed:
+                _reaper.submit(path)
+        print("\t{} {} files, {} bytes".format("Would remove" if dry_run else "Removed",
+                                              totals.nfiles, totals.nbytes))
     elif os.path.isfile(dirs):
         # Read file
         with open(dirs,'r') as fh:
             dirlist = [line.rstrip() for line in fh]
         fh.close()
-        removed = clean_dirs(dirlist,location)
+        removed, totals = clean_dirs(dirlist,location, threads, dry_run, True,
+                                     background, detach)
     else:
         # Assume it is a single directory
-        removed = clean_dirs([dirs],location)
+        removed, totals = clean_dirs([dirs],location, threads, dry_run, True,
+                                     background, detach)
     
-    return(removed)       
-                
+    if stats:
+        return((removed, totals))
+    return(removed)
+
+def _copy_fd(in_fd, out_fd, size = None, buffer_size = COPY_BUFFER_SIZE):
+    """Copies the contents of one file descriptor into another
+    
+    Uses :py:func:`os.copy_file_range` when available, then
+    :py:func:`os.sendfile`, and finally plain reads and writes. Each
+    method is abandoned for the next one as soon as the kernel reports
+    that it cannot be used for this pair of files.
+    
+    Args:
+        in_fd (int): File descriptor to read from, starting at offset 0.
+        out_fd (int): File descriptor to write to, at its current offset.
+        size (int): Number of bytes to copy. If None, copies with reads
+            and writes until the end of the input.
+        buffer_size (int): Maximum number of bytes per system call.
     
+    Returns:
+        The number of bytes copied.
+    
+    Raises:
+        IOError: If the input has less than *size* bytes.
+    """
+    
+    methods = []
+    if size is not None:
+        if hasattr(os, 'copy_file_range'):
+            methods.append('copy_file_range')
+        if hasattr(os, 'sendfile'):
+            methods.append('sendfile')
+    methods.append('read')
+    
+    pos = 0
+    while size is None or pos < size:
+        count = buffer_size if size is None else min(buffer_size, size - pos)
+        method = methods[0]
+        try:
+            if method == 'copy_file_range':
+                n = os.copy_file_range(in_fd, out_fd, count, pos)
+            elif method == 'sendfile':
+                n = os.sendfile(out_fd, in_fd, pos, count)
+            else:
+                os.lseek(in_fd, pos, os.SEEK_SET)
+                n = _write_all(out_fd, os.read(in_fd, count))
+        except OSError as error:
+            if method != 'read' and error.errno in _COPY_FALLBACK_ERRNOS:
+                methods.pop(0)
+                continue
+            raise
+        if n == 0:
+            if method != 'read':
+                # Some files, e.g. in /proc, report a size but cannot
+                # be copied by the kernel
+                methods.pop(0)
+                continue
+            if size is not None:
+                raise IOError("Input ended after {} of {} bytes".format(pos, size))
+            break
+        pos += n
+    
+    return(pos)
 
-def concatenate_files(infiles, outfile):
+def _write_all(fd, data):
+    """Writes a whole bytes object to a file descriptor and returns its length"""
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+    return(len(data))
+
+def concatenate_files(infiles, outfile, buffer_size = COPY_BUFFER_SIZE,
+                      verbose = True):
     """Concatenates a list of files.
     
-    Takes a list of file names and concatenates those
-    files using the UNIX cat utility
+    Takes a list of file names and concatenates those files in
+    process, without calling the shell. Data is copied by the
+    kernel (:py:func:`os.copy_file_range` or :py:func:`os.sendfile`)
+    whenever the filesystem supports it, and with large buffered
+    reads and writes otherwise. There is no limit on the number
+    of input files.
     
     Args:
-        infiles: List of file names
+        infiles: List (or any iterable) of file names
         outfile: File name to store the concatenated result.
             It will overwrite any existing file with that
             name.
+        buffer_size (int): Maximum number of bytes copied per
+            system call.
+        verbose (bool): Whether to print the number of bytes copied
+            and the throughput to STDOUT.
     
     Returns:
-        Returns the result of calling :py:func:`subprocess.run`
+        A :py:class:`ConcatenationResult` with the number of files
+        and bytes copied and the time it took.
         
     Raises:
-        CalledProcessError: If the cat command returns a non-zero
-            status.
+        OSError: If any input file cannot be read or the output
+            cannot be written.
+    """
+    
+    start = time.perf_counter()
+    nfiles = 0
+    nbytes = 0
+    with open(outfile, 'wb', buffering = 0) as out_fh:
+        out_fd = out_fh.fileno()
+        for infile in infiles:
+            with open(infile, 'rb', buffering = 0) as in_fh:
+                in_fd = in_fh.fileno()
+                info = os.fstat(in_fd)
+                size = info.st_size if stat.S_ISREG(info.st_mode) else None
+                nbytes += _copy_fd(in_fd, out_fd, size, buffer_size)
+            nfiles += 1
+    
+    res = ConcatenationResult(outfile, nfiles, nbytes,
+                              time.perf_counter() - start)
+    if verbose:
+        print("\tConcatenated {} files into {}".format(nfiles, outfile))
+        print("\t\t{} bytes in {:.2f}s ({:.1f} MB/s)".format(nbytes, res.seconds,
+                                                          res.throughput / 1e6))
+    
+    return(res)
+
+class DownloadResult(object):
+    """Summary of a call to :py:func:`download_file`
+    
+    Attributes:
+        outfile (str): Name of the file created.
+        nbytes (int): Size of the file.
+        checksum (str): Hex digest of the whole file, or None if no
+            checksum was requested.
+        seconds (float): Wall-clock time spent downloading.
+        resumed (int): Number of bytes that were already on disk from
+            a previous partial download.
+        url (str): URL downloaded, if any.
+        skipped (bool): Whether the file already existed and was not
+            downloaded by :py:func:`fetch_files`.
+        error (Exception): Exception raised by the last attempt, or
+            None if the download succeeded.
+    """
+    
+    def __init__(self, outfile, nbytes, checksum, seconds, resumed = 0,
+                 url = None, skipped = False, error = None):
+        self.outfile = outfile
+        self.nbytes = nbytes
+        self.checksum = checksum
+        self.seconds = seconds
+        self.resumed = resumed
+        self.url = url
+        self.skipped = skipped
+        self.error = error
+    
+    @property
+    def ok(self):
+        """Whether the file is complete on disk"""
+        return(self.error is None)
+    
+    @property
+    def throughput(self):
+        """Bytes downloaded per second, not counting resumed bytes"""
+        if self.seconds <= 0:
+            return(float(self.nbytes - self.resumed))
+        return((self.nbytes - self.resumed) / self.seconds)
+    
+    def __repr__(self):
+        return("DownloadResult(outfile={!r}, nbytes={}, checksum={!r}, "
+               "seconds={:.3f}, resumed={}, skipped={}, "
+               "error={!r})".format(self.outfile, self.nbytes, self.checksum,
+                                    self.seconds, self.resumed, self.skipped,
+                                    self.error))
+
+def _response_chunks(download, chunk_size):
+    """Iterates over the body of a response as bytes chunks
+    
+    Uses *iter_content* (:py:func:`requests.get`), *read* (file-like
+    and :py:mod:`http.client` responses) or, as a last resort, the
+    *text* attribute.
+    """
+    if hasattr(download, 'iter_content'):
+        return(download.iter_content(chunk_size))
+    if hasattr(download, 'read'):
+        return(iter(lambda: download.read(chunk_size), b''))
+    text = download.text
+    return([text.encode() if isinstance(text, str) else text])
+
+def _write_chunks(chunks, fh, hasher):
+    """Writes chunks to a binary file and returns the number of bytes"""
+    nbytes = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        fh.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+        nbytes += len(chunk)
+    return(nbytes)
+
+def _hash_file(fh, hasher, buffer_size = COPY_BUFFER_SIZE):
+    """Feeds an open binary file to a hash object"""
+    for chunk in iter(lambda: fh.read(buffer_size), b''):
+        hasher.update(chunk)
+
+class _ConnectionPool(object):
+    """Keep-alive HTTP connections shared by threads
+    
+    Idle connections are kept per (scheme, host) and handed to the next
+    request to the same host. *per_host* limits the number of
+    connections to a host in use at the same time.
+    """
+    
+    def __init__(self, timeout = 60, per_host = None):
+        self.timeout = timeout
+        self.per_host = per_host
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+    
+    def acquire(self, key):
+        """Returns a connection to a host and whether it was used before"""
+        scheme, netloc = key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection
+        elif scheme == 'http':
+            connection = http.client.HTTPConnection
+        else:
+            raise ValueError("Unsupported URL scheme: {}".format(scheme))
+        with self._lock:
+            if self.per_host is not None and key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.per_host)
+            slot = self._slots.get(key)
+        if slot is not None:
+            slot.acquire()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return((idle.pop(), True))
+        return((connection(netloc, timeout = self.timeout), False))
+    
+    def release(self, key, conn, reuse):
+        """Returns a connection, which is closed unless *reuse* is True"""
+        if reuse:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        else:
+            conn.close()
+        slot = self._slots.get(key)
+        if slot is not None:
+            slot.release()
+    
+    def close(self):
+        """Closes all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+# Errors raised when the server closed an idle keep-alive connection
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                            ConnectionResetError, BrokenPipeError)
+
+def _http_get(url, headers, pool, redirects = 5):
+    """Sends a GET request and follows redirects
+    
+    Returns:
+        The :py:class:`http.client.HTTPResponse`, and the pool key and
+        connection that produced it, which must be released to *pool*.
+    """
+    for i in range(redirects + 1):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        conn, reused = pool.acquire(key)
+        try:
+            try:
+                conn.request('GET', path, headers = headers)
+                response = conn.getresponse()
+            except _STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # Reconnect once, the server closed the idle connection
+                conn.close()
+                conn.request('GET', path, headers = headers)
+                response = conn.getresponse()
+        except BaseException:
+            pool.release(key, conn, False)
+            raise
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('Location')
+            response.read()
+            pool.release(key, conn, not response.will_close)
+            if location is None:
+                raise DownloadError("Redirect without location from {}".format(url),
+                                    response.status)
+            url = urllib.parse.urljoin(url, location)
+            continue
+        return((response, key, conn))
+    raise DownloadError("Too many redirects for {}".format(url))
+
+def _download(url, outfile, resume, checksum, chunk_size, headers, pool):
+    """Downloads a URL to outfile through a partial file"""
+    start = time.perf_counter()
+    part = outfile + PART_SUFFIX
+    hasher = hashlib.new(checksum) if checksum is not None else None
+    request_headers = dict(headers) if headers is not None else {}
+    offset = 0
+    if resume and os.path.isfile(part):
+        offset = os.path.getsize(part)
+    if offset > 0:
+        request_headers['Range'] = 'bytes={}-'.format(offset)
+    
+    response, key, conn = _http_get(url, request_headers, pool)
+    drained = False
+    try:
+        complete = False
+        if offset > 0 and response.status == 416:
+            # The partial file might already be complete
+            total = response.getheader('Content-Range', '').rpartition('/')[2]
+            response.read()
+            drained = True
+            complete = total == str(offset)
+        elif offset > 0 and response.status == 206:
+            pass
+        elif response.status == 200:
+            # Server ignored the range, start over
+            offset = 0
+        else:
+            raise DownloadError("HTTP {} {} for {}".format(response.status,
+                                                          response.reason,
+                                                          url),
+                                response.status)
+        
+        if not drained:
+            nbytes = offset
+            with open(part, 'ab' if offset > 0 else 'wb') as fh:
+                if hasher is not None and offset > 0:
+                    with open(part, 'rb') as in_fh:
+                        _hash_file(in_fh, hasher)
+                nbytes += _write_chunks(_response_chunks(response, chunk_size),
+                                        fh, hasher)
+            drained = True
+            length = response.getheader('Content-Length')
+            if length is not None and nbytes - offset != int(length):
+                raise DownloadError("Incomplete download of {}: got {} of {} "
+                                    "bytes".format(url, nbytes - offset, length))
+    finally:
+        if not drained:
+            response.close()
+        pool.release(key, conn, drained and not response.will_close)
+    
+    if drained and not complete and response.status == 416:
+        # Partial file does not match the remote file
+        os.unlink(part)
+        return(_download(url, outfile, False, checksum, chunk_size, headers,
+                         pool))
+    if complete:
+        nbytes = offset
+        if hasher is not None:
+            with open(part, 'rb') as in_fh:
+                _hash_file(in_fh, hasher)
+    
+    os.replace(part, outfile)
+    return(DownloadResult(outfile, nbytes,
+                          hasher.hexdigest() if hasher is not None else None,
+                          time.perf_counter() - start, offset, url))
+
+def download_file(url, outfile, resume = True, checksum = 'md5',
+                  chunk_size = DOWNLOAD_CHUNK_SIZE, timeout = 60,
+                  headers = None):
+    """Downloads a URL into a file with constant memory
+    
+    Streams the body of an HTTP(S) GET request into *outfile* plus
+    PART_SUFFIX, which is renamed to *outfile* once complete, so
+    *outfile* never holds a partial download. If the partial file of
+    a previous attempt exists, only the missing bytes are requested
+    with an HTTP Range header; if the server does not honor the range,
+    the download starts over.
+    
+    Args:
+        url (str): HTTP or HTTPS URL to download.
+        outfile (str): Name of the file to create. It will overwrite
+            any existing file with that name.
+        resume (bool): Whether to resume an existing partial file.
+        checksum (str): Name of a :py:mod:`hashlib` algorithm computed
+            over the whole file while downloading, or None.
+        chunk_size (int): Bytes read per chunk.
+        timeout (float): Seconds to wait on the connection.
+        headers (dict): Extra request headers.
+    
+    Returns:
+        A :py:class:`DownloadResult`.
+    
+    Raises:
+        DownloadError: If the server returns an error or the body is
+            shorter than announced. The partial file is kept.
+        OSError: If the connection fails or the file cannot be written.
+    """
+    
+    pool = _ConnectionPool(timeout)
+    try:
+        return(_download(url, outfile, resume, checksum, chunk_size, headers,
+                         pool))
+    finally:
+        pool.close()
+
+def _fetch_one(url, outfile, retries, backoff, skip_existing, checksum,
+               chunk_size, headers, pool):
+    """Downloads a file for fetch_files, retrying on transient errors"""
+    if skip_existing and os.path.isfile(outfile):
+        return(DownloadResult(outfile, os.path.getsize(outfile), None, 0.0,
+                              url = url, skipped = True))
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            return(_download(url, outfile, True, checksum, chunk_size, headers,
+                             pool))
+        except (DownloadError, http.client.HTTPException, OSError) as error:
+            status = getattr(error, 'status', None)
+            # Client errors will not go away by trying again
+            permanent = status is not None and 400 <= status < 500 and status not in (408, 429)
+            if permanent or attempt >= retries:
+                return(DownloadResult(outfile, 0, None,
+                                      time.perf_counter() - start, url = url,
+                                      error = error))
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+def fetch_files(pairs, max_workers = 8, per_host = 4, retries = 3,
+                backoff = 1.0, skip_existing = True, checksum = 'md5',
+                chunk_size = DOWNLOAD_CHUNK_SIZE, timeout = 60,
+                headers = None, verbose = True):
+    """Downloads many URLs concurrently
+    
+    Downloads every URL with :py:func:`download_file` from a pool of
+    threads that share keep-alive connections, so consecutive files
+    from the same host do not pay for a new connection. Failed
+    downloads are retried with exponential backoff and resume from
+    the bytes already on disk.
+    
+    Args:
+        pairs: Iterable of (url, outfile) tuples.
+        max_workers (int): Maximum number of simultaneous downloads.
+        per_host (int): Maximum number of simultaneous connections to
+            the same host. None for no limit.
+        retries (int): Number of times a failed download is retried.
+            Client errors (HTTP 4xx, except 408 and 429) are not retried.
+        backoff (float): Seconds to wait before the first retry. The
+            wait doubles with every retry.
+        skip_existing (bool): Whether to skip URLs whose outfile
+            exists. Since downloads go through a partial file, an
+            existing outfile is always complete.
+        checksum (str): Name of a :py:mod:`hashlib` algorithm computed
+            over every file, or None.
+        chunk_size (int): Bytes read per chunk.
+        timeout (float): Seconds to wait on a connection.
+        headers (dict): Extra request headers.
+        verbose (bool): Whether to print the progress to STDOUT.
+    
+    Returns:
+        A list of :py:class:`DownloadResult` in the same order as
+        *pairs*. Failed downloads have their *error* attribute set
+        instead of raising.
+    """
+    
+    pairs = list(pairs)
+    pool = _ConnectionPool(timeout, per_host)
+    results = [None] * len(pairs)
+    if verbose:
+        print("== Downloading {} files".format(len(pairs)))
+    try:
+        with ThreadPoolExecutor(max_workers) as executor:
+            futures = {executor.submit(_fetch_one, url, outfile, retries,
+                                       backoff, skip_existing, checksum,
+                                       chunk_size, headers, pool): i
+                       for i, (url, outfile) in enumerate(pairs)}
+            for future, i in futures.items():
+                results[i] = future.result()
+    finally:
+        pool.close()
+    
+    if verbose:
+        for res in results:
+            if res.skipped:
+                print("\tSkipped {} (exists)".format(res.outfile))
+            elif res.ok:
+                print("\tDownloaded {} ({} bytes)".format(res.outfile, res.nbytes))
+            else:
+                print("\tFailed {} ({})".format(res.url, res.error))
+        nfailed = sum(not res.ok for res in results)
+        print("\t{} files downloaded, {} failed".format(len(results) - nfailed,
+                                                        nfailed))
+    
+    return(results)
+
+def _column_blocks(infile, cols, separator = '\t', header = True,
+                   block_size = COLUMN_BLOCK_SIZE):
+    """Reads some columns of a file in blocks
+    
+    Files without quote characters are scanned over a memory map of
+    the file, one block of lines at a time. Every line is split only
+    up to the last requested column, and the values of a column in a
+    block are decoded with a single call. Files that contain quotes
+    are parsed with :py:func:`csv.reader`. Empty lines are skipped.
+    
+    Args:
+        cols: List of 0-indexed column numbers.
+        block_size: Approximate number of bytes per block.
+    
+    Yields:
+        A list with one list of values per column in *cols*, for the
+        lines in each block.
+    """
+    
+    with open(infile, 'rb') as fh:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return
+    
+    with mm:
+        if mm.find(b'"') == -1:
+            sep = separator.encode()
+            maxsplit = max(cols) + 1
+            n = len(mm)
+            pos = 0
+            if header:
+                pos = mm.find(b'\n') + 1 or n
+            while pos < n:
+                end = pos + block_size
+                if end >= n:
+                    end = n
+                else:
+                    newline = mm.rfind(b'\n', pos, end)
+                    if newline == -1:
+                        newline = mm.find(b'\n', end)
+                    end = n if newline == -1 else newline + 1
+                lines = [line for line in mm[pos:end].splitlines() if line]
+                pos = end
+                if not lines:
+                    continue
+                # Splitting once per column avoids keeping a list of
+                # fields per line alive, which is much slower.
+                yield([b'\n'.join([line.split(sep, maxsplit)[col]
+                                   for line in lines]).decode().split('\n')
+                       for col in cols])
+            return
+    
+    with open(infile, 'r', newline = '') as fh:
+        reader = csv.reader(fh, delimiter = separator)
+        if header:
+            next(reader, None)
+        block = [[] for col in cols]
+        for row in reader:
+            if not row:
+                continue
+            for values, col in zip(block, cols):
+                values.append(row[col])
+            if len(block[0]) >= 100000:
+                yield(block)
+                block = [[] for col in cols]
+        if block[0]:
+            yield(block)
+
+def iter_columns(infile, cols, separator = '\t', header = True):
+    """Iterates over the values of some columns of a file
+    
+    Reads the file in a single pass, in blocks of lines, and yields
+    the values of the requested columns for every row. Files without
+    quote characters are scanned directly over a memory map of the
+    file, and files with quotes are parsed with :py:func:`csv.reader`.
+    Empty lines are skipped.
+    
+    Args:
+        infile: File name with the table.
+        cols: List of column numbers to return. Must be 1-indexed
+            integers.
+        separator: String that separates columns in the file.
+        header: Logical indicating whether the table has a first row
+            of headers, which is skipped.
+    
+    Yields:
+        A tuple with the value of every column in *cols*.
+    """
+    
+    cols = [col - 1 for col in cols]
+    for block in _column_blocks(infile, cols, separator, header):
+        for row in zip(*block):
+            yield(row)
+
+def _lpt_partition(weights, nbins):
+    """Splits items in bins of similar total weight
+    
+    Uses the Longest Processing Time rule: items are taken from the
+    heaviest to the lightest, and each one goes to the bin with the
+    lowest total weight so far.
+    
+    Args:
+        weights (list): Weight of every item.
+        nbins (int): Number of bins.
+    
+    Returns:
+        A tuple with a list of bins, each a list of item indices in
+        their original order, and a list with the total weight of every
+        bin.
+    """
+    
+    bins = [[] for i in range(nbins)]
+    heap = [(0, i) for i in range(nbins)]
+    order = sorted(range(len(weights)), key = lambda i: weights[i], reverse = True)
+    for item in order:
+        load, b = heapq.heappop(heap)
+        bins[b].append(item)
+        heapq.heappush(heap, (load + weights[item], b))
+    loads = [0] * nbins
+    for load, b in heap:
+        loads[b] = load
+    return(([sorted(items) for items in bins], loads))
+
+def _list_schedule_makespan(durations, slots):
+    """Returns when the last of a list of tasks ends
+    
+    Tasks start in order, each as soon as one of *slots* is free.
+    """
+    free = [0] * slots
+    for duration in durations:
+        heapq.heapreplace(free, free[0] + duration)
+    return(max(free))
+
+def _first_fit_partition(weights, capacity, slots = 1):
+    """Splits items in as few bins of at most *capacity* as possible
+    
+    Uses the First Fit Decreasing rule. The items of a bin run in their
+    original order on *slots* parallel slots, and an item only goes in
+    a bin if they still end within *capacity* (see
+    :py:func:`_list_schedule_makespan`). Items heavier than *capacity*
+    get a bin of their own.
+    
+    Returns:
+        Same as :py:func:`_lpt_partition`.
+    """
+    
+    bins = []
+    loads = []
+    order = sorted(range(len(weights)), key = lambda i: weights[i], reverse = True)
+    for item in order:
+        for b in range(len(bins)):
+            items = sorted(bins[b] + [item])
+            if _list_schedule_makespan([weights[i] for i in items],
+                                       slots) <= capacity:
+                break
+        else:
+            b = len(bins)
+            bins.append([])
+            loads.append(0)
+        bins[b].append(item)
+        loads[b] += weights[item]
+    return(([sorted(items) for items in bins], loads))
+
+def _parse_walltime(walltime):
+    """Converts '[D-]HH:MM:SS', 'MM:SS' or a number of seconds to seconds"""
+    if isinstance(walltime, (int, float)):
+        return(walltime)
+    days = 0
+    if '-' in walltime:
+        days, walltime = walltime.split('-')
+        days = int(days)
+    seconds = 0
+    for part in walltime.split(':'):
+        seconds = 60 * seconds + int(part)
+    return(86400 * days + seconds)
+
+def _format_walltime(seconds):
+    """Converts seconds to 'HH:MM:SS', rounding up"""
+    seconds = int(math.ceil(seconds))
+    return("{}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60,
+                                     seconds % 60))
+
+def pack_commands(commands, outdir, njobs = None, walltime = None,
+                  scheduler = 'slurm', cpus = 1, parallel = False,
+                  name = "pack", time_margin = 1.2, **options):
+    """Packs many short commands into a few submission scripts
+    
+    Takes commands with an estimated runtime and memory, and splits
+    them in jobs of similar length. Either the number of jobs
+    (*njobs*) or the maximum runtime of each job (*walltime*) must be
+    given. Every job is written with :py:func:`write_slurm_submission`
+    or :py:func:`write_qsub_submission`, requesting the time, memory
+    and CPUs its commands need.
+    
+    With *parallel*, the commands of a job run up to *cpus* at a time,
+    each starting when an earlier one finishes, and its runtime is
+    predicted by simulating that order. The job fails if any of its
+    commands fails. Otherwise they run one after the other.
+    
+    Args:
+        commands (list): Tuples of the form (command, seconds) or
+            (command, seconds, memory), with the estimated runtime in
+            seconds and memory in MB of every command. Commands
+            without memory are assumed to need 1000 MB.
+        outdir (str): Directory to write the submission scripts.
+        njobs (int): Number of jobs to create.
+        walltime: Maximum predicted runtime per job, either in seconds
+            or as 'HH:MM:SS'. Used when *njobs* is None.
+        scheduler (str): Either 'slurm' or 'pbs'.
+        cpus (int): CPUs to request per job.
+        parallel (bool): Whether to run the commands of each job in
+            parallel, up to *cpus* at a time.
+        name (str): Prefix of the job names and script files.
+        time_margin (float): Factor applied to the predicted runtime
+            of every job to request its time.
+        **options: Other options for the submission function, e.g.
+            *queue* or *logfile*.
+    
+    Returns:
+        A list with the file names of the submission scripts.
+    
+    Raises:
+        ValueError: If neither or both of *njobs* and *walltime* are
+            given, or *scheduler* is not recognized.
     """
     
-    command = " ".join(infiles) 
-    command = "cat " + command + " > " + outfile
-    check = run_command(command)
+    if (njobs is None) == (walltime is None):
+        raise ValueError("Exactly one of njobs and walltime must be given")
+    if scheduler not in ('slurm', 'pbs'):
+        raise ValueError("Unrecognized scheduler {}".format(scheduler))
+    
+    commands = [tuple(command) + (1000,) * (3 - len(command))
+                for command in commands]
+    seconds = [command[1] for command in commands]
+    slots = cpus if parallel else 1
+    if njobs is not None:
+        packs, loads = _lpt_partition(seconds, min(njobs, len(commands)))
+    else:
+        packs, loads = _first_fit_partition(seconds, _parse_walltime(walltime),
+                                            slots)
+    
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    loptions = list(options.pop('loptions', []))
     
-    if check.returncode != 0:
-        raise CalledProcessError("Could not concatenate files")
+    print("\n=============================================")
+    print("== Packing {} commands into {} jobs".format(len(commands), len(packs)))
+    if scheduler == 'slurm':
+        template = SubmissionTemplate.slurm(cpus = str(cpus), **options)
+    else:
+        template = SubmissionTemplate.pbs(nodes = "nodes=1:ppn={}".format(cpus),
+                                          **options)
+    SUBMISSIONS = []
+    for i, pack in enumerate(packs):
+        cmds = [commands[j][0] for j in pack]
+        memories = sorted([commands[j][2] for j in pack], reverse = True)
+        runtime = _list_schedule_makespan([seconds[j] for j in pack], slots)
+        memory = int(math.ceil(sum(memories[:slots])))
+        if parallel and cpus > 1:
+            # Bash keeps the status of finished jobs, including those
+            # reaped by wait -n, until they are waited for by PID
+            throttle = ("while [ $(jobs -rp | wc -l) -ge {} ]; "
+                        "do wait -n; done".format(cpus))
+            cmds = ['pids=""'] + [line for cmd in cmds
+                                  for line in (cmd + " &", 'pids="$pids $!"',
+                                               throttle)]
+            # The job exits with the status of the commands after the
+            # lines that the template adds at the end of the script
+            cmds += ['rc=0',
+                     'for pid in $pids; do wait "$pid" || rc=1; done',
+                     "trap 'exit $rc' EXIT"]
+        
+        job_name = "{}{}".format(name, i + 1)
+        submission = os.path.join(outdir, job_name + ".bash")
+        with open(submission, 'w') as fh:
+            if scheduler == 'slurm':
+                template.write(fh, cmds, name = job_name,
+                               memory = "{}M".format(memory),
+                               time = _format_walltime(runtime * time_margin))
+            else:
+                walltime = "walltime=" + _format_walltime(runtime * time_margin)
+                template.write(fh, cmds, name = job_name,
+                               memory = "{}mb".format(memory),
+                               loptions = loptions + [walltime])
+        print("\t{}: {} commands, {} predicted, {} MB".format(job_name, len(pack),
+                                                             _format_walltime(runtime),
+                                                             memory))
+        SUBMISSIONS.append(submission)
+    print("=============================================")
     
-    return(check)
+    return(SUBMISSIONS)
 
-def process_run_list(file,sample_col,run_col,header = True):
+def parse_submission(file):
+    """Reads the scheduler options of a SLURM or PBS submission script
+    
+    Understands the options written by :py:func:`write_slurm_submission`
+    and :py:func:`write_qsub_submission`, in both their short and long
+    forms.
+    
+    Args:
+        file (str): Name of the submission script.
+    
+    Returns:
+        A dictionary with the *scheduler* ('slurm', 'pbs' or None if
+        there are no options), and the *name*, *workdir*, *output* and
+        *error* declared in the script (None when missing), the
+        number of *cpus* (default 1) and the *memory* in MB (default 0).
+    """
+    
+    options = {'scheduler': None, 'name': None, 'workdir': None,
+               'output': None, 'error': None, 'cpus': 1, 'memory': 0}
+    slurm_keys = {'--job-name': 'name', '-J': 'name',
+                  '--workdir': 'workdir', '--chdir': 'workdir', '-D': 'workdir',
+                  '--output': 'output', '-o': 'output',
+                  '--error': 'error', '-e': 'error',
+                  '--cpus-per-task': 'cpus', '-c': 'cpus',
+                  '--mem': 'memory'}
+    pbs_keys = {'-N': 'name', '-d': 'workdir', '-o': 'output', '-e': 'error'}
+    
+    with open(file, 'r') as fh:
+        for line in fh:
+            if line.startswith("#SBATCH"):
+                options['scheduler'] = 'slurm'
+                keys = slurm_keys
+            elif line.startswith("#PBS"):
+                options['scheduler'] = 'pbs'
+                keys = pbs_keys
+            else:
+                continue
+            
+            args = shlex.split(line)[1:]
+            i = 0
+            while i < len(args):
+                arg = args[i]
+                if '=' in arg and arg.startswith('--'):
+                    arg, value = arg.split('=', 1)
+                elif i + 1 < len(args):
+                    i += 1
+                    value = args[i]
+                else:
+                    value = None
+                i += 1
+                
+                if arg == '-l' and value is not None:
+                    # PBS resources, e.g. mem=1000mb or nodes=1:ppn=4
+                    for resource in value.split(','):
+                        if resource.startswith('mem='):
+                            options['memory'] = _parse_memory(resource[4:])
+                        for part in resource.split(':'):
+                            if part.startswith('ppn='):
+                                options['cpus'] = int(part[4:])
+                elif arg in keys and value is not None:
+                    options[keys[arg]] = value
+    
+    options['cpus'] = int(options['cpus'])
+    if isinstance(options['memory'], str):
+        options['memory'] = _parse_memory(options['memory'])
+    return(options)
+
+def _parse_memory(memory):
+    """Converts memory strings like '10G', '1000mb' or '500' to MB"""
+    memory = memory.strip().upper().rstrip('B')
+    units = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    if memory and memory[-1] in units:
+        return(float(memory[:-1]) * units[memory[-1]])
+    return(float(memory))
+
+def process_run_list(file,sample_col,run_col,header = True, cache = None,
+                     compact = False):
     """Takes a map of runs and samples and returns runs per sample.
     
     Takes a file name of a tab-delimited file containing columns
@@ -94,6 +1666,12 @@ def process_run_list(file,sample_col,run_col,header = True):
             a 0-indexed integer.
         header: Logical indicating whether the mapping file contains
             a header row. If so, the first line will be skipped.
+        cache: Whether to keep a binary cache of the map next to the
+            file, or the name of the cache file. See
+            :py:meth:`RunIndex.from_file`.
+        compact: If True, returns the :py:class:`RunIndex` itself,
+            which can be used as a read-only dictionary and also
+            maps runs back to samples.
     
     Returns:
         A dictionary indexed by the sample IDs, and where every
@@ -101,44 +1679,341 @@ def process_run_list(file,sample_col,run_col,header = True):
     """
     
     print("\n=============================================")
-    with open(file,'r') as fh:
-        print("> Processing map of runs")
-        if header is True:
-            colnames = fh.readline()
-        reader = csv.reader(fh, delimiter = "\t")
+    print("> Processing map of runs")
+    index = RunIndex.from_file(file, sample_col, run_col, header = header,
+                               cache = cache)
+    print("\tProcessed {} runs in {} samples".format(index.nruns,len(index)))
+    print("=============================================")
+    
+    if compact:
+        return(index)
+    return(index.to_dict())
+
+# Job states that mean a job is still queued or running. Any other state
+# reported by the scheduler means the job is done.
+ACTIVE_JOB_STATES = ('PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING',
+                     'SUSPENDED', 'REQUEUED', 'REQUEUE_HOLD', 'REQUEUE_FED',
+                     'RESIZING', 'SIGNALING', 'STAGE_OUT', 'STOPPED')
+
+# Job states of qstat and their SLURM equivalent
+_PBS_JOB_STATES = {'Q': 'PENDING', 'H': 'PENDING', 'W': 'PENDING',
+                   'T': 'PENDING', 'R': 'RUNNING', 'E': 'COMPLETING',
+                   'S': 'SUSPENDED', 'C': 'COMPLETED', 'F': 'COMPLETED'}
+# Errors of squeue and qstat for jobs that are no longer known
+_SLURM_MISSING_RE = re.compile(r'invalid job id', re.I)
+_PBS_MISSING_RE = re.compile(r'unknown job id|job has finished', re.I)
+
+def parse_job_ids(output):
+    """Finds job IDs in the output of sbatch or qsub
+    
+    Args:
+        output (str): STDOUT of one or more calls to sbatch (e.g.
+            'Submitted batch job 123', or '123;cluster' with
+            --parsable) or qsub (e.g. '123.server').
+    
+    Returns:
+        A list with the job IDs found, in order.
+    """
+    
+    ids = []
+    for line in output.splitlines():
+        m = re.search(r'Submitted batch job (\d+)', line)
+        if m is not None:
+            ids.append(m.group(1))
+        elif re.match(r'^\d+(\[\])?([.;]\S*)?$', line.strip()):
+            ids.append(line.strip().split(';')[0])
+    return(ids)
+
+class JobTracker(object):
+    """Tracks the state of many scheduler jobs with batched queries
+    
+    Every update of the states makes a single call to squeue (plus
+    one call to sacct for the jobs that already left the queue), or
+    to qstat, for all the tracked jobs. States are cached between
+    updates, and the time between updates grows while nothing changes,
+    from *interval* up to *max_interval*.
+    
+    States follow SLURM's names, e.g. 'PENDING', 'RUNNING',
+    'COMPLETED' or 'FAILED'. PBS states are converted to them. Jobs
+    that the scheduler no longer reports are 'UNKNOWN' in SLURM and
+    'COMPLETED' in PBS. Array jobs are tracked by their base ID, and
+    are done when all their tasks are done. If a query fails, e.g.
+    because the scheduler is not responding, the jobs it did not
+    report keep their state until the next update.
+    
+    Args:
+        job_ids (list): Job IDs to track, e.g. as returned by
+            :py:func:`sbatch_submissions`.
+        scheduler (str): Either 'slurm' or 'pbs'.
+        interval (float): Minimum seconds between updates.
+        max_interval (float): Maximum seconds between updates.
+        backoff (float): Factor by which the time between updates grows
+            after every update with no changes.
+    """
+    
+    def __init__(self, job_ids = (), scheduler = 'slurm', interval = 10,
+                 max_interval = 300, backoff = 1.5):
+        if scheduler not in ('slurm', 'pbs'):
+            raise ValueError("Unrecognized scheduler {}".format(scheduler))
+        self.scheduler = scheduler
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.states = collections.OrderedDict()
+        self._delay = interval
+        self._last_update = None
+        self.add(job_ids)
+    
+    def add(self, job_ids):
+        """Starts tracking more jobs"""
+        for job_id in job_ids:
+            self.states.setdefault(self._base_id(job_id), None)
+    
+    def _base_id(self, job_id):
+        return(re.split(r'[_.\[;]', str(job_id))[0])
+    
+    def pending(self):
+        """Returns the IDs of the jobs that are not done"""
+        return([job_id for job_id, state in self.states.items()
+                if state is None or state in ACTIVE_JOB_STATES])
+    
+    def status(self, refresh = False):
+        """Returns the state of every job
+        
+        The scheduler is only queried if the cached states are older
+        than the current time between updates, or *refresh* is True.
         
-        RUNS = dict()
-        nruns = 0
-        nsamples = 0
-        for line in reader:
-            sample = line[sample_col]
-            run = line[run_col]
-            #print([sample,run])
-            if sample in RUNS:
-                RUNS[sample].append(run)
+        Returns:
+            A dictionary with the state of every job ID, or None for
+            jobs with no state yet.
+        """
+        if refresh or self._next_update() <= 0:
+            self.update()
+        return(dict(self.states))
+    
+    def _next_update(self):
+        if self._last_update is None:
+            return(0)
+        return(self._last_update + self._delay - time.monotonic())
+    
+    def update(self):
+        """Queries the scheduler for the jobs that are not done
+        
+        Returns:
+            A list with the IDs of the jobs whose state changed.
+        """
+        ids = self.pending()
+        new = {}
+        if ids and self.scheduler == 'slurm':
+            new, res = self._query(['squeue', '-h', '-o', '%i %T', '-j', ','.join(ids)])
+            # squeue fails when none of the jobs is known anymore, and
+            # then sacct is asked about all of them. After any other
+            # failure, jobs that sacct does not know keep their state.
+            infer = new is not None or bool(_SLURM_MISSING_RE.search(res.stderr or ''))
+            new = new or {}
+            missing = [job_id for job_id in ids if job_id not in new]
+            if missing:
+                done, res = self._query(['sacct', '-n', '-X', '-P', '-o', 'JobID,State',
+                                         '-j', ','.join(missing)], separator = '|')
+                for job_id in missing:
+                    if done is not None and job_id in done:
+                        new[job_id] = done[job_id]
+                    elif done is not None and infer:
+                        new[job_id] = 'UNKNOWN'
+        elif ids:
+            new, res = self._query(['qstat'] + ids, pbs = True)
+            new = new or {}
+            # qstat fails when any job is no longer known, and names
+            # those jobs in its errors
+            gone = [line for line in (res.stderr or '').splitlines()
+                    if _PBS_MISSING_RE.search(line)]
+            for job_id in ids:
+                if job_id in new:
+                    continue
+                pattern = re.compile(r'\b{}\b'.format(re.escape(job_id)))
+                if res.ok or any(pattern.search(line) for line in gone):
+                    new[job_id] = 'COMPLETED'
+        
+        changed = [job_id for job_id in new if new[job_id] != self.states[job_id]]
+        self.states.update(new)
+        if changed:
+            self._delay = self.interval
+        else:
+            self._delay = min(self._delay * self.backoff, self.max_interval)
+        self._last_update = time.monotonic()
+        return(changed)
+    
+    def _query(self, command, separator = None, pbs = False):
+        """Runs a scheduler query and returns the state per base job ID
+        
+        Returns:
+            A tuple with a dictionary of states, and the
+            :py:class:`CommandResult` of the query. The dictionary is
+            None if the query failed without reporting any job.
+        """
+        res = _execute(command, capture = True)
+        states = {}
+        for line in (res.stdout or '').splitlines():
+            fields = line.split(separator)
+            if pbs:
+                if len(fields) < 6 or fields[4] not in _PBS_JOB_STATES:
+                    continue
+                job_id, state = fields[0], _PBS_JOB_STATES[fields[4]]
             else:
-                RUNS[sample] = [run]
-                nsamples += 1
-            nruns += 1
-    fh.close()
-    print("\tProcessed {} runs in {} samples".format(nruns,nsamples))
-    print("=============================================")
+                if len(fields) < 2:
+                    continue
+                job_id, state = fields[0], fields[1].split()[0].rstrip('+')
+            job_id = self._base_id(job_id)
+            if job_id not in self.states:
+                continue
+            # A job with any active task is active, and a job with any
+            # failed task failed.
+            old = states.get(job_id)
+            if old is None or state in ACTIVE_JOB_STATES or old == 'COMPLETED':
+                states[job_id] = state
+        if not states and not res.ok:
+            print("\tWARNING: {} failed ({})".format(command[0],
+                                                   res.error or (res.stderr or '').strip()))
+            return((None, res))
+        return((states, res))
+    
+    def as_completed(self, timeout = None):
+        """Waits for jobs and yields them as they finish
+        
+        Args:
+            timeout (float): Maximum seconds to wait. If None, waits
+                until all jobs are done.
+        
+        Yields:
+            Tuples with the ID and final state of every job.
+        
+        Raises:
+            TimeoutError: If jobs are still active after *timeout*.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        reported = set()
+        while True:
+            for job_id, state in self.status().items():
+                if (job_id not in reported and state is not None and
+                        state not in ACTIVE_JOB_STATES):
+                    reported.add(job_id)
+                    yield((job_id, state))
+            if not self.pending():
+                return
+            wait = self._next_update()
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError("Jobs still active: {}".format(self.pending()))
+                wait = min(wait, deadline - time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+    
+    def wait_all(self, timeout = None):
+        """Waits until all jobs are done
+        
+        Args:
+            timeout (float): Maximum seconds to wait. If None, waits
+                until all jobs are done.
+        
+        Returns:
+            A dictionary with the final state of every job.
+        
+        Raises:
+            TimeoutError: If jobs are still active after *timeout*.
+        """
+        for job in self.as_completed(timeout):
+            pass
+        return(dict(self.states))
 
-    return(RUNS)
+def _write_array_job(tasks, arraydir, name, write_submission, task_var,
+                     throttle = None, **options):
+    """Writes the task table and script of an array job
+    
+    Every task becomes one line of the table <arraydir>/<name>.tasks.
+    The script <arraydir>/<name>.sh, written with *write_submission*,
+    reads the line whose number is the array index and runs it, and
+    exits with the status of the task.
+    
+    Args:
+        tasks (list): Each element is either the name of a script, which
+            is run with bash, or a list of commands, which are run in
+            order and stop at the first failure.
+        arraydir (str): Directory for the table and the script.
+        name (str): Job name and prefix of the files.
+        write_submission: :py:func:`write_slurm_submission` or
+            :py:func:`write_qsub_submission`.
+        task_var (str): Shell expression with the array index.
+        throttle (int): Maximum number of tasks running at once.
+        **options: Passed to *write_submission*.
+    
+    Returns:
+        A tuple with the name of the script and the array range, e.g.
+        '1-100%10'.
+    """
+    
+    if not tasks:
+        raise ValueError("No tasks to submit")
+    if not os.path.isdir(arraydir):
+        os.makedirs(arraydir)
+    
+    table = os.path.abspath(os.path.join(arraydir, name + ".tasks"))
+    lines = []
+    for task in tasks:
+        if isinstance(task, str):
+            line = "bash " + shlex.quote(os.path.abspath(task))
+        else:
+            line = " && ".join(task)
+        if "\n" in line:
+            raise ValueError("Commands in an array task cannot have newlines")
+        lines.append(line + "\n")
+    _atomic_write(table, ["".join(lines).encode()])
+    
+    commands = ['TASK=$(sed -n "{}p" {})'.format(task_var, shlex.quote(table)),
+                'echo "Array task {}: $TASK"'.format(task_var),
+                'eval "$TASK"; rc=$?',
+                # The job exits with the status of the task after the
+                # lines that the template adds at the end of the script
+                "trap 'exit $rc' EXIT"]
+    script = os.path.join(arraydir, name + ".sh")
+    with open(script, 'w') as fh:
+        write_submission(fh, commands, name = name, **options)
+    
+    spec = "1-{}".format(len(tasks))
+    if throttle is not None:
+        spec += "%{}".format(throttle)
+    return((script, spec))
 
-def qsub_submissions(submissions,logdir):
+def qsub_submissions(submissions,logdir, array = False, throttle = None,
+                     arraydir = None, name = "array", local = False,
+                     **options):
     """Submits to PBS via qsub
     
     Takes a list of file names of PBS submission files, and sends
-    them to qsub.
+    them to qsub. In array mode, all of them are submitted as the
+    tasks of a single array job (qsub -t), with one call to qsub.
     
     Args:
-        submissions: List of file paths to submit to qsub.
+        submissions: List of file paths to submit to qsub. In array
+            mode, elements can also be lists of commands, which are
+            run in order within one task, stopping at the first
+            failure.
         logdir: A directory path that is checked for existence before
             submitting the jobs. If it does not exists it is created.
+        array (bool): Whether to submit an array job.
+        throttle (int): Maximum number of array tasks running at once.
+        arraydir (str): Directory to write the table of tasks and the
+            array job script. Defaults to *logdir*.
+        name (str): Name of the array job and prefix of its files.
+        local (bool): Whether to run the scripts on this machine with
+            :py:func:`run_submissions_locally` instead of submitting
+            them. Cannot be combined with *array*.
+        **options: Options of :py:func:`write_qsub_submission` for the
+            array job script, e.g. *memory* or *nodes*.
             
     Returns:
-        Nothing
+        A list with the IDs of the submitted jobs, as printed by
+        qsub. Use :py:class:`JobTracker` to wait for them. In local
+        mode, the list is empty.
     """
     
     if os.path.exists(logdir):
@@ -146,16 +2021,153 @@ def qsub_submissions(submissions,logdir):
     else:
         os.mkdir(logdir)
     
+    job_ids = []
+    if local:
+        if array:
+            raise ValueError("Array jobs cannot be run locally")
+        run_submissions_locally(submissions)
+        submissions = []
+    
+    if array:
+        options.setdefault('logfile', logdir)
+        options.setdefault('errorfile', logdir)
+        script, spec = _write_array_job(submissions, arraydir or logdir, name,
+                                        write_qsub_submission,
+                                        "${PBS_ARRAYID:-$PBS_ARRAY_INDEX}",
+                                        throttle, **options)
+        check = run_command("qsub -t " + spec + " " + script, capture = True)
+        job_ids.extend(parse_job_ids(check.stdout))
+        submissions = []
+    
     for file in submissions:
-        run_command("qsub " + file)
+        check = run_command("qsub " + file, capture = True)
+        job_ids.extend(parse_job_ids(check.stdout))
         
     print("==========SUBMISSIONS DONE==========\n\n")
+    return(job_ids)
+    
+class RemovalStats(object):
+    """Counts of what :py:func:`remove_tree` removed
+    
+    Attributes:
+        ndirs (int): Number of directories, including the top one.
+        nfiles (int): Number of files, symbolic links and other
+            non-directories.
+        nbytes (int): Total size of the files.
+        seconds (float): Wall-clock time spent.
+    """
+    
+    def __init__(self, ndirs = 0, nfiles = 0, nbytes = 0, seconds = 0.0):
+        self.ndirs = ndirs
+        self.nfiles = nfiles
+        self.nbytes = nbytes
+        self.seconds = seconds
+    
+    def __iadd__(self, other):
+        self.ndirs += other.ndirs
+        self.nfiles += other.nfiles
+        self.nbytes += other.nbytes
+        self.seconds += other.seconds
+        return(self)
+    
+    def __repr__(self):
+        return("RemovalStats(ndirs={}, nfiles={}, nbytes={}, "
+               "seconds={:.3f})".format(self.ndirs, self.nfiles, self.nbytes,
+                                        self.seconds))
+
+def _scan_and_unlink(path, dry_run):
+    """Removes the non-directory entries of a directory
+    
+    Returns:
+        A tuple with the list of subdirectories, and the number and
+        total size of the entries removed.
+    """
+    subdirs = []
+    nfiles = 0
+    nbytes = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks = False):
+                    subdirs.append(entry.path)
+                    continue
+                size = entry.stat(follow_symlinks = False).st_size
+                if not dry_run:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                continue
+            nfiles += 1
+            nbytes += size
+    return((subdirs, nfiles, nbytes))
+
+def remove_tree(path, threads = REMOVE_THREADS, dry_run = False,
+                executor = None):
+    """Removes a directory and everything in it
+    
+    Like :py:func:`shutil.rmtree`, but directories are listed with
+    :py:func:`os.scandir` and emptied in parallel by a pool of threads,
+    each thread deleting the files of one directory at a time. Once all
+    files are gone, directories are removed from the deepest level up,
+    also in parallel. Symbolic links are removed, not followed, and
+    that includes *path* itself: if it is a link to a directory, only
+    the link is removed.
     
-def return_column(infile,col = 1, separator = '\t', header = True):
+    Args:
+        path (str): Directory to remove.
+        threads (int): Number of threads.
+        dry_run (bool): If True, nothing is removed, and the returned
+            counts are those of what would be removed.
+        executor: A :py:class:`concurrent.futures.ThreadPoolExecutor`
+            to use instead of creating one with *threads*.
+    
+    Returns:
+        A :py:class:`RemovalStats`.
+    """
+    
+    if executor is None:
+        with ThreadPoolExecutor(threads) as executor:
+            return(remove_tree(path, dry_run = dry_run, executor = executor))
+    
+    start = time.perf_counter()
+    res = RemovalStats()
+    if os.path.islink(path):
+        res.nfiles = 1
+        res.nbytes = os.lstat(path).st_size
+        if not dry_run:
+            os.unlink(path)
+        res.seconds = time.perf_counter() - start
+        return(res)
+    
+    levels = [[path]]
+    futures = {executor.submit(_scan_and_unlink, path, dry_run): 0}
+    while futures:
+        done, not_done = wait(futures, return_when = FIRST_COMPLETED)
+        for future in done:
+            depth = futures.pop(future)
+            subdirs, nfiles, nbytes = future.result()
+            res.nfiles += nfiles
+            res.nbytes += nbytes
+            if subdirs and len(levels) == depth + 1:
+                levels.append([])
+            for subdir in subdirs:
+                levels[depth + 1].append(subdir)
+                futures[executor.submit(_scan_and_unlink, subdir, dry_run)] = depth + 1
+    
+    for level in reversed(levels):
+        res.ndirs += len(level)
+        if not dry_run:
+            list(executor.map(os.rmdir, level))
+    res.seconds = time.perf_counter() - start
+    
+    return(res)
+
+def return_column(infile,col = 1, separator = '\t', header = True,
+                  generator = False, cache = None, cache_max_bytes = None):
     """Returns the values in the column of a file
     
     Takes a file name and returns a list with the values in the
-    specified column of that file.
+    specified column of that file. The file is read in blocks, as
+    in :py:func:`iter_columns`.
     
     Args:
         infile: File name with the table.
@@ -166,30 +2178,298 @@ def return_column(infile,col = 1, separator = '\t', header = True):
         header: Logical indicating whether the table has a first row
             of headers. If true, the first row is skipped and the
             value in that row is not included in the returned lis.
+        generator: If True, returns a generator of the values instead
+            of a list, and nothing is printed.
+        cache: If True, the column is stored in a binary file named
+            *infile*.col<col>.cache the first time, and later calls
+            memory-map that file instead of parsing the table, as
+            long as the size and modification time of *infile* do not
+            change. It can also be the name of a directory where the
+            cache files are kept. If None or False, no cache is used.
+            Cache files are replaced atomically, so many processes can
+            use the same cache at once.
+        cache_max_bytes (int): When *cache* is a directory, least
+            recently used cache files in it are removed until they
+            take at most this many bytes. If None, nothing is removed.
     
     Returns:
         A list with the elements in the specified column.
     """
     
+    if cache:
+        blocks = [[_cached_column(infile, col, separator, header, cache,
+                                  cache_max_bytes)]]
+    else:
+        blocks = _column_blocks(infile, [col - 1], separator, header)
+    if generator:
+        return(value for block in blocks for value in block[0])
+    
     print("\n=============================================")
-    col -= 1
-    with open(infile,'r') as fh:
-        print("\tReading table file {}".format(infile))
-        reader = csv.reader(fh,delimiter = separator)
-        if header:
-            header = next(reader)
-        
-        res = []
-        i = 0
-        for row in reader:
-            res.append(row[col])
-            i += 1
-    fh.close()
-    print("\tProcessed {} lines".format(str(i)))
+    print("\tReading table file {}".format(infile))
+    res = []
+    for block in blocks:
+        res.extend(block[0])
+    print("\tProcessed {} lines".format(str(len(res))))
+    print("=============================================")
+    return(res)
+
+def return_columns(infile, cols, separator = '\t', header = True):
+    """Returns the values in several columns of a file
+    
+    Like :py:func:`return_column` but for several columns, which are
+    all read in a single pass over the file.
+    
+    Args:
+        infile: File name with the table.
+        cols: List of column numbers to return. Must be 1-indexed
+            integers.
+        separator: String that separates columns in the file.
+        header: Logical indicating whether the table has a first row
+            of headers, which is skipped.
+    
+    Returns:
+        A list with one list of values per column in *cols*.
+    """
+    
+    print("\n=============================================")
+    print("\tReading table file {}".format(infile))
+    res = [[] for col in cols]
+    for block in _column_blocks(infile, [col - 1 for col in cols],
+                                separator, header):
+        for values, block_values in zip(res, block):
+            values.extend(block_values)
+    print("\tProcessed {} lines".format(str(len(res[0]))))
     print("=============================================")
     return(res)
     
-def run_command(command):
+class CommandResult(object):
+    """Result of a command run by :py:func:`run_commands`
+    
+    Resource usage comes from :py:func:`os.wait4` and is None on
+    platforms without it, or when the command could not be started.
+    
+    Attributes:
+        args: The command, as passed.
+        returncode (int): Exit status of the command, or None if it
+            did not finish, e.g. because it timed out or could not be
+            started.
+        stdout (str): Captured STDOUT, or None if it was not captured.
+        stderr (str): Captured STDERR, or None if it was not captured.
+        seconds (float): Wall-clock time the command took.
+        error (Exception): The exception that stopped the command from
+            finishing (:py:class:`subprocess.TimeoutExpired` or
+            :py:class:`OSError`, including :py:class:`ChildProcessError`
+            if the command was reaped elsewhere), or None.
+        user_seconds (float): CPU time in user mode.
+        system_seconds (float): CPU time in kernel mode.
+        max_rss_kb (int): Peak resident set size in KiB.
+        read_bytes (int): Bytes read from block devices.
+        write_bytes (int): Bytes written to block devices.
+        start (float): Time the command started, in seconds since the
+            epoch.
+    """
+    
+    def __init__(self, args, returncode, stdout = None, stderr = None,
+                 seconds = 0.0, error = None, rusage = None, start = None):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+        self.error = error
+        self.start = start
+        self.user_seconds = None
+        self.system_seconds = None
+        self.max_rss_kb = None
+        self.read_bytes = None
+        self.write_bytes = None
+        if rusage is not None:
+            self.user_seconds = rusage.ru_utime
+            self.system_seconds = rusage.ru_stime
+            self.max_rss_kb = rusage.ru_maxrss
+            if sys.platform == 'darwin':
+                # Reported in bytes instead of KiB
+                self.max_rss_kb //= 1024
+            # Block I/O is counted in 512-byte units
+            self.read_bytes = rusage.ru_inblock * 512
+            self.write_bytes = rusage.ru_oublock * 512
+    
+    @property
+    def ok(self):
+        """Whether the command finished with status 0"""
+        return(self.error is None and self.returncode == 0)
+    
+    def to_record(self):
+        """Returns a dictionary with the command and its resource usage"""
+        return({'command': self.args,
+                'start': self.start,
+                'wall_seconds': self.seconds,
+                'user_seconds': self.user_seconds,
+                'system_seconds': self.system_seconds,
+                'max_rss_kb': self.max_rss_kb,
+                'read_bytes': self.read_bytes,
+                'write_bytes': self.write_bytes,
+                'returncode': self.returncode,
+                'error': None if self.error is None else repr(self.error)})
+    
+    def __repr__(self):
+        return("CommandResult(args={!r}, returncode={}, seconds={:.3f}, "
+               "error={!r})".format(self.args, self.returncode, self.seconds,
+                                    self.error))
+
+_trace_file = None
+_trace_lock = threading.Lock()
+
+def set_trace(path):
+    """Records every command run by :py:func:`run_command` and
+    :py:func:`run_commands` in a JSONL file
+    
+    Every command is appended to the file as one JSON object per line,
+    with the fields of :py:meth:`CommandResult.to_record`. The trace can
+    also be enabled by setting the environment variable
+    SUTILSPY_TRACE to the name of the file, which is used when no file
+    was set with this function.
+    
+    Args:
+        path (str): Name of the trace file, or None to go back to using
+            the environment variable.
+    
+    Returns:
+        Nothing
+    """
+    global _trace_file
+    _trace_file = path
+
+def _trace(result):
+    path = _trace_file or os.environ.get(TRACE_ENV)
+    if not path:
+        return
+    line = json.dumps(result.to_record(), default = str) + "\n"
+    with _trace_lock:
+        with open(path, 'a') as fh:
+            fh.write(line)
+
+def _read_pipe(pipe, output, name):
+    """Reads a pipe of a child until it is closed"""
+    with pipe:
+        output[name] = pipe.read()
+
+def _kill_child(proc):
+    """Kills a child that was not reaped yet
+    
+    Unlike :py:meth:`subprocess.Popen.kill`, never reaps the child, so
+    its resource usage can still be read by :py:func:`os.wait4`.
+    """
+    try:
+        os.kill(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def _wait_rusage(proc, timeout = None):
+    """Reaps a child with :py:func:`os.wait4`
+    
+    The child is killed if it does not finish in *timeout* seconds.
+    On platforms without :py:func:`os.wait4`, waits with
+    :py:meth:`subprocess.Popen.wait` and there is no resource usage.
+    
+    Returns:
+        A tuple with the exit status of the child (negative for a
+        signal, or None if it did not finish), its resource usage (or
+        None), and the exception that stopped it from finishing (or
+        None).
+    """
+    if not hasattr(os, 'wait4'):
+        try:
+            return((proc.wait(timeout), None, None))
+        except subprocess.TimeoutExpired as error:
+            proc.kill()
+            proc.wait()
+            return((None, None, error))
+    
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = 0.0005
+    error = None
+    try:
+        while True:
+            if deadline is None or error is not None:
+                pid, status, rusage = os.wait4(proc.pid, 0)
+                break
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                _kill_child(proc)
+                error = subprocess.TimeoutExpired(proc.args, timeout)
+                continue
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+    except ChildProcessError as wait_error:
+        # Reaped somewhere else, e.g. by a SIGCHLD handler, so the exit
+        # status and resource usage are lost
+        return((None, None, error or wait_error))
+    
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return((None if error else proc.returncode, rusage, error))
+
+def _execute(command, timeout = None, capture = False, cwd = None,
+             stdout = None, stderr = None, env = None):
+    """Runs one command and returns a :py:class:`CommandResult`
+    
+    Strings are run through the shell, and lists are run directly as
+    an argv. Timeouts and commands that cannot be started are
+    recorded in the result instead of raised. The result is added to
+    the trace set by :py:func:`set_trace`. When not capturing, output
+    goes to the *stdout* and *stderr* file handles, or to the ones of
+    this process if they are None.
+    """
+    
+    if capture:
+        stdout = stderr = subprocess.PIPE
+    start = time.time()
+    clock = time.perf_counter()
+    try:
+        proc = subprocess.Popen(command, shell = isinstance(command, str),
+                                stdout = stdout, stderr = stderr, cwd = cwd,
+                                env = env, universal_newlines = capture)
+    except OSError as error:
+        result = CommandResult(command, None, seconds = time.perf_counter() - clock,
+                               error = error, start = start)
+        _trace(result)
+        return(result)
+    
+    readers = []
+    output = {}
+    for name, pipe in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+        if pipe is not None:
+            reader = threading.Thread(target = _read_pipe,
+                                      args = (pipe, output, name), daemon = True)
+            reader.start()
+            readers.append(reader)
+    try:
+        returncode, rusage, error = _wait_rusage(proc, timeout)
+    except BaseException:
+        _kill_child(proc)
+        proc.wait()
+        raise
+    finally:
+        for reader in readers:
+            reader.join()
+    stdout = output.get('stdout')
+    stderr = output.get('stderr')
+    if isinstance(error, subprocess.TimeoutExpired):
+        error.stdout = stdout
+        error.stderr = stderr
+    
+    result = CommandResult(command, returncode, stdout, stderr,
+                           time.perf_counter() - clock, error, rusage, start)
+    _trace(result)
+    return(result)
+
+def run_command(command, capture = False):
     """Makes a system call
     
     Takes a command and runs it via subprocess. It also
@@ -197,32 +2477,253 @@ def run_command(command):
     Useful wrapper for scripts that generate many system calls.
     
     Args:
-        command: A string with the command to be executed
+        command: A string with the command to be executed through
+            the shell, or a list with the program and its arguments
+            to execute it directly.
+        capture (bool): Whether to also keep the output of the command
+            in the *stdout* and *stderr* attributes of the result. It
+            is printed either way.
         
     Returns:
-        The result from :py:func:`subprocess.run`
+        A :py:class:`subprocess.CompletedProcess`, like
+        :py:func:`subprocess.run`. Its resource usage is added to the
+        trace set by :py:func:`set_trace`.
     """
     status = 0;
     print("Executing:\n>{}".format(command))
-    status = subprocess.run(command, shell = True)
+    result = _execute(command, capture = capture)
+    if result.error is not None:
+        raise result.error
+    if capture:
+        sys.stdout.write(result.stdout)
+        sys.stderr.write(result.stderr)
+    status = subprocess.CompletedProcess(command, result.returncode,
+                                         result.stdout, result.stderr)
     print("Status={}\n\n".format(status));
 
     return(status)
 
+def run_commands(commands, max_workers = None, timeout = None, capture = False,
+                 cwd = None, verbose = True):
+    """Makes many system calls in parallel
+    
+    Takes a list of commands and runs up to *max_workers* of them at
+    the same time. Every command runs to the end, or to its timeout,
+    regardless of the others failing, and failures are reported in the
+    results rather than raised.
+    
+    Args:
+        commands (list): Commands to execute. Each one is either a string,
+            which is executed through the shell, or a list with the
+            program and its arguments, which is executed directly.
+        max_workers (int): Maximum number of commands running at once.
+            If None, uses the number of CPUs.
+        timeout (float): Seconds after which a command is killed. If
+            None, commands can run for any time.
+        capture (bool): Whether to capture the STDOUT and STDERR of the
+            commands into the results. If False, the output of the
+            commands goes to the STDOUT and STDERR of this process.
+        cwd (str): Working directory for the commands.
+        verbose (bool): Whether to print the commands and a summary of
+            the results to STDOUT.
+    
+    Returns:
+        A list of :py:class:`CommandResult`, in the same order as
+        *commands*, with the resource usage of every command. They are
+        also added to the trace set by :py:func:`set_trace`.
+    """
+    
+    commands = list(commands)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if verbose:
+        print("Executing {} commands, up to {} at a time".format(len(commands),
+                                                                max_workers))
+    
+    def execute(command):
+        if verbose:
+            print(">{}".format(command))
+        return(_execute(command, timeout = timeout, capture = capture,
+                        cwd = cwd))
+    
+    if not commands:
+        return([])
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = list(executor.map(execute, commands))
+    
+    if verbose:
+        failed = [res for res in results if not res.ok]
+        for res in failed:
+            print("\tFAILED: {} (status={}, error={})".format(res.args,
+                                                              res.returncode,
+                                                              res.error))
+        print("Executed {} commands, {} failed\n\n".format(len(results),
+                                                           len(failed)))
+    
+    return(results)
+
+def _run_local_job(file, options, job_id):
+    """Runs one submission script with bash, as the scheduler would"""
+    
+    name = options['name'] or os.path.basename(file)
+    workdir = options['workdir'] or os.getcwd()
+    scheduler = options['scheduler']
+    if scheduler == 'pbs':
+        env = {'PBS_JOBID': job_id, 'PBS_JOBNAME': name,
+               'PBS_O_WORKDIR': workdir, 'PBS_NUM_PPN': str(options['cpus']),
+               'PBS_ENVIRONMENT': 'PBS_BATCH'}
+        default_output = "{}.o{}".format(name, job_id)
+        default_error = "{}.e{}".format(name, job_id)
+    else:
+        env = {'SLURM_JOB_ID': job_id, 'SLURM_JOB_NAME': name,
+               'SLURM_SUBMIT_DIR': workdir,
+               'SLURM_CPUS_PER_TASK': str(options['cpus'])}
+        default_output = "slurm-{}.out".format(job_id)
+        default_error = None
+    env = dict(os.environ, **env)
+    
+    def log_path(path, default):
+        if path is None:
+            path = default
+        if path is None:
+            return(None)
+        path = path.replace('%j', job_id).replace('%x', name)
+        path = path.replace('%A', job_id).replace('%a', '0')
+        path = os.path.join(workdir, path)
+        if os.path.isdir(path):
+            # PBS accepts a directory for the logs
+            path = os.path.join(path, os.path.basename(default))
+        return(path)
+    
+    output = log_path(options['output'], default_output)
+    error = log_path(options['error'], default_error)
+    try:
+        out_fh = open(output, 'w')
+        err_fh = open(error, 'w') if error is not None else subprocess.STDOUT
+    except OSError as err:
+        return(CommandResult(['bash', file], None, error = err))
+    try:
+        return(_execute(['bash', os.path.abspath(file)], cwd = workdir,
+                        stdout = out_fh, stderr = err_fh, env = env))
+    finally:
+        out_fh.close()
+        if error is not None:
+            err_fh.close()
+
+def _total_memory():
+    """Returns the physical memory of this machine in MB, or None"""
+    try:
+        return(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 2)
+    except (AttributeError, ValueError, OSError):
+        return(None)
+
+def run_submissions_locally(submissions, max_cpus = None, max_memory = None,
+                            verbose = True):
+    """Runs SLURM or PBS submission scripts on this machine
+    
+    Takes a list of submission scripts, reads their options with
+    :py:func:`parse_submission`, and runs them with bash in parallel,
+    without going through a scheduler. Jobs start in order as long as
+    the CPUs and memory they declare are free, and later jobs that fit
+    start while earlier ones wait for resources. Jobs that declare more
+    than the limits run when nothing else is running. Each job runs in
+    its declared working directory, writes to its declared log and
+    error files ('%j' becomes a local job number) and sees the usual
+    scheduler environment variables, like SLURM_JOB_ID or PBS_JOBID.
+    
+    Args:
+        submissions (list): File names of the submission scripts.
+        max_cpus (int): CPUs available for jobs. If None, uses the
+            number of CPUs of the machine.
+        max_memory (float): MB of memory available for jobs. If None,
+            uses the physical memory of the machine.
+        verbose (bool): Whether to print when jobs start and finish.
+    
+    Returns:
+        A list of :py:class:`CommandResult`, in the same order as
+        *submissions*.
+    """
+    
+    if max_cpus is None:
+        max_cpus = os.cpu_count() or 1
+    if max_memory is None:
+        max_memory = _total_memory() or float('inf')
+    jobs = [parse_submission(file) for file in submissions]
+    results = [None] * len(jobs)
+    free = {'cpus': max_cpus, 'memory': max_memory}
+    condition = threading.Condition()
+    
+    def run(i, cpus, memory):
+        try:
+            results[i] = _run_local_job(submissions[i], jobs[i], str(i + 1))
+        finally:
+            with condition:
+                free['cpus'] += cpus
+                free['memory'] += memory
+                condition.notify_all()
+        if verbose:
+            print("\tFinished job {} ({}): status={}".format(i + 1,
+                                                             submissions[i],
+                                                             results[i].returncode))
+    
+    threads = []
+    pending = list(range(len(jobs)))
+    with condition:
+        while pending:
+            for i in list(pending):
+                cpus = min(jobs[i]['cpus'], max_cpus)
+                memory = min(jobs[i]['memory'], max_memory)
+                if cpus > free['cpus'] or memory > free['memory']:
+                    continue
+                free['cpus'] -= cpus
+                free['memory'] -= memory
+                pending.remove(i)
+                if verbose:
+                    print("\tStarting job {} ({})".format(i + 1, submissions[i]))
+                thread = threading.Thread(target = run, args = (i, cpus, memory))
+                thread.start()
+                threads.append(thread)
+            if pending:
+                condition.wait()
+    for thread in threads:
+        thread.join()
+    
+    if verbose:
+        print("==========LOCAL JOBS DONE==========\n\n")
+    return(results)
 
-def sbatch_submissions(submissions,logdir):
+def sbatch_submissions(submissions,logdir, array = False, throttle = None,
+                       arraydir = None, name = "array", local = False,
+                       **options):
     """Submits to SLURM via sbatch
     
     Takes a list of file names of SLURM submission files, and sends
-    them to sbatch.
+    them to sbatch. In array mode, all of them are submitted as the
+    tasks of a single array job (sbatch --array), with one call to
+    sbatch.
     
     Args:
-        submissions: List of file paths to submit to sbatch.
+        submissions: List of file paths to submit to sbatch. In array
+            mode, elements can also be lists of commands, which are
+            run in order within one task, stopping at the first
+            failure.
         logdir: A directory path that is checked for existence before
             submitting the jobs. If it does not exists it is created.
+        array (bool): Whether to submit an array job.
+        throttle (int): Maximum number of array tasks running at once.
+        arraydir (str): Directory to write the table of tasks and the
+            array job script. Defaults to *logdir*.
+        name (str): Name of the array job and prefix of its files.
+        local (bool): Whether to run the scripts on this machine with
+            :py:func:`run_submissions_locally` instead of submitting
+            them. Cannot be combined with *array*.
+        **options: Options of :py:func:`write_slurm_submission` for the
+            array job script, e.g. *memory*, *cpus* or *time*.
             
     Returns:
-        Nothing
+        A list with the IDs of the submitted jobs, as printed by
+        sbatch. Use :py:class:`JobTracker` to wait for them. In local
+        mode, the list is empty.
     """
     
     if os.path.exists(logdir):
@@ -230,31 +2731,306 @@ def sbatch_submissions(submissions,logdir):
     else:
         os.mkdir(logdir)
     
+    job_ids = []
+    if local:
+        if array:
+            raise ValueError("Array jobs cannot be run locally")
+        run_submissions_locally(submissions)
+        submissions = []
+    
+    if array:
+        options.setdefault('logfile', os.path.join(logdir, name + ".%A_%a.log"))
+        options.setdefault('errorfile', os.path.join(logdir, name + ".%A_%a.err"))
+        script, spec = _write_array_job(submissions, arraydir or logdir, name,
+                                        write_slurm_submission,
+                                        "${SLURM_ARRAY_TASK_ID}",
+                                        throttle, **options)
+        check = run_command("sbatch --array=" + spec + " " + script,
+                            capture = True)
+        job_ids.extend(parse_job_ids(check.stdout))
+        submissions = []
+    
     for file in submissions:
-        run_command("sbatch " + file)
+        check = run_command("sbatch " + file, capture = True)
+        job_ids.extend(parse_job_ids(check.stdout))
         
     print("==========SUBMISSIONS DONE==========\n\n")
+    return(job_ids)
 
-def write_download(download,outfile):
+def write_download(download, outfile, checksum = 'md5',
+                   chunk_size = DOWNLOAD_CHUNK_SIZE):
     """Writes the result of :py:func:`requests.get` to a file
     
-    Takes an object with a *text* attribute, such as the one
-    produced by :py:func:`requests.get`, and writes it to a
-    file.
+    Streams the body of a response in chunks into *outfile* plus
+    PART_SUFFIX, and renames it to *outfile* when complete, so memory use does not
+    depend on the size of the download and binary data is written
+    as is. Use ``stream=True`` in :py:func:`requests.get` to avoid
+    holding the whole body in memory.
     
     Args:
-        download (str): Object with *text* attribute
+        download: Object with an *iter_content* method, such as the
+            one produced by :py:func:`requests.get`, a file-like object
+            with a *read* method, or an object with a *text* attribute.
         outfile (str): Name of the file to create and write. It
             will overwrite any existing file with that name
+        checksum (str): Name of a :py:mod:`hashlib` algorithm computed
+            while writing, or None.
+        chunk_size (int): Bytes read per chunk.
     
     Returns:
-        Nothing
+        A :py:class:`DownloadResult`.
     """
     
-    with open(outfile,'w') as out_fh:
-        out_fh.write(download.text)
-    out_fh.close()
+    start = time.perf_counter()
+    hasher = hashlib.new(checksum) if checksum is not None else None
+    part = outfile + PART_SUFFIX
+    try:
+        with open(part, 'wb') as out_fh:
+            nbytes = _write_chunks(_response_chunks(download, chunk_size),
+                                   out_fh, hasher)
+        os.replace(part, outfile)
+    except BaseException:
+        if os.path.exists(part):
+            os.unlink(part)
+        raise
+    
+    return(DownloadResult(outfile, nbytes,
+                          hasher.hexdigest() if hasher is not None else None,
+                          time.perf_counter() - start,
+                          url = getattr(download, 'url', None)))
+    
+# Lines of the scripts written by write_qsub_submission. Writing some
+# useful information. Based on suggestions at
+# http://qcd.phys.cmu.edu/QCDcluster/pbs/run_serial.html
+_PBS_LINES = ("#!/bin/bash\n",
+              "#PBS -N  {name}\n",
+              "#PBS -d {dir}\n",
+              "#PBS -o {logfile}\n",
+              "#PBS -e {errorfile}\n",
+              "#PBS -l mem={memory}\n",
+              "#PBS -m {mail}\n",
+              "#PBS -l {nodes}\n",
+              "#PBS -q {queue}\n",
+              "#PBS -M {email}\n",
+              "#PBS -l {loptions}\n",
+              "echo ------------------------------------------------------\n"
+              "echo ------------------------------------------------------\n"
+              "echo PBS: qsub is running on $PBS_O_HOST\n"
+              "echo PBS: originating queue is $PBS_O_QUEUE\n"
+              "echo PBS: executing queue is $PBS_QUEUE\n"
+              "echo PBS: working directory is $PBS_O_WORKDIR\n"
+              "echo PBS: execution mode is $PBS_ENVIRONMENT\n"
+              "echo PBS: job identifier is $PBS_JOBID\n"
+              "echo PBS: job name is $PBS_JOBNAME\n"
+              "echo PBS: node file is $PBS_NODEFILE\n"
+              "echo PBS: current home directory is $PBS_O_HOME\n"
+              "echo PBS: PATH = $PBS_O_PATH\n"
+              "echo ------------------------------------------------------\n"
+              "date\n",
+              "{commands}\n",
+              "echo ------------------------------------------------------\n"
+              "date\n")
+_PBS_DEFAULTS = {'name': "Job", 'memory': "1000mb", 'logfile': "log",
+                 'errorfile': "error", 'loptions': [], 'mail': "n",
+                 'nodes': "nodes=1:ppn=1"}
+
+# Lines of the scripts written by write_slurm_submission
+_SLURM_LINES = ("#!/bin/bash\n",
+                "#SBATCH --job-name={name}\n",
+                "#SBATCH --workdir={dir}\n",
+                "#SBATCH --output={logfile}\n",
+                "#SBATCH --error={errorfile}\n",
+                "#SBATCH --time={time}\n",
+                "#SBATCH --nodes={nodes}\n",
+                "#SBATCH -c {cpus}\n",
+                "#SBATCH --mem={memory}\n",
+                "#SBATCH --mail-type={mail}\n",
+                "#SBATCH -p {queue}\n",
+                "#SBATCH ---mail-user={email}\n",
+                "echo ------------------------------------------------------\n",
+                "echo SLURM: Job name is {name}\n",
+                "echo ------------------------------------------------------\n"
+                "echo SLURM: sbatch is running on $SLURM_SUBMIT_HOST\n"
+                "echo SLURM: executing queue is $SLURM_JOB_PARTITION\n"
+                "echo SLURM: job identifier is $SLURM_JOB_ID\n"
+                "echo SLURM: job name is $SLURM_JOB_NAME\n"
+                "echo ------------------------------------------------------\n"
+                "date\n",
+                "{commands}\n",
+                "echo ------------------------------------------------------\n"
+                "date\n"
+                "echo ------------------------------------------------------\n"
+                "sstat --format JobID,NTasks,MaxRSS,MaxVMsize,AveRSS,AveVMSize -j $SLURM_JOB_ID")
+_SLURM_DEFAULTS = {'name': "Job", 'memory': "10G", 'logfile': "%j.log",
+                   'errorfile': "%j.err", 'mail': "NONE", 'nodes': "1",
+                   'cpus': "1", 'time': '2:00:00'}
+
+def _render_line(line, fields, values):
+    """Renders one template line
     
+    The line is omitted if any of its fields is None, and repeated
+    once per element if a field is a list.
+    """
+    values = {field: values.get(field) for field in fields}
+    if any(value is None for value in values.values()):
+        return("")
+    for field in fields:
+        if isinstance(values[field], (list, tuple)):
+            return("".join(line.format(**dict(values, **{field: item}))
+                           for item in values[field]))
+    return(line.format(**values))
+
+class SubmissionTemplate(object):
+    """Precompiled submission script
+    
+    A template is a sequence of lines with :py:meth:`str.format` fields.
+    Lines whose fields are all given when the template is created are
+    rendered once, and every consecutive run of them is stored as a
+    single string, so rendering a script only formats the lines that
+    change between scripts. Use :py:meth:`pbs` and :py:meth:`slurm` for
+    the scripts of :py:func:`write_qsub_submission` and
+    :py:func:`write_slurm_submission`.
+    
+    When rendering, a line is omitted if any of its fields is None or
+    missing, and repeated once per element if a field is a list. The
+    *commands* field holds the list of commands of the script.
+    
+    Args:
+        lines: Sequence of lines with named fields.
+        defaults (dict): Values of the fields not given to the
+            constructor or to :py:meth:`render`.
+        **options: Values of the fields that are the same in every
+            script.
+    """
+    
+    def __init__(self, lines, defaults = None, **options):
+        self.defaults = dict(defaults) if defaults is not None else {}
+        self.options = options
+        self._parts = []
+        formatter = string.Formatter()
+        constant = []
+        for line in lines:
+            fields = [field for _, field, _, _ in formatter.parse(line)
+                      if field is not None]
+            if all(field in options for field in fields):
+                constant.append(_render_line(line, fields, options))
+                continue
+            if constant:
+                self._parts.append("".join(constant))
+                constant = []
+            self._parts.append((line, fields))
+        if constant:
+            self._parts.append("".join(constant))
+    
+    @classmethod
+    def pbs(cls, **options):
+        """Template of the scripts of :py:func:`write_qsub_submission`"""
+        return(cls(_PBS_LINES, dict(_PBS_DEFAULTS, dir = os.getcwd()),
+                   **options))
+    
+    @classmethod
+    def slurm(cls, **options):
+        """Template of the scripts of :py:func:`write_slurm_submission`"""
+        return(cls(_SLURM_LINES, dict(_SLURM_DEFAULTS, dir = os.getcwd()),
+                   **options))
+    
+    def render(self, commands = (), **options):
+        """Returns the text of a script
+        
+        Args:
+            commands (list): Commands of the script.
+            **options: Values of the fields not given to the
+                constructor. Fields given to the constructor
+                cannot be changed.
+        """
+        values = dict(self.defaults)
+        values.update(options)
+        values['commands'] = list(commands)
+        return("".join(part if isinstance(part, str)
+                       else _render_line(part[0], part[1], values)
+                       for part in self._parts))
+    
+    def write(self, fh, commands = (), **options):
+        """Renders a script and writes it to a file handle in one call"""
+        fh.write(self.render(commands, **options))
+    
+    def write_batch(self, jobs, outdir, manifest = "manifest.tsv",
+                    launcher = None, submit = "qsub", archive = None,
+                    mode = 0o744):
+        """Writes many scripts
+        
+        Every script is rendered into a single buffer and written with
+        a single call. The scripts can be written as individual files
+        or into one uncompressed tar archive, which avoids creating
+        thousands of files on network filesystems.
+        
+        Args:
+            jobs: Iterable of (name, commands) or (name, commands, options)
+                tuples, where name is the file name of the script, and
+                options a dictionary of values for :py:meth:`render`.
+            outdir (str): Directory where scripts are written, or
+                extracted to from the archive.
+            manifest (str): Name of a file in *outdir* listing the name
+                and path of every script, separated by tabs. None for no
+                manifest.
+            launcher (str): Name of an executable script in *outdir*
+                that calls *submit* on every script, extracting the
+                archive first if needed. None for no launcher.
+            submit (str): Command used by the launcher on every script.
+            archive (str): Path of a tar archive where all scripts are
+                written instead of *outdir*.
+            mode (int): Permissions of the scripts.
+        
+        Returns:
+            List of script paths in *outdir*.
+        """
+        os.makedirs(outdir, exist_ok = True)
+        tar = tarfile.open(archive, 'w') if archive is not None else None
+        names = []
+        paths = []
+        try:
+            for job in jobs:
+                name, commands = job[0], job[1]
+                options = job[2] if len(job) > 2 else {}
+                data = self.render(commands, **options).encode()
+                path = os.path.join(outdir, name)
+                if tar is None:
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+                    try:
+                        _write_all(fd, data)
+                        os.fchmod(fd, mode)
+                    finally:
+                        os.close(fd)
+                else:
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mode = mode
+                    info.mtime = time.time()
+                    tar.addfile(info, BytesIO(data))
+                names.append(name)
+                paths.append(path)
+        finally:
+            if tar is not None:
+                tar.close()
+        
+        if manifest is not None:
+            with open(os.path.join(outdir, manifest), 'w') as fh:
+                fh.write("".join("{}\t{}\n".format(name, path)
+                                 for name, path in zip(names, paths)))
+        if launcher is not None:
+            lines = ["#!/bin/bash\n"]
+            if archive is not None:
+                lines.append("tar -xf {} -C {}\n".format(shlex.quote(archive),
+                                                         shlex.quote(outdir)))
+            lines.extend("{} {}\n".format(submit, shlex.quote(path))
+                         for path in paths)
+            launcher = os.path.join(outdir, launcher)
+            with open(launcher, 'w') as fh:
+                fh.write("".join(lines))
+            os.chmod(launcher, 0o744)
+        
+        return(paths)
+
 def write_qsub_submission(fh, commands, dir = os.getcwd(),
                           name = "Job", memory = "1000mb",
                           logfile = "log", errorfile = "error",
@@ -265,7 +3041,7 @@ def write_qsub_submission(fh, commands, dir = os.getcwd(),
     
     Takes a filehandle and a list of commands, and writes to it
     a series of PBS submission instructions, followed by the commands
-    passed. A breif decription of the supportd qsub options is below.
+    passed, with a single write. A breif decription of the supportd qsub options is below.
     See the qsub documentation for more details.
     
     Args:
@@ -292,50 +3068,10 @@ def write_qsub_submission(fh, commands, dir = os.getcwd(),
     
     """
     
-    
-    # Writing options
-    fh.write("#!/bin/bash\n")
-    fh.write("#PBS -N  " + name + "\n")
-    fh.write("#PBS -d " + dir + "\n")
-    fh.write("#PBS -o " + logfile + "\n")
-    fh.write("#PBS -e " + errorfile + "\n")
-    fh.write("#PBS -l mem=" + memory + "\n")
-    fh.write("#PBS -m " + mail + "\n")
-    fh.write("#PBS -l " + nodes + "\n")
-    
-    if queue is not None:
-        fh.write("#PBS -q " + queue + "\n")
-    if email is not None:
-        fh.write("#PBS -M " + email + "\n")
-    
-    # Adding l options like cput, walltime,
-    for opt in loptions:
-        fh.write("#PBS -l " + opt + "\n")
-        
-    # Writing some useful information. Based
-    # on suggestions at
-    # http://qcd.phys.cmu.edu/QCDcluster/pbs/run_serial.html
-    fh.write("echo ------------------------------------------------------\n")
-    #fh.write("echo -n 'Job is running on node '; cat $PBS_NODEFILE\n")
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("echo PBS: qsub is running on $PBS_O_HOST\n")
-    fh.write("echo PBS: originating queue is $PBS_O_QUEUE\n")
-    fh.write("echo PBS: executing queue is $PBS_QUEUE\n")
-    fh.write("echo PBS: working directory is $PBS_O_WORKDIR\n")
-    fh.write("echo PBS: execution mode is $PBS_ENVIRONMENT\n")
-    fh.write("echo PBS: job identifier is $PBS_JOBID\n")
-    fh.write("echo PBS: job name is $PBS_JOBNAME\n")
-    fh.write("echo PBS: node file is $PBS_NODEFILE\n")
-    fh.write("echo PBS: current home directory is $PBS_O_HOME\n")
-    fh.write("echo PBS: PATH = $PBS_O_PATH\n")
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("date\n")
-    
-    for cmd in commands:
-        fh.write(cmd + "\n")
-    
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("date\n")
+    SubmissionTemplate.pbs(dir = dir, name = name, memory = memory,
+                           logfile = logfile, errorfile = errorfile,
+                           loptions = loptions, queue = queue, mail = mail,
+                           email = email, nodes = nodes).write(fh, commands)
     
 def write_slurm_submission(fh, commands, dir = os.getcwd(),
                            name = "Job", memory = "10G",
@@ -347,7 +3083,8 @@ def write_slurm_submission(fh, commands, dir = os.getcwd(),
     Writes a SLURM submission bash file.
     
     Takes a filehandle and a list of commands, and writes a file that
-    can be subitted to SLURM via the sbatch command. A brief description
+    can be subitted to SLURM via the sbatch command, with a single
+    write. A brief description
     of the supportted SLURMoptions is below.
     See the sbatch documentation for more details.
     
@@ -379,91 +3116,160 @@ def write_slurm_submission(fh, commands, dir = os.getcwd(),
     
     """
     
-    ## SLURM
-    # Writing options
-    fh.write("#!/bin/bash\n")
-    fh.write("#SBATCH --job-name=" + name + "\n")
-    fh.write("#SBATCH --workdir=" + dir + "\n")
-    fh.write("#SBATCH --output=" + logfile + "\n")
-    fh.write("#SBATCH --error=" + errorfile + "\n")
-    fh.write("#SBATCH --time=" + time + "\n")
-    fh.write("#SBATCH --nodes=" + nodes + "\n")
-    fh.write("#SBATCH -c " + cpus + "\n")
-    fh.write("#SBATCH --mem=" + memory + "\n")    
-    fh.write("#SBATCH --mail-type=" + mail + "\n")
-
-    if queue is not None:
-        fh.write("#SBATCH -p " + queue + "\n")
-    if email is not None:
-        fh.write("#SBATCH ---mail-user=" + email + "\n")
-        
-    # Writing some useful information. Based
-    # on suggestions at
-    # http://qcd.phys.cmu.edu/QCDcluster/pbs/run_serial.html
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("echo SLURM: Job name is {}\n".format(name))
-    #fh.write("echo -n 'Job is running on node '; cat $SLURM_JOB_NODELIST\n")
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("echo SLURM: sbatch is running on $SLURM_SUBMIT_HOST\n")
-    fh.write("echo SLURM: executing queue is $SLURM_JOB_PARTITION\n")
-    #fh.write("echo SLURM: working directory is $PBS_O_WORKDIR\n")
-    #fh.write("echo SLURM: execution mode is $PBS_ENVIRONMENT\n")
-    fh.write("echo SLURM: job identifier is $SLURM_JOB_ID\n")
-    fh.write("echo SLURM: job name is $SLURM_JOB_NAME\n")
-    #fh.write("echo SLURM: node file is $PBS_NODEFILE\n")
-    #fh.write("echo SLURM: current home directory is $PBS_O_HOME\n")
-    #fh.write("echo SLURM: PATH = $PBS_O_PATH\n")
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("date\n")
-    
-    for cmd in commands:
-        fh.write(cmd + "\n")
-    
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("date\n")
-    fh.write("echo ------------------------------------------------------\n")
-    fh.write("sstat --format JobID,NTasks,MaxRSS,MaxVMsize,AveRSS,AveVMSize -j $SLURM_JOB_ID")
-    
-    
-
-def write_table(outfile,rows, header = None, delimiter = "\t", verbose = False):
+    SubmissionTemplate.slurm(dir = dir, name = name, memory = memory,
+                             logfile = logfile, errorfile = errorfile,
+                             queue = queue, mail = mail, email = email,
+                             nodes = nodes, cpus = cpus,
+                             time = time).write(fh, commands)
+    
+
+class _BackgroundWriter(object):
+    """Writes to a file handle from a separate thread
+    
+    Calls to :py:meth:`write` only queue the data, so the caller can keep
+    producing while the thread waits on the disk. At most *max_pending*
+    writes are queued. Errors in the thread are raised by the next call
+    to :py:meth:`write` or :py:meth:`close`.
+    """
+    
+    def __init__(self, fh, max_pending = 4):
+        self._fh = fh
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is None:
+                try:
+                    self._fh.write(data)
+                except BaseException as error:
+                    self._error = error
+    
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(data)
+    
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+def _format_rows(rows, delimiter):
+    """Formats a list of rows with :py:func:`csv.writer` into a string"""
+    buffer = StringIO()
+    csv.writer(buffer, delimiter = delimiter).writerows(rows)
+    return(buffer.getvalue())
+
+def _table_chunks(rows, delimiter, chunk_size, fmt):
+    """Formats a table in chunks of rows
+    
+    Yields:
+        Tuples with the text of a chunk and its number of rows.
+    """
+    
+    lineterminator = csv.excel.lineterminator
+    if hasattr(rows, 'iloc') and hasattr(rows, 'to_csv'):
+        kinds = set([dtype.kind for dtype in rows.dtypes])
+        if len(kinds) == 1 and kinds.pop() in 'biuf':
+            # Numeric DataFrames with a single type of column are
+            # formatted faster as arrays.
+            for chunk in _table_chunks(rows.to_numpy(), delimiter,
+                                       chunk_size, fmt):
+                yield(chunk)
+            return
+        # Other DataFrames are formatted by pandas' own writer
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows.iloc[start:start + chunk_size]
+            try:
+                text = chunk.to_csv(sep = delimiter, header = False, index = False,
+                                    lineterminator = lineterminator)
+            except TypeError:
+                text = chunk.to_csv(sep = delimiter, header = False, index = False,
+                                    line_terminator = lineterminator)
+            yield((text, len(chunk)))
+    elif getattr(rows, 'ndim', None) == 2 and hasattr(rows, 'dtype'):
+        # NumPy 2-D array. Numbers are formatted a whole chunk at a time
+        # with a single string formatting operation.
+        numeric = rows.dtype.kind in 'biuf'
+        row_fmt = (delimiter.replace('%', '%%').join([fmt] * rows.shape[1]) +
+                   lineterminator.replace('%', '%%'))
+        for start in range(0, rows.shape[0], chunk_size):
+            chunk = rows[start:start + chunk_size]
+            if numeric:
+                text = (row_fmt * len(chunk)) % tuple(chunk.ravel().tolist())
+            else:
+                text = _format_rows(chunk.tolist(), delimiter)
+            yield((text, len(chunk)))
+    else:
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield((_format_rows(chunk, delimiter), len(chunk)))
+
+def write_table(outfile,rows, header = None, delimiter = "\t", verbose = False,
+                chunk_size = TABLE_CHUNK_ROWS, background = False, fmt = '%s'):
     """Writes a table
     
     Takes a file name and a list of rows, and writes a file in table format.
-    It will overwrite any existing file with that  name.
+    It will overwrite any existing file with that  name. Rows are formatted
+    in chunks, and every chunk is written to a large file buffer with a
+    single call.
     
     Args:
         outfile (str): Name of file to be created, and overwritten if necessary,
             where the table will be printed
-        rows (list): List where each element is a list corresponding to the fields
-            on each row
+        rows: List, or any iterable, where each element is a list
+            corresponding to the fields on each row. It can also be a
+            2-D NumPy array or a pandas DataFrame, whose index is not
+            written.
         header (list): A list with header names. If it is not None it will be printed
-            before *row*.
+            before *row*. If True and *rows* is a DataFrame, its column
+            names are used.
         delimiter (str): A string indicating the delimiter to use to separate fields
             in the table.
         verbose (bool): Boolean indicating whether to print informational messages
             to STDOUT.
+        chunk_size (int): Number of rows formatted at a time.
+        background (bool): Whether to write to disk from a separate
+            thread, so formatting (or a generator producing *rows*)
+            does not wait for the disk.
+        fmt (str): printf-style format used for every value of numeric
+            NumPy arrays.
     
     Returns:
         The number of lines printed
     """
     
-    with open(outfile,'w') as out_fh:
-        writer = csv.writer(out_fh,delimiter = '\t')
-        if verbose:
-            print("\tWriting {}".format(outfile))
-            
-        nlines = 0
-        if header is not None:
-            writer.writerow(header)
-            nlines += 1
-        for row in rows:
-            writer.writerow(row)
-            nlines += 1
-    out_fh.close()
+    if header is True:
+        header = [str(name) for name in rows.columns]
+    if verbose:
+        print("\tWriting {}".format(outfile))
+    
+    nlines = 0
+    with open(outfile, 'w', newline = '',
+              buffering = TABLE_BUFFER_SIZE) as out_fh:
+        sink = _BackgroundWriter(out_fh) if background else out_fh
+        try:
+            if header is not None:
+                sink.write(_format_rows([header], delimiter))
+                nlines += 1
+            for text, n in _table_chunks(rows, delimiter, chunk_size, fmt):
+                sink.write(text)
+                nlines += n
+        finally:
+            if background:
+                sink.close()
 
     if verbose:
         print("\t\tWrote {} lines".format(nlines))
     
     return(nlines)
-                
\ No newline at end of file
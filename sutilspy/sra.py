@@ -1,100 +1,607 @@
 #!/usr/bin/env python
 # Copyright (C) 2017 Sur Herrera Paredes
 
-def check_set_of_runs(runs, dir):
+import collections.abc
+import csv
+import glob
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+from math import ceil
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from sutilspy.io import (BZ2BlockWriter, DownloadResult, SubmissionTemplate,
+                         bzip2_files, concatenate_files, run_command,
+                         run_commands, write_table, _atomic_write, _hash_file,
+                         _join_blob, _lpt_partition, _read_sidecar,
+                         _split_blob, _write_sidecar)
+from sutilspy.all import IntegrityError, MissingFileError, ProcessError
+
+# Name of the file, in the directory of the .sra files, that records
+# which files passed vdb-validate
+VALIDATION_CACHE = ".vdb_validate.json"
+_validation_cache_lock = threading.Lock()
+
+# Aspera key and location of the .sra files of every run
+ASCP_KEY = '/godot/hmp/aspera/asperaweb_id_dsa.openssh'
+SRA_PREFIX = 'anonftp@ftp.ncbi.nlm.nih.gov:/sra/sra-instant/reads/ByRun/sra/SRR/'
+# Suffixes of the files ascp keeps while a transfer is incomplete
+ASCP_PARTIAL_SUFFIXES = ('.aspx', '.partial')
+
+# Column of EBI reports with the sample title, and pattern of the
+# subject IDs in it
+EBI_TITLE_COL = 22
+_SUBJECT_RE = re.compile(r'containing sample (\d+) from participant (\d+)')
+# Rows of an EBI report read at once by iter_ebi_metadata
+EBI_CHUNK_ROWS = 100000
+
+# Bytes of FASTQ read at once from fastq-dump in streaming mode
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
+def _read_validation_cache(path):
+    """Returns the entries of a validation cache, or {} if it is unreadable"""
+    try:
+        with open(path, 'r') as fh:
+            return(json.load(fh)['runs'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return({})
+
+def check_set_of_runs(runs, dir, workers = 1, cache = None, checksum = None):
+    """Validates the .sra files of a set of runs with vdb-validate
+
+    Runs are validated in parallel. With a validation cache, files that
+    passed are recorded with their size and modification time, and are
+    not validated again while those do not change. If the cache cannot
+    be written, a warning is printed and the results are still returned.
+
+    Args:
+        runs (list): Run IDs. Each must have a <run>.sra file in *dir*.
+        dir (str): Directory with the .sra files.
+        workers (int): Number of files validated at the same time.
+        cache: True to use VALIDATION_CACHE in *dir*, the path of the
+            cache file, or None (default) to validate every file.
+        checksum (str): Name of a :py:mod:`hashlib` algorithm. If given
+            with *cache*, the hash of every file is also recorded and
+            compared, which reads every file but is still much faster
+            than vdb-validate. Ignored without *cache*.
+
+    Returns:
+        A list of :py:class:`sutilspy.io.CommandResult`, one per file
+        that was validated.
+
+    Raises:
+        MissingFileError: If the .sra file of any run does not exist.
+        IntegrityError: If any file does not pass the validation. Files
+            that passed are still recorded in the cache.
+    """
     print("\t Checking runs..,")
+    if cache is True:
+        cache = os.path.join(dir, VALIDATION_CACHE)
+    
+    entries = {}
     for run in runs:
-        run_sra = dir + "/" + run + ".sra"
-        check = 0
-        if os.path.exists(run_sra):
-            command = 'vdb-validate ' + run_sra
-            check = download_runs.run_command(command)
-            #check = subprocess.run('vdb-validate ' + run_sra + " &", shell = True)
-            if check.returncode != 0:
-                raise IntegrityError("\rRun {} did not pass the validation".format(run))
-        else:
-            raise MissingFileError("\tRun {} file does not exist in {}".format(run,outdir))
-        
-    return(check)
+        run_sra = os.path.abspath(dir + "/" + run + ".sra")
+        if not os.path.exists(run_sra):
+            raise MissingFileError("\tRun {} file does not exist in {}".format(run,dir))
+        info = os.stat(run_sra)
+        entry = {'size': info.st_size, 'mtime_ns': info.st_mtime_ns}
+        if cache and checksum is not None:
+            hasher = hashlib.new(checksum)
+            with open(run_sra, 'rb') as fh:
+                _hash_file(fh, hasher)
+            entry[checksum] = hasher.hexdigest()
+        entries[run] = (run_sra, entry)
+    
+    cached = _read_validation_cache(cache) if cache else {}
+    pending = [run for run in runs
+               if any(cached.get(entries[run][0], {}).get(key) != value
+                      for key, value in entries[run][1].items())]
+    if len(pending) < len(runs):
+        print("\t\t{} run(s) already validated".format(len(runs) - len(pending)))
+    
+    results = run_commands([['vdb-validate', entries[run][0]] for run in pending],
+                           max_workers = workers)
+    passed = [run for run, res in zip(pending, results) if res.ok]
+    if cache and passed:
+        # Merge with entries written by others since reading
+        with _validation_cache_lock:
+            cached = _read_validation_cache(cache)
+            for run in passed:
+                cached[entries[run][0]] = entries[run][1]
+            try:
+                _atomic_write(cache, [json.dumps({'version': 1, 'runs': cached},
+                                                 indent = 1).encode()])
+            except OSError as error:
+                print("\tWARNING: Could not write validation cache {} ({})".format(cache, error))
+    
+    failed = [run for run, res in zip(pending, results) if not res.ok]
+    if failed:
+        raise IntegrityError("\rRun(s) {} did not pass the validation".format(", ".join(failed)))
+    
+    return(results)
+
+def fastq_dump_runs(runs,indir,outdir,keep, compress = True, workers = 1):
+    """Runs fastq-dump on a set of runs
+
+    Args:
+        runs (list): Run IDs. Each must have a <run>.sra file in *indir*.
+        indir (str): Directory with the .sra files.
+        outdir (str): Directory to write the FASTQ files. It is created
+            if it does not exist.
+        keep: Ignored.
+        compress (bool): Whether to make fastq-dump write bz2 files. Use
+            False when the files will be compressed later, e.g. by
+            :py:func:`concatenate_run` with several processes.
+        workers (int): Number of runs dumped at the same time.
 
-def fastq_dump_runs(runs,indir,outdir,keep):
+    Returns:
+        A list of two lists, with the read 1 and read 2 files of every run,
+        in the same order as *runs*.
+    
+    Raises:
+        MissingFileError: If the .sra file of any run does not exist.
+            Nothing is dumped in that case.
+        ProcessError: If fastq-dump fails for any run. The files of the
+            failed runs are removed, and the other runs are dumped anyway.
+    """
     if not os.path.isdir(indir):
         raise FileNotFoundError("Input directory {} does not exist".format(indir))
     if not os.path.isdir(outdir):
         print("\tCreating output directory {}".format(outdir))
-        os.mkdir(outdir)
+        os.makedirs(outdir, exist_ok = True)
         
-    FILES = [[], []]
+    if compress:
+        options = ['--split-files', '--bzip2']
+        extension = ".fastq.bz2"
+    else:
+        options = ['--split-files']
+        extension = ".fastq"
+    
+    commands = []
     for run in runs:
         run_sra = indir + "/" + run + ".sra"
-        
-        if os.path.exists(run_sra):
-            command = 'fastq-dump -I -O ' + outdir + ' --split-files --bzip2 ' + run_sra
-            check = download_runs.run_command(command)
-            #check = subprocess.run('fastq-dump -O ' + outdir + ' --split-files ' + run_sra + " &", shell = True)
-            if check.returncode != 0:
-                raise ProcessError("\tRun {} could not be processed by fastq-dump".format(run))
-            else:
-                read1 = outdir + "/" + run + "_1.fastq.bz2"                
-                FILES[0].append(read1)
-                read2 = outdir + "/" + run + "_2.fastq.bz2"                
-                FILES[1].append(read2)
-        else:
-            raise MissingFileError("\tRun {} file does not exist in {}".format(run,outdir))
+        if not os.path.exists(run_sra):
+            raise MissingFileError("\tRun {} file does not exist in {}".format(run,indir))
+        commands.append(['fastq-dump', '-I', '-O', outdir] + options + [run_sra])
+    
+    results = run_commands(commands, max_workers = workers)
+    failed = [run for run, res in zip(runs, results) if not res.ok]
+    if failed:
+        # Remove the partial output of failed runs
+        for run in failed:
+            partial = glob.glob(glob.escape(outdir + "/" + run) + "_*" + extension)
+            partial.append(outdir + "/" + run + extension)
+            for file in partial:
+                if os.path.exists(file):
+                    os.remove(file)
+        raise ProcessError("\tRun(s) {} could not be processed by fastq-dump".format(", ".join(failed)))
+    
+    FILES = [[], []]
+    for run in runs:
+        read1 = outdir + "/" + run + "_1" + extension
+        FILES[0].append(read1)
+        read2 = outdir + "/" + run + "_2" + extension
+        FILES[1].append(read2)
         
     return(FILES)
 
-def concatenate_run(file_sets,outdir,name_prefix, extension = ".fastq"):
+def concatenate_run(file_sets,outdir,name_prefix, extension = ".fastq",
+                    processes = None):
+    """Concatenates the files of every read into one file per read
+
+    Args:
+        file_sets (list): A list of lists of files, one list per read.
+        outdir (str): Directory to write the concatenated files.
+        name_prefix (str): Prefix of the output files, which are named
+            <name_prefix>_read<i><extension>.
+        extension (str): Extension of the output files.
+        processes (int): If not None and *extension* ends in '.bz2',
+            the files are compressed with that many processes by
+            :py:func:`sutilspy.io.bzip2_files`. Inputs that are already
+            bz2 files are appended as they are.
+
+    Returns:
+        A list with the concatenated files.
+    """
     if not os.path.isdir(outdir):
         print("\tCreating output directory {}".format(outdir))
-        os.mkdir(outdir)
+        os.makedirs(outdir, exist_ok = True)
     
     i = 1
     FILES = []
     for files in file_sets:
         newfile = outdir + "/" + name_prefix + "_read" + str(i) + extension
         try:
-            concatenate_files(files, newfile)
+            if processes is not None and extension.endswith(".bz2"):
+                bzip2_files(files, newfile, processes = processes)
+            else:
+                concatenate_files(files, newfile)
             i += 1
             FILES.append(newfile)
-        except (ProcessError):
+        except (OSError, ProcessError):
             raise ProcessError("Could not concatenate files from read {}".format(i))
     
     return(FILES)
 
-def process_ebi_metadata(infile,accession,accession_col = 4):
-    accession_col -= 1
-    with open(infile,'r') as meta_file:
-        reader = csv.reader(meta_file,delimiter = '\t')
-        header = next(reader)
+def _split_reads(stream, writers, chunk_size = STREAM_CHUNK_SIZE):
+    """Routes the FASTQ records of fastq-dump -I to a writer per read
+    
+    Records are assigned by the read number that -I appends to the
+    read name (e.g. @SRR001.1.2 is read 2). Reads beyond the number
+    of writers are dropped.
+    """
+    suffixes = [".{}".format(i + 1).encode() for i in range(len(writers))]
+    pending = []
+    for lines in iter(lambda: stream.readlines(chunk_size), []):
+        if pending:
+            lines = pending + lines
+        end = len(lines) - len(lines) % 4
+        pending = lines[end:]
+        reads = [[] for writer in writers]
+        for i in range(0, end, 4):
+            name = lines[i].split(None, 1)[0]
+            for read, suffix in zip(reads, suffixes):
+                if name.endswith(suffix):
+                    read.extend(lines[i:i + 4])
+                    break
+        for read, writer in zip(reads, writers):
+            if read:
+                writer.write(b''.join(read))
+    if pending:
+        raise ProcessError("Truncated FASTQ record: {!r}".format(pending[0]))
+
+def stream_runs(runs, indir, outdir, name_prefix, processes = 1):
+    """Dumps a set of runs straight into one compressed file per read
+    
+    Pipes the output of fastq-dump for every run, in order, into a
+    :py:class:`sutilspy.io.BZ2BlockWriter` per read, so no FASTQ file
+    is written per run. The files are the same as those made by
+    :py:func:`fastq_dump_runs` followed by :py:func:`concatenate_run`.
+    
+    Args:
+        runs (list): Run IDs. Each must have a <run>.sra file in *indir*.
+        indir (str): Directory with the .sra files.
+        outdir (str): Directory to write the compressed files.
+        name_prefix (str): Prefix of the output files, which are named
+            <name_prefix>_read<i>.fastq.bz2.
+        processes (int): Number of compression processes, shared by the
+            files of both reads.
+    
+    Returns:
+        A list with the two compressed files, one per read.
+    
+    Raises:
+        MissingFileError: If the .sra file of any run does not exist.
+        ProcessError: If fastq-dump fails for any run. The output
+            files are removed.
+    """
+    if not os.path.isdir(indir):
+        raise FileNotFoundError("Input directory {} does not exist".format(indir))
+    for run in runs:
+        if not os.path.exists(indir + "/" + run + ".sra"):
+            raise MissingFileError("\tRun {} file does not exist in {}".format(run,indir))
+    if not os.path.isdir(outdir):
+        print("\tCreating output directory {}".format(outdir))
+        os.makedirs(outdir, exist_ok = True)
+    
+    FILES = [outdir + "/" + name_prefix + "_read" + str(i) + ".fastq.bz2"
+             for i in (1, 2)]
+    executor = ProcessPoolExecutor(processes) if processes > 1 else None
+    writers = [BZ2BlockWriter(file, processes, executor = executor)
+               for file in FILES]
+    try:
+        for run in runs:
+            command = ['fastq-dump', '--split-spot', '-Z', '-I',
+                       indir + "/" + run + ".sra"]
+            print(">{}".format(" ".join(command)))
+            try:
+                proc = subprocess.Popen(command, stdout = subprocess.PIPE)
+            except OSError as error:
+                raise ProcessError("\tCould not run fastq-dump: {}".format(error))
+            with proc:
+                try:
+                    _split_reads(proc.stdout, writers)
+                finally:
+                    proc.stdout.close()
+                    returncode = proc.wait()
+            if returncode != 0:
+                raise ProcessError("\tRun {} could not be processed by fastq-dump".format(run))
+        for writer in writers:
+            writer.close()
+    except BaseException:
+        # Errors while cleaning up must not hide the original one
+        for writer, file in zip(writers, FILES):
+            try:
+                writer.close()
+            except Exception:
+                pass
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    return(FILES)
+
+def _add_subject_id(row):
+    """Appends the subject ID in the sample title of an EBI report row"""
+    m = _SUBJECT_RE.search(row[EBI_TITLE_COL])
+    if m is not None:
+        row.append(m.group(1))
+    else:
+        row.append('NA')
+    return(row)
+
+def _parse_ebi_line(line):
+    """Parses one line of an EBI report read in binary mode"""
+    return(next(csv.reader([line.decode().rstrip('\r\n')], delimiter = '\t')))
+
+def _ebi_index_sections(index):
+    """Turns a dictionary of row offsets per accession into sidecar sections"""
+    accessions = list(index)
+    bounds = array('Q', [0])
+    offsets = array('Q')
+    for accession in accessions:
+        offsets.extend(index[accession])
+        bounds.append(len(offsets))
+    return([_join_blob(accessions), bounds.tobytes(), offsets.tobytes()])
+
+def _ebi_index_from_sections(sections):
+    """Inverse of :py:func:`_ebi_index_sections`"""
+    accessions = _split_blob(sections[0])
+    bounds = sections[1].cast('Q')
+    offsets = sections[2].cast('Q')
+    return({accession: offsets[bounds[i]:bounds[i + 1]]
+            for i, accession in enumerate(accessions)})
+
+def process_ebi_metadata_batch(infile, accessions, accession_col = 4,
+                               cache = None):
+    """Finds the rows of many accessions in an EBI report
+
+    Reads the report once for all accessions. The subject ID in the
+    sample title of every row is appended as an extra column.
+
+    Args:
+        infile (str): Tab-delimited EBI report with a header.
+        accessions: Iterable of accessions to find.
+        accession_col (int): 1-indexed column with the accessions.
+        cache: If True, the byte offset of the rows of every accession
+            in the report is stored in a binary sidecar named
+            *infile*.ebiidx, and later calls read only the rows they
+            need, as long as the size and modification time of *infile*
+            do not change. It can also be the name of the sidecar to
+            use. If None or False, the whole report is read every time.
+
+    Returns:
+        A tuple with the header, including the subject_id column, and
+        a dictionary with the list of rows of every accession, which is
+        empty for accessions not found.
+    """
+    col = accession_col - 1
+    accessions = list(accessions)
+    res = {accession: [] for accession in accessions}
+    if cache is True:
+        cache = infile + ".ebiidx"
+    key = "EBIIndex:{}:{}".format(col, sys.byteorder)
+    
+    with open(infile, 'rb') as fh:
+        header = _parse_ebi_line(fh.readline())
         header.append('subject_id')
-        print("\tSeaching for accession {} in column {}".format(accession,header[accession_col]))
-        #print(header[accession_col])
-        nruns = 0
-        res = []
-        for row in reader:
-            if row[accession_col] == accession:
-                nruns += 1
-                #print(row[22]) 
-                
-                # Search for subject id
-                title = row[22]
-                m = re.search('containing sample (\d+) from participant (\d+)', title)
-                if m is not None:
-                    #print(m.group(1))
-                    row.append(m.group(1))
-                else:
-                    row.append('NA')
-                
-                res.append(row)
-        meta_file.close()
-    return(header,res,nruns)
-
-def process_sample(sample,runs,indir,fastqdir,outdir,keep = False):
-    
-    # Validate files
+        
+        sections = _read_sidecar(cache, infile, key) if cache else None
+        if sections is not None:
+            index = _ebi_index_from_sections(sections)
+            for accession in accessions:
+                for offset in index.get(accession, ()):
+                    fh.seek(offset)
+                    res[accession].append(_add_subject_id(_parse_ebi_line(fh.readline())))
+            return((header, res))
+        
+        index = {}
+        offset = fh.tell()
+        for line in fh:
+            fields = line.split(b'\t', col + 1)
+            if len(fields) > col:
+                accession = fields[col].rstrip(b'\r\n').decode()
+                if cache:
+                    index.setdefault(accession, array('Q')).append(offset)
+                if accession in res:
+                    res[accession].append(_add_subject_id(_parse_ebi_line(line)))
+            offset += len(line)
+    
+    if cache:
+        _write_sidecar(cache, infile, key, _ebi_index_sections(index))
+    return((header, res))
+
+def _open_report(infile):
+    """Opens a report in binary mode, decompressing it if it is gzipped"""
+    with open(infile, 'rb') as fh:
+        magic = fh.read(2)
+    if magic == b'\x1f\x8b':
+        return(gzip.open(infile, 'rb'))
+    return(open(infile, 'rb'))
+
+def _iter_ebi_chunks_pandas(pandas, infile, wanted, col, chunk_size):
+    """Rows of iter_ebi_metadata, filtered and parsed by pandas"""
+    reader = pandas.read_csv(infile, sep = '\t', dtype = str, header = 0,
+                             na_filter = False, chunksize = chunk_size,
+                             compression = 'infer')
+    for chunk in reader:
+        chunk = chunk[chunk.iloc[:, col].isin(wanted)]
+        if chunk.empty:
+            continue
+        subjects = chunk.iloc[:, EBI_TITLE_COL].str.extract(_SUBJECT_RE,
+                                                            expand = True)[0]
+        rows = chunk.values.tolist()
+        for row, subject in zip(rows, subjects.fillna('NA').tolist()):
+            row.append(subject)
+        yield rows
+
+def _iter_ebi_chunks(fh, wanted, col, chunk_size):
+    """Rows of iter_ebi_metadata, filtered on the raw lines"""
+    wanted = set(accession.encode() for accession in wanted)
+    for lines in iter(lambda: list(itertools.islice(fh, chunk_size)), []):
+        rows = []
+        for line in lines:
+            fields = line.split(b'\t', col + 1)
+            if len(fields) > col and fields[col].rstrip(b'\r\n') in wanted:
+                rows.append(_add_subject_id(_parse_ebi_line(line)))
+        if rows:
+            yield rows
+
+def iter_ebi_metadata(infile, accessions, accession_col = 4,
+                      chunk_size = EBI_CHUNK_ROWS, engine = 'python'):
+    """Streams the rows of many accessions from an EBI report
+
+    Reads the report, plain or gzipped, in chunks of *chunk_size* rows,
+    so memory use does not depend on its size. The 'python' engine
+    splits only the accession column of every line, and parses only
+    matching lines, which is usually fastest since few rows match.
+    The 'pandas' engine parses every chunk with pandas, and filters it
+    and extracts the subject IDs with vectorized operations.
+
+    Args:
+        infile (str): Tab-delimited EBI report with a header.
+        accessions: Iterable of accessions to find.
+        accession_col (int): 1-indexed column with the accessions.
+        chunk_size (int): Number of rows read at a time.
+        engine (str): 'python', 'pandas', or None to use pandas if it
+            is installed.
+
+    Returns:
+        A tuple with the header, including the subject_id column, and
+        a generator of the matching rows, which can be passed to
+        :py:func:`sutilspy.io.write_table`.
+    """
+    col = accession_col - 1
+    wanted = list(accessions)
+    pandas = None
+    if engine in (None, 'pandas'):
+        try:
+            import pandas
+        except ImportError:
+            if engine == 'pandas':
+                raise
+    elif engine != 'python':
+        raise ValueError("Unrecognized engine {}".format(engine))
+    
+    with _open_report(infile) as fh:
+        header = _parse_ebi_line(fh.readline())
+    header.append('subject_id')
+    
+    def rows():
+        if pandas is not None:
+            chunks = _iter_ebi_chunks_pandas(pandas, infile, wanted, col,
+                                             chunk_size)
+            for chunk in chunks:
+                yield from chunk
+            return
+        with _open_report(infile) as fh:
+            fh.readline()
+            for chunk in _iter_ebi_chunks(fh, wanted, col, chunk_size):
+                yield from chunk
+    
+    return((header, rows()))
+
+def filter_ebi_metadata(infile, accessions, outfile, accession_col = 4,
+                        chunk_size = EBI_CHUNK_ROWS, engine = 'python',
+                        background = False):
+    """Writes the rows of many accessions of an EBI report to a table
+
+    Streams the rows found by :py:func:`iter_ebi_metadata` into
+    :py:func:`sutilspy.io.write_table`, with constant memory.
+
+    Args:
+        infile (str): Tab-delimited EBI report with a header, plain or
+            gzipped.
+        accessions: Iterable of accessions to find.
+        outfile (str): Name of the table to create. It will overwrite
+            any existing file with that name.
+        accession_col (int): 1-indexed column with the accessions.
+        chunk_size (int): Number of rows read at a time.
+        engine (str): See :py:func:`iter_ebi_metadata`.
+        background (bool): Whether to write to disk from a separate
+            thread while the report is read.
+
+    Returns:
+        The number of lines written, including the header.
+    """
+    header, rows = iter_ebi_metadata(infile, accessions, accession_col,
+                                     chunk_size, engine)
+    return(write_table(outfile, rows, header = header, background = background))
+
+def process_ebi_metadata(infile,accession,accession_col = 4):
+    """Finds the rows of one accession in an EBI report
+
+    See :py:func:`process_ebi_metadata_batch`, which is much faster
+    than calling this for many accessions.
+
+    Returns:
+        A tuple with the header, the list of rows of the accession,
+        and the number of rows.
+    """
+    header, res = process_ebi_metadata_batch(infile, [accession], accession_col)
+    print("\tSeaching for accession {} in column {}".format(accession,header[accession_col - 1]))
+    res = res[accession]
+    return(header,res,len(res))
+
+def process_sample(sample,runs,indir,fastqdir,outdir,keep = False,
+                   processes = 1, workers = 1, stream = False):
+    """Validates, dumps and concatenates the runs of one sample
+    
+    In streaming mode, the output of fastq-dump for every run is
+    compressed straight into the files of the sample by
+    :py:func:`stream_runs`, without writing a file per run.
+
+    Args:
+        sample (str): Sample ID, used as prefix of the output files.
+        runs (list): Run IDs of the sample.
+        indir (str): Directory with the .sra files.
+        fastqdir (str): Directory for the FASTQ files of every run.
+        outdir (str): Directory for the concatenated files.
+        keep: Passed to :py:func:`fastq_dump_runs`. With more than one
+            of *processes*, also whether to keep the uncompressed files
+            of every run.
+        processes (int): Number of processes to compress the output.
+            With more than one, fastq-dump writes uncompressed files
+            that are compressed in parallel while concatenating, and
+            removed once the sample is concatenated unless *keep* is
+            True.
+        workers (int): Number of runs validated and dumped at the same
+            time by :py:func:`check_set_of_runs` and
+            :py:func:`fastq_dump_runs`.
+        stream (bool): Whether to use the streaming mode. *fastqdir*
+            and *keep* are ignored in this mode.
+
+    Returns:
+        A list with the concatenated .fastq.bz2 files, one per read.
+    """
+    
+    _validate_sample(sample, runs, indir, workers)
+    if stream:
+        return(_stream_sample(sample, runs, indir, outdir, processes))
+    run_fastq = _dump_sample(sample, runs, indir, fastqdir, keep, processes,
+                             workers)
+    concatenated_files = _concatenate_sample(sample, run_fastq, outdir,
+                                             processes, keep)
+    
+    return(concatenated_files)
+
+def _validate_sample(sample, runs, indir, workers):
+    """First stage of :py:func:`process_sample`"""
     try:
-        check_set_of_runs(runs,indir)
+        check_set_of_runs(runs,indir, workers = workers)
     except IntegrityError as error:
         print("\tWARNING: Run(s) in sample {} did not pass integrity check. SKIPPING".format(sample))
         raise ProcessError("\tSample didn't pass check")
@@ -102,9 +609,14 @@ def process_sample(sample,runs,indir,fastqdir,outdir,keep = False):
         print("\tWARNING: Missing file(s) for run(s) in sample {}. SKIPPING".format(sample))
         raise ProcessError("\tSample didn't pass check")    
     
-    # Proceed to fastq-dump
+    return(runs)
+
+def _dump_sample(sample, runs, indir, fastqdir, keep, processes, workers):
+    """Second stage of :py:func:`process_sample`"""
     try:
-        run_fastq = fastq_dump_runs(runs,indir,fastqdir,keep)
+        run_fastq = fastq_dump_runs(runs,indir,fastqdir,keep,
+                                    compress = processes <= 1,
+                                    workers = workers)
     except FileNotFoundError as error:
         print("\tERROR: Input directory {} does not exist. TERMINATING".format(indir))
         raise FileNotFoundError("Input directory {} does not exist".format(indir))
@@ -115,59 +627,346 @@ def process_sample(sample,runs,indir,fastqdir,outdir,keep = False):
         print("\tWARNING:Run(s) file(s) for sample {} missing".format(sample))
         raise ProcessError("Run(s) file(s) for sample {} missing".format(sample))
     
-    # Proceed to concatenate
+    return(run_fastq)
+
+def _concatenate_sample(sample, run_fastq, outdir, processes, keep = False):
+    """Third stage of :py:func:`process_sample`"""
     try:
-        concatenated_files = concatenate_run(run_fastq, outdir, sample, ".fastq.bz2")
+        concatenated_files = concatenate_run(run_fastq, outdir, sample, ".fastq.bz2",
+                                             processes = processes if processes > 1 else None)
     except ProcessError as error:
         print("\tWARNING. Could not concatenate files from sample {}. SKIPPING")
         raise ProcessError("Could not concatenate files from sample {}".format(sample))
     
+    if processes > 1 and not keep:
+        # Uncompressed files of every run, now in the concatenated files
+        for files in run_fastq:
+            for file in files:
+                os.remove(file)
+    
     return(concatenated_files)
 
+def _stream_sample(sample, runs, indir, outdir, processes):
+    """Streaming replacement of the second and third stages"""
+    try:
+        return(stream_runs(runs, indir, outdir, sample, processes = processes))
+    except FileNotFoundError as error:
+        print("\tERROR: Input directory {} does not exist. TERMINATING".format(indir))
+        raise FileNotFoundError("Input directory {} does not exist".format(indir))
+    except (ProcessError, MissingFileError) as error:
+        print("\tWARNING: Run(s) in sample {} could not be processed by fastq-dump. SKIPPING".format(sample))
+        raise ProcessError("\tSample could not be processed  with fastq-dump")
+
+def _run_stage(function, inbox, outbox, results, failed, errors, stop):
+    """Worker of a stage of :py:func:`_pipeline`"""
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        name, value = item
+        if stop.is_set():
+            continue
+        try:
+            value = function(name, value)
+        except ProcessError as error:
+            failed[name] = error
+            continue
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+            continue
+        if outbox is None:
+            results[name] = value
+        else:
+            outbox.put((name, value))
+
+def _pipeline(items, stages, queue_size):
+    """Passes (name, value) items through a series of stages
+    
+    Every stage is a (function, nworkers) tuple, where function takes a
+    name and a value and returns the value for the next stage. Stages
+    are connected by queues of at most *queue_size* items, so every
+    stage works on different items at the same time. Items whose
+    function raises :py:class:`ProcessError` are dropped and recorded.
+    Any other exception stops the pipeline and is raised.
+    
+    Returns:
+        A tuple with a dictionary of the values returned by the last
+        stage, and a dictionary with the :py:class:`ProcessError` of
+        every failed item.
+    """
+    results = {}
+    failed = {}
+    errors = []
+    stop = threading.Event()
+    inboxes = [queue.Queue(queue_size) for stage in stages]
+    outboxes = inboxes[1:] + [None]
+    threads = []
+    for (function, nworkers), inbox, outbox in zip(stages, inboxes, outboxes):
+        threads.append([threading.Thread(target = _run_stage,
+                                         args = (function, inbox, outbox,
+                                                 results, failed, errors, stop))
+                        for i in range(nworkers)])
+        for thread in threads[-1]:
+            thread.start()
+    
+    try:
+        for item in items:
+            if stop.is_set():
+                break
+            inboxes[0].put(item)
+    finally:
+        # Close every stage once the previous one is done
+        for workers, inbox in zip(threads, inboxes):
+            for thread in workers:
+                inbox.put(None)
+            for thread in workers:
+                thread.join()
+    
+    if errors:
+        raise errors[0]
+    return((results, failed))
+
+def process_samples(samples, indir, fastqdir, outdir, keep = False,
+                    processes = 1, workers = 1, validate_workers = 1,
+                    dump_workers = 1, concatenate_workers = 1,
+                    queue_size = 2, stream = False):
+    """Processes many samples with overlapping stages
+    
+    Runs the validation, fastq-dump and concatenation stages of
+    :py:func:`process_sample` as a pipeline, so one sample can be
+    concatenated while the next one is dumped and another one is
+    validated. Each stage has its own pool of workers, and samples
+    wait between stages in queues of at most *queue_size* samples.
+    Samples that fail are recorded and skipped without stopping the
+    pipeline.
+    
+    Args:
+        samples: Dictionary of run IDs per sample, such as the one
+            returned by :py:func:`sutilspy.io.process_run_list`, or an
+            iterable of (sample, runs) tuples.
+        indir (str): Directory with the .sra files.
+        fastqdir (str): Directory for the FASTQ files of every run.
+        outdir (str): Directory for the concatenated files.
+        keep: See :py:func:`process_sample`.
+        processes (int): Number of processes to compress the output of
+            every sample. See :py:func:`process_sample`.
+        workers (int): Number of runs of a sample validated and dumped
+            at the same time.
+        validate_workers (int): Number of samples validated at once.
+        dump_workers (int): Number of samples dumped at once.
+        concatenate_workers (int): Number of samples concatenated at once.
+        queue_size (int): Maximum number of samples waiting for a stage.
+        stream (bool): Whether to use the streaming mode of
+            :py:func:`process_sample`, where *dump_workers* samples
+            are dumped and compressed at once, and there is no
+            concatenation stage.
+    
+    Returns:
+        A tuple with a dictionary of the concatenated files of every
+        sample that was processed, in the same order as *samples*,
+        and a dictionary with the :py:class:`ProcessError` of every
+        sample that failed.
+    
+    Raises:
+        Any exception other than :py:class:`ProcessError` raised while
+        processing a sample, after stopping the pipeline.
+    """
+    
+    if isinstance(samples, collections.abc.Mapping):
+        samples = samples.items()
+    samples = [(sample, list(runs)) for sample, runs in samples]
+    print("\n=============================================")
+    print("== Processing {} samples".format(len(samples)))
+    stages = [(lambda sample, runs: _validate_sample(sample, runs, indir, workers),
+               validate_workers),
+              (lambda sample, runs: _dump_sample(sample, runs, indir, fastqdir,
+                                                 keep, processes, workers),
+               dump_workers),
+              (lambda sample, run_fastq: _concatenate_sample(sample, run_fastq,
+                                                             outdir, processes,
+                                                             keep),
+               concatenate_workers)]
+    if stream:
+        stages[1:] = [(lambda sample, runs: _stream_sample(sample, runs, indir,
+                                                           outdir, processes),
+                       dump_workers)]
+    results, failed = _pipeline(samples, stages, queue_size)
+    results = {sample: results[sample] for sample, runs in samples
+               if sample in results}
+    
+    print("\tProcessed {} samples, {} failed".format(len(results), len(failed)))
+    for sample in failed:
+        print("\tFAILED: {}".format(sample))
+    print("=============================================")
+    return((results, failed))
+
+# Script of every download submission
+_DOWNLOAD_TEMPLATE = SubmissionTemplate(("#!/bin/bash\n",
+                                         "#PBS -N download.{name}\n",
+                                         "#PBS -d {outdir}\n",
+                                         "#PBS -o {logdir}/download.{name}.log\n",
+                                         "#PBS -e {logdir}/download.{name}.err\n",
+                                         "#PBS -l mem=1000mb\n",
+                                         "{commands}\n"))
+
 def create_single_submission(name, group,submission_dir,outdir,logdir):
     submission_file = submission_dir + "/" + name
+    
+    # Add lines for every run in sample
+    ascp_command = 'ascp -i ' + ASCP_KEY + ' -k 1 -T -l200m'
+    commands = []
+    for run in group:
+        commands.append(" ".join([ascp_command, _sra_location(run), outdir]))
     with open(submission_file,'w') as fh:
-        fh.write("#!/bin/bash\n")
-        fh.write("#PBS -N download." + name + "\n")
-        fh.write("#PBS -d " + outdir + "\n")
-        fh.write("#PBS -o " + logdir + "/download." + name + ".log\n")
-        fh.write("#PBS -e " + logdir + "/download." + name + ".err\n")
-        fh.write("#PBS -l mem=1000mb\n")
-        
-        # Add lines for every run in sample
-        ascp_command = 'ascp -i /godot/hmp/aspera/asperaweb_id_dsa.openssh -k 1 -T -l200m'
-        sra_prefix = 'anonftp\@ftp.ncbi.nlm.nih.gov:/sra/sra-instant/reads/ByRun/sra/SRR/'
-        for run in group:
-            run_location = run[0:6] + "/" + run + "/" + run + ".sra"
-            command = " ".join([ascp_command, sra_prefix + "/" + run_location, outdir + "\n"])
-            fh.write(command)
-    fh.close()
+        _DOWNLOAD_TEMPLATE.write(fh, commands, name = name, outdir = outdir,
+                                 logdir = logdir)
     os.chmod(submission_file, 0o744)
     
     return(submission_file)
 
-def aspera_download(groups,outdir):
+def _sra_location(run):
+    """Returns the location of the .sra file of a run for ascp"""
+    return(SRA_PREFIX + "/" + run[0:6] + "/" + run + "/" + run + ".sra")
+
+def _sra_complete(file):
+    """Whether a .sra file exists and ascp is not still writing it"""
+    return(os.path.isfile(file) and
+           not any(os.path.exists(file + suffix)
+                   for suffix in ASCP_PARTIAL_SUFFIXES))
+
+def _aspera_transfer(run, outdir, command, retries, backoff):
+    """Downloads one run with ascp, retrying with exponential backoff"""
+    source = _sra_location(run)
+    target = outdir + "/" + run + ".sra"
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            check = run_command(command + [source, outdir])
+            error = None
+            if check.returncode != 0:
+                error = ProcessError("Aspera download failed for run {} "
+                                     "(status {})".format(run, check.returncode))
+            elif not _sra_complete(target):
+                error = MissingFileError("Aspera did not write {}".format(target))
+        except OSError as err:
+            error = err
+        if error is None:
+            break
+        print("\tWARNING: Failed downloading run {} (attempt {} of {})".format(run,
+                                                                           attempt + 1,
+                                                                           retries + 1))
+    
+    nbytes = os.path.getsize(target) if error is None else 0
+    return(DownloadResult(target, nbytes, None, time.perf_counter() - start,
+                          url = source, error = error))
+
+def aspera_download(groups,outdir, workers = 1, rate = 200, retries = 2,
+                    backoff = 30, skip_existing = True, key = ASCP_KEY):
+    """Downloads the .sra files of many runs with ascp
+
+    Runs up to *workers* transfers at the same time, and splits the
+    total transfer rate evenly between them. Failed transfers are
+    retried, and ascp resumes them from the partial file.
+
+    Args:
+        groups (dict): Lists of run IDs per group, e.g. per sample.
+        outdir (str): Directory to write the <run>.sra files.
+        workers (int): Number of simultaneous transfers.
+        rate (int): Total target transfer rate in Mbps.
+        retries (int): Number of times a failed transfer is retried.
+        backoff (float): Seconds to wait before the first retry. The
+            wait doubles with every retry.
+        skip_existing (bool): Whether to skip runs whose .sra file is
+            complete, i.e. it exists and ascp has no partial file for it.
+        key (str): Private key file passed to ascp.
+
+    Returns:
+        A list of :py:class:`sutilspy.io.DownloadResult`, one per run in
+        the order of *groups*, with the size of every file and the time
+        its transfer took. Failed runs have their *error* set.
+    """
+    
+    runs = [run for name, group in groups.items() for run in group]
+    per_transfer = max(1, int(rate / workers))
+    command = ['ascp', '-i', key, '-k', '1', '-T', '-l{}m'.format(per_transfer)]
+    print("\n=============================================")
+    print("== Downloading {} runs, {} at a time at {}Mbps each".format(len(runs),
+                                                                      workers,
+                                                                      per_transfer))
     
-    ascp_command = 'ascp -i /godot/hmp/aspera/asperaweb_id_dsa.openssh -k 1 -T -l200m'
-    sra_prefix = 'anonftp\@ftp.ncbi.nlm.nih.gov:/sra/sra-instant/reads/ByRun/sra/SRR/'
+    def transfer(run):
+        target = outdir + "/" + run + ".sra"
+        if skip_existing and _sra_complete(target):
+            return(DownloadResult(target, os.path.getsize(target), None, 0.0,
+                                  url = _sra_location(run), skipped = True))
+        return(_aspera_transfer(run, outdir, command, retries, backoff))
     
-    FAILED = []
-    for name, runs in groups.items():
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(transfer, runs))
+    
+    failed = [res for res in results if not res.ok]
+    for res in failed:
+        print("\tWARNING: Failed downloading {}".format(res.outfile))
+    print("\t{} runs downloaded, {} skipped, {} failed".format(sum(res.ok and not res.skipped
+                                                                 for res in results),
+                                                             sum(res.skipped for res in results),
+                                                             len(failed)))
+    print("=============================================")
+    return(results)
+
+def _run_weights(runs, weights, run_col, weight_col, separator):
+    """Returns the weight of every run for create_submission_sets
+    
+    Runs without a weight get the mean weight of the others.
+    """
+    if isinstance(weights, str) and os.path.isdir(weights):
+        print("\tUsing the size of the .sra files in {}".format(weights))
+        sizes = {}
         for run in runs:
-            run_location = run[0:6] + "/" + run + "/" + run + ".sra"
-            command = " ".join([ascp_command, sra_prefix + "/" + run_location, outdir + "\n"])
-            print(command)
-            try:
-                check = run_command(command)
-                if check.returncode != 0:
-                    raise CalledProcessError("Aspera download failed for run {}".format(run))
-            except (CalledProcessError):
-                print("\tWARNING: Failed downloading run {}".format(run))
-                FAILED.append([run, 'dummy'])
-    #FAILED = [[1,'a'],[2,'a']]
-    return(FAILED)
-
-def create_submission_sets(runs_per_sample, split_by, ngroups):
+            file = weights + "/" + run + ".sra"
+            if os.path.isfile(file):
+                sizes[run] = os.path.getsize(file)
+        weights = sizes
+    elif isinstance(weights, str):
+        print("\tUsing column {} of {}".format(weight_col, weights))
+        with open(weights, 'r') as fh:
+            reader = csv.DictReader(fh, delimiter = separator)
+            weights = {row[run_col]: float(row[weight_col]) for row in reader
+                       if row.get(weight_col) not in (None, '')}
+    
+    known = [weights[run] for run in runs if run in weights]
+    if len(known) < len(runs):
+        print("\tWARNING: No weight for {} run(s). Using the mean".format(len(runs) - len(known)))
+    default = sum(known) / len(known) if known else 1
+    return({run: weights.get(run, default) for run in runs})
+
+def create_submission_sets(runs_per_sample, split_by, ngroups, weights = None,
+                           run_col = 'Run', weight_col = 'size_MB',
+                           separator = '\t'):
+    """Splits the runs of many samples into groups
+
+    Args:
+        runs_per_sample (dict): List of run IDs of every sample.
+        split_by (str): 'sample' for one group per sample, 'groups' for
+            *ngroups* groups with the same number of samples, or
+            'balanced' for *ngroups* groups with similar total weight,
+            assigned with the longest-processing-time rule. Samples are
+            never split between groups.
+        ngroups (int): Number of groups.
+        weights: Weight of every run for 'balanced': a dictionary from
+            run ID to weight, the name of a run info table with a
+            *run_col* and a *weight_col* column (e.g. size_MB or spots),
+            or a directory with the .sra files, whose sizes are used.
+        run_col (str): Column with run IDs in the run info table.
+        weight_col (str): Column with weights in the run info table.
+        separator (str): Separator of the run info table.
+
+    Returns:
+        A dictionary with the list of runs of every group.
+    """
     print("\n=============================================")
     GROUPS = dict()
     if split_by == 'sample':
@@ -189,6 +988,27 @@ def create_submission_sets(runs_per_sample, split_by, ngroups):
                 group_i += 1
             GROUPS[id].extend(runs)
             i += 1
+    elif split_by == 'balanced':
+        if weights is None:
+            raise ValueError("split_by='balanced' requires weights")
+        samples = list(runs_per_sample.items())
+        print("== Balancing {} samples into {} submissions".format(len(samples),ngroups))
+        run_weights = _run_weights([run for sample, runs in samples for run in runs],
+                                   weights, run_col, weight_col, separator)
+        sample_weights = [sum(run_weights[run] for run in runs)
+                          for sample, runs in samples]
+        bins, loads = _lpt_partition(sample_weights, ngroups)
+        for items, load in zip(bins, loads):
+            if not items:
+                continue
+            id = 'group' + str(len(GROUPS))
+            GROUPS[id] = [run for i in items for run in samples[i][1]]
+            print("\t{}: {} samples, {} runs, weight {:g}".format(id, len(items),
+                                                                 len(GROUPS[id]),
+                                                                 load))
+        mean = sum(loads) / ngroups
+        print("\tPredicted makespan: {:g} ({:.2f} times the mean weight "
+              "per group)".format(max(loads), max(loads) / mean if mean else 1))
     else:
         raise ValueError("Unrecognized split_by value")
     
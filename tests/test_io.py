@@ -1,6 +1,27 @@
 import unittest
+import bz2
+import hashlib
+import http.server
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import StringIO
 from sutilspy import io
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
 #import shutils
 
 class TestWriteTable(unittest.TestCase):
@@ -32,6 +53,45 @@ class TestWriteTable(unittest.TestCase):
         else:
             print("\tFile {} created".format(self.path))
         
+    def test_write_table_delimiter(self):
+        """Test delimiter and generator input"""
+        rows = ([str(i), "x{}".format(i)] for i in range(25))
+        self.assertEqual(io.write_table(self.path, rows, header = ['a', 'b'],
+                                        delimiter = ',', chunk_size = 10),
+                         26)
+        with open(self.path, 'r') as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines[0], 'a,b')
+        self.assertEqual(lines[25], '24,x24')
+    
+    def test_write_table_background(self):
+        """Test writing from a background thread"""
+        rows = [[i, i * 2] for i in range(1000)]
+        self.assertEqual(io.write_table(self.path, rows, chunk_size = 7,
+                                        background = True),
+                         1000)
+        self.assertEqual(io.return_column(self.path, 2, header = False)[-1],
+                         '1998')
+    
+    @unittest.skipUnless(numpy, "numpy is not installed")
+    def test_write_table_array(self):
+        """Test writing a numeric NumPy array"""
+        rows = numpy.arange(12).reshape(4, 3)
+        self.assertEqual(io.write_table(self.path, rows, chunk_size = 3), 4)
+        self.assertEqual(io.return_column(self.path, 3, header = False),
+                         ['2', '5', '8', '11'])
+        io.write_table(self.path, numpy.array([[1, 2], [3, 4]]), delimiter = '%')
+        with open(self.path, 'r') as fh:
+            self.assertEqual(fh.read().splitlines(), ['1%2', '3%4'])
+    
+    @unittest.skipUnless(pandas, "pandas is not installed")
+    def test_write_table_dataframe(self):
+        """Test writing a DataFrame with its column names"""
+        rows = pandas.DataFrame({'a': ['x', 'y'], 'b': [1, 2]})
+        self.assertEqual(io.write_table(self.path, rows, header = True), 3)
+        self.assertEqual(io.return_columns(self.path, [1, 2], header = False),
+                         [['a', 'x', 'y'], ['b', '1', '2']])
+        
 class TestClean_dirs(unittest.TestCase):
     """Test clean dirs"""
     
@@ -56,13 +116,867 @@ class TestClean_dirs(unittest.TestCase):
         self.assertEqual(io.clean_dirs('b',self.path),
                          ['temp_test_clean_dirs/b'])
      
+    def test_clean_dirs_stats(self):
+        with open(self.path + "/a/file", 'w') as fh:
+            fh.write("12345")
+        removed, stats = io.clean_dirs(['a', 'b', 'c'], self.path, stats = True)
+        self.assertEqual(removed, ['temp_test_clean_dirs/a','temp_test_clean_dirs/b'])
+        self.assertEqual([stats.ndirs, stats.nfiles, stats.nbytes], [2, 1, 5])
+    
     def test_clean_dirs_file(self):
         io.write_table(self.path + "/dirs", ['a','b'])
         self.assertEqual(io.clean_dirs(self.path + "/dirs",
                                        self.path),
                          ['temp_test_clean_dirs/a','temp_test_clean_dirs/b'])
         os.unlink(self.path + "/dirs")
+    
+    def test_clean_dirs_background(self):
+        with open(self.path + "/a/file", 'w') as fh:
+            fh.write("12345")
+        io.write_table(self.path + "/dirs", ['a','b','c'])
+        self.assertEqual(io.clean_dirs(self.path + "/dirs", self.path,
+                                       background = True),
+                         ['temp_test_clean_dirs/a','temp_test_clean_dirs/b'])
+        self.assertFalse(os.path.exists(self.path + "/a"))
+        self.assertTrue(io.wait_for_reaps(timeout = 10))
+        self.assertEqual(os.listdir(self.path), ['dirs'])
+        os.unlink(self.path + "/dirs")
+    
+    def test_clean_dirs_detach(self):
+        io.clean_dirs(['a', 'b'], self.path, background = True, detach = True)
+        self.assertFalse(os.path.exists(self.path + "/b"))
+        for i in range(100):
+            if not os.listdir(self.path):
+                break
+            time.sleep(0.1)
+        self.assertEqual(os.listdir(self.path), [])
+        
+        
+class TestConcatenateFiles(unittest.TestCase):
+    """Test concatenate_files"""
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix = 'temp_test_concatenate_files')
+        self.infiles = []
+        for i in range(3):
+            infile = os.path.join(self.path, "in{}.txt".format(i))
+            with open(infile, 'wb') as fh:
+                fh.write(("file{}\n".format(i) * (1000 * (i + 1))).encode())
+            self.infiles.append(infile)
+        self.outfile = os.path.join(self.path, "out.txt")
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def test_concatenate_files(self):
+        """Test output matches the inputs in order"""
+        res = io.concatenate_files(self.infiles, self.outfile)
+        expected = b''
+        for infile in self.infiles:
+            with open(infile, 'rb') as fh:
+                expected += fh.read()
+        with open(self.outfile, 'rb') as fh:
+            self.assertEqual(fh.read(), expected)
+        self.assertEqual(res.nfiles, 3)
+        self.assertEqual(res.nbytes, len(expected))
+        self.assertEqual(res.returncode, 0)
+    
+    def test_concatenate_files_small_buffer(self):
+        """Test copying in many small chunks"""
+        res = io.concatenate_files(iter(self.infiles), self.outfile,
+                                   buffer_size = 7, verbose = False)
+        self.assertEqual(os.path.getsize(self.outfile), res.nbytes)
+        self.assertEqual(res.nbytes, sum(os.path.getsize(f) for f in self.infiles))
+    
+    def test_copy_fd_short_input(self):
+        """Test a copy that comes up short of its size raises"""
+        size = os.path.getsize(self.infiles[0])
+        in_fd = os.open(self.infiles[0], os.O_RDONLY)
+        out_fd = os.open(self.outfile, os.O_WRONLY | os.O_CREAT)
+        try:
+            with self.assertRaises(IOError):
+                io._copy_fd(in_fd, out_fd, size + 10)
+        finally:
+            os.close(in_fd)
+            os.close(out_fd)
+        self.assertEqual(os.path.getsize(self.outfile), size)
+    
+    def test_concatenate_files_missing(self):
+        """Test missing input raises"""
+        with self.assertRaises(FileNotFoundError):
+            io.concatenate_files(self.infiles + [self.path + "/missing"],
+                                 self.outfile)
+        
+class TestBzip2Files(unittest.TestCase):
+    """Test bzip2_files"""
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix = 'temp_test_bzip2_files')
+        self.data = []
+        self.infiles = []
+        for i in range(2):
+            data = ("@read{0}\nACGT\n+\nIIII\n".format(i) * 5000).encode()
+            infile = os.path.join(self.path, "in{}.fastq".format(i))
+            with open(infile, 'wb') as fh:
+                fh.write(data)
+            self.data.append(data)
+            self.infiles.append(infile)
+        self.outfile = os.path.join(self.path, "out.fastq.bz2")
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def test_bzip2_files_parallel(self):
+        """Test multi-stream output decompresses to the inputs"""
+        res = io.bzip2_files(self.infiles, self.outfile, processes = 2,
+                             block_size = 10000)
+        with bz2.open(self.outfile, 'rb') as fh:
+            self.assertEqual(fh.read(), b''.join(self.data))
+        self.assertEqual(res.nbytes, sum(len(d) for d in self.data))
+        self.assertEqual(res.compressed_bytes, os.path.getsize(self.outfile))
+    
+    def test_bzip2_files_merge(self):
+        """Test bz2 inputs are appended without recompressing"""
+        compressed = self.infiles[1] + ".bz2"
+        with open(compressed, 'wb') as fh:
+            fh.write(bz2.compress(self.data[1]))
+        res = io.bzip2_files([self.infiles[0], compressed], self.outfile,
+                             processes = 1, verbose = False)
+        with bz2.open(self.outfile, 'rb') as fh:
+            self.assertEqual(fh.read(), b''.join(self.data))
+        self.assertEqual(res.nbytes, len(self.data[0]))
+        
+class TestProcessRunList(unittest.TestCase):
+    """Test process_run_list"""
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix = 'temp_test_process_run_list')
+        self.file = os.path.join(self.path, "runs.txt")
+        io.write_table(self.file, [['s1', 'r1'], ['s2', 'r2'], ['s1', 'r3'],
+                                   ['s3', 'r4'], ['s2', 'r5']],
+                       header = ['sample', 'run'])
+        self.expected = {'s1': ['r1', 'r3'], 's2': ['r2', 'r5'], 's3': ['r4']}
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def test_process_run_list(self):
+        """Test runs per sample"""
+        self.assertEqual(io.process_run_list(self.file, 0, 1), self.expected)
+    
+    def test_process_run_list_compact(self):
+        """Test index view and reverse lookup"""
+        index = io.process_run_list(self.file, 0, 1, compact = True)
+        self.assertEqual(dict(index), self.expected)
+        self.assertEqual(list(index), ['s1', 's2', 's3'])
+        self.assertEqual(index.sample_of('r5'), 's2')
+        self.assertEqual(index.nruns, 5)
+    
+    def test_process_run_list_cache(self):
+        """Test cache is written, reused and invalidated"""
+        cache = self.file + ".runidx"
+        self.assertEqual(io.process_run_list(self.file, 0, 1, cache = True),
+                         self.expected)
+        self.assertTrue(os.path.isfile(cache))
+        self.assertEqual(io.process_run_list(self.file, 0, 1, cache = True),
+                         self.expected)
+        
+        # Swapped columns must not reuse the cache
+        self.assertEqual(io.process_run_list(self.file, 1, 0, cache = True)['r3'],
+                         ['s1'])
+        
+        with open(self.file, 'a') as fh:
+            fh.write("s3\tr6\n")
+        self.assertEqual(io.process_run_list(self.file, 0, 1, cache = True)['s3'],
+                         ['r4', 'r6'])
+        
+class TestReturnColumn(unittest.TestCase):
+    """Test return_column and return_columns"""
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix = 'temp_test_return_column')
+        self.file = os.path.join(self.path, "table.txt")
+        with open(self.file, 'w') as fh:
+            fh.write("a\tb\tc\n1\t2\t3\n4\t5\t6\r\n\n7\t8\t9\n")
+        self.quoted = os.path.join(self.path, "quoted.txt")
+        with open(self.quoted, 'w') as fh:
+            fh.write('a,b\n"x,1",2\n"y",3\n')
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def test_return_column(self):
+        self.assertEqual(io.return_column(self.file, 3), ['3', '6', '9'])
+        self.assertEqual(io.return_column(self.file, 1, header = False),
+                         ['a', '1', '4', '7'])
+    
+    def test_return_column_generator(self):
+        values = io.return_column(self.file, 2, generator = True)
+        self.assertFalse(isinstance(values, list))
+        self.assertEqual(list(values), ['2', '5', '8'])
+    
+    def test_return_columns(self):
+        self.assertEqual(io.return_columns(self.file, [3, 1]),
+                         [['3', '6', '9'], ['1', '4', '7']])
+        self.assertEqual(list(io.iter_columns(self.file, [2, 3])),
+                         [('2', '3'), ('5', '6'), ('8', '9')])
+    
+    def test_return_column_blocks(self):
+        """Test values are not lost across block boundaries"""
+        blocks = list(io._column_blocks(self.file, [0], header = False,
+                                        block_size = 3))
+        self.assertTrue(len(blocks) > 1)
+        self.assertEqual([v for block in blocks for v in block[0]],
+                         ['a', '1', '4', '7'])
+    
+    def test_return_column_cache(self):
+        """Test column cache next to the file"""
+        cache = self.file + ".col2.cache"
+        self.assertEqual(io.return_column(self.file, 2, cache = True),
+                         ['2', '5', '8'])
+        self.assertTrue(os.path.isfile(cache))
+        self.assertEqual(io.return_column(self.file, 2, cache = True),
+                         ['2', '5', '8'])
+        with open(self.file, 'a') as fh:
+            fh.write("10\t11\t12\n")
+        self.assertEqual(list(io.return_column(self.file, 2, cache = True,
+                                               generator = True)),
+                         ['2', '5', '8', '11'])
+    
+    def test_return_column_cache_dir(self):
+        """Test column cache directory and eviction"""
+        cache_dir = os.path.join(self.path, "cache")
+        self.assertEqual(io.return_column(self.file, 1, cache = cache_dir),
+                         ['1', '4', '7'])
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(io.return_column(self.file, 3, cache = cache_dir,
+                                          cache_max_bytes = 0),
+                         ['3', '6', '9'])
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(io.return_column(self.file, 3, cache = cache_dir),
+                         ['3', '6', '9'])
+    
+    def test_return_column_quoted(self):
+        """Test files with quotes are parsed as csv"""
+        self.assertEqual(io.return_column(self.quoted, 1, separator = ','),
+                         ['x,1', 'y'])
+        
+class TestRunCommands(unittest.TestCase):
+    """Test run_commands"""
+    
+    def test_run_commands(self):
+        """Test results are in order and failures are collected"""
+        commands = ['echo one', ['echo', 'two'], 'exit 3',
+                    ['sleep', '5'], ['temp_test_no_such_program']]
+        res = io.run_commands(commands, max_workers = 3, timeout = 0.5,
+                              capture = True)
+        self.assertEqual([r.args for r in res], commands)
+        self.assertEqual(res[0].stdout, "one\n")
+        self.assertEqual(res[1].stdout, "two\n")
+        self.assertTrue(res[0].ok and res[1].ok)
+        self.assertEqual(res[2].returncode, 3)
+        self.assertIsNone(res[3].returncode)
+        self.assertIsInstance(res[3].error, subprocess.TimeoutExpired)
+        self.assertIsInstance(res[4].error, OSError)
+    
+    def test_run_commands_trace(self):
+        """Test resource usage is recorded in the trace"""
+        path = tempfile.mkdtemp(prefix = 'temp_test_run_commands_trace')
+        trace = os.path.join(path, "trace.jsonl")
+        io.set_trace(trace)
+        try:
+            command = [sys.executable, '-c',
+                       'x = bytearray(64 * 1024 * 1024); x[::4096] = b"1" * len(x[::4096])']
+            res = io.run_commands([command, 'exit 2'], verbose = False)
+            io.run_command('true')
+        finally:
+            io.set_trace(None)
+        with open(trace, 'r') as fh:
+            records = [json.loads(line) for line in fh]
+        shutil.rmtree(path)
+        
+        self.assertEqual(len(records), 3)
+        self.assertGreater(res[0].max_rss_kb, 60 * 1024)
+        self.assertIsNotNone(res[0].user_seconds)
+        first = [r for r in records if r['command'] == command][0]
+        self.assertEqual(first['max_rss_kb'], res[0].max_rss_kb)
+        self.assertEqual(sorted(r['returncode'] for r in records), [0, 0, 2])
+        
+    def test_run_commands_output(self):
+        """Test both outputs, signals and timeouts with resource usage"""
+        commands = ['echo out; echo err >&2; kill -TERM $$',
+                    'echo partial; exec sleep 5']
+        res = io.run_commands(commands, timeout = 0.5, capture = True,
+                              verbose = False)
+        self.assertEqual([res[0].stdout, res[0].stderr], ["out\n", "err\n"])
+        self.assertEqual(res[0].returncode, -15)
+        self.assertIsNotNone(res[0].user_seconds)
+        self.assertIsInstance(res[1].error, subprocess.TimeoutExpired)
+        self.assertEqual(res[1].error.stdout, "partial\n")
+        self.assertIsNotNone(res[1].user_seconds)
+        
+    def test_run_commands_empty(self):
+        self.assertEqual(io.run_commands([]), [])
+        
+def write_fake_program(bindir, name, script):
+    """Writes an executable bash script to stand in for a program"""
+    path = os.path.join(bindir, name)
+    with open(path, 'w') as fh:
+        fh.write("#!/bin/bash\n" + script)
+    os.chmod(path, 0o755)
+    return(path)
+
+class FakeProgramTestCase(unittest.TestCase):
+    """Puts fake programs first in PATH
+    
+    Every script in *programs*, a dictionary of scripts per program
+    name, is written with :py:func:`write_fake_program` into
+    <tmpdir>/bin.
+    """
+    
+    programs = {}
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bindir = os.path.join(self.tmpdir, "bin")
+        os.mkdir(self.bindir)
+        for name, script in self.programs.items():
+            write_fake_program(self.bindir, name, script)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = self.bindir + os.pathsep + self.old_path
+    
+    def tearDown(self):
+        os.environ['PATH'] = self.old_path
+        shutil.rmtree(self.tmpdir)
+
+class TestSubmissionTemplate(unittest.TestCase):
+    """Test SubmissionTemplate"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_render(self):
+        template = io.SubmissionTemplate(("#!/bin/bash\n",
+                                          "#PBS -N {name}\n",
+                                          "#PBS -q {queue}\n",
+                                          "#PBS -l {loptions}\n",
+                                          "{commands}\n"),
+                                         {'name': "Job"},
+                                         loptions = ["mem=1gb", "cput=1:00:00"])
+        self.assertEqual(template.render(["echo {}"], queue = "long"),
+                         "#!/bin/bash\n#PBS -N Job\n#PBS -q long\n"
+                         "#PBS -l mem=1gb\n#PBS -l cput=1:00:00\necho {}\n")
+        self.assertEqual(template.render(["true"], name = "a"),
+                         "#!/bin/bash\n#PBS -N a\n"
+                         "#PBS -l mem=1gb\n#PBS -l cput=1:00:00\ntrue\n")
+        
+        fh = StringIO()
+        io.write_qsub_submission(fh, ["true"], dir = "/work", name = "b")
+        self.assertEqual(fh.getvalue(),
+                         io.SubmissionTemplate.pbs(dir = "/work").render(["true"],
+                                                                         name = "b"))
+        self.assertTrue(fh.getvalue().startswith("#!/bin/bash\n#PBS -N  b\n"
+                                                 "#PBS -d /work\n#PBS -o log\n"))
+    
+    def test_write_batch(self):
+        template = io.SubmissionTemplate.slurm(dir = self.tmpdir)
+        jobs = [("job{}.bash".format(i), ["echo {}".format(i)], {'name': str(i)})
+                for i in range(3)]
+        outdir = os.path.join(self.tmpdir, "files")
+        paths = template.write_batch(jobs, outdir, launcher = "submit.sh",
+                                     submit = "sbatch")
+        self.assertEqual(paths, [os.path.join(outdir, job[0]) for job in jobs])
+        with open(paths[1], 'r') as fh:
+            self.assertEqual(fh.read(), template.render(["echo 1"], name = "1"))
+        self.assertTrue(os.access(paths[1], os.X_OK))
+        with open(os.path.join(outdir, "manifest.tsv"), 'r') as fh:
+            self.assertEqual(fh.readline(), "job0.bash\t{}\n".format(paths[0]))
+        with open(os.path.join(outdir, "submit.sh"), 'r') as fh:
+            self.assertEqual(fh.read().splitlines()[1:],
+                             ["sbatch " + path for path in paths])
+        
+        outdir = os.path.join(self.tmpdir, "archive")
+        archive = os.path.join(self.tmpdir, "jobs.tar")
+        paths = template.write_batch(jobs, outdir, launcher = "submit.sh",
+                                     archive = archive)
+        self.assertFalse(os.path.exists(paths[0]))
+        subprocess.run(["tar", "-xf", archive, "-C", outdir], check = True)
+        with open(paths[2], 'r') as fh:
+            self.assertEqual(fh.read(), template.render(["echo 2"], name = "2"))
+
+class TestArraySubmissions(FakeProgramTestCase):
+    """Test array mode of sbatch_submissions and qsub_submissions"""
+    
+    programs = {program: 'echo "{} $@" >> "$(dirname "$0")/calls.txt"\n'.format(program)
+                for program in ['sbatch', 'qsub']}
+    
+    def setUp(self):
+        super().setUp()
+        self.calls = os.path.join(self.bindir, "calls.txt")
+        self.logdir = os.path.join(self.tmpdir, "logs")
+    
+    def test_sbatch_array(self):
+        """Test one sbatch call runs every task by its index"""
+        tasks = [["echo one > {}/out1".format(self.tmpdir)],
+                 ["echo two > {}/out2".format(self.tmpdir),
+                  "echo more >> {}/out2".format(self.tmpdir)]]
+        io.sbatch_submissions(tasks, self.logdir, array = True, throttle = 5,
+                              name = "test", time = "1:00:00")
+        with open(self.calls, 'r') as fh:
+            calls = fh.read().splitlines()
+        script = os.path.join(self.logdir, "test.sh")
+        self.assertEqual(calls, ["sbatch --array=1-2%5 " + script])
+        
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID = "2")
+        subprocess.run(['bash', script], env = env, stdout = subprocess.DEVNULL,
+                       stderr = subprocess.DEVNULL)
+        with open(os.path.join(self.tmpdir, "out2"), 'r') as fh:
+            self.assertEqual(fh.read(), "two\nmore\n")
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "out1")))
+    
+    def test_qsub_array(self):
+        """Test one qsub call with scripts as tasks"""
+        scripts = []
+        for i in range(3):
+            scripts.append(os.path.join(self.tmpdir, "job{}.sh".format(i)))
+            with open(scripts[-1], 'w') as fh:
+                fh.write("echo {0} > {1}/out{0}\n".format(i, self.tmpdir))
+        io.qsub_submissions(scripts, self.logdir, array = True)
+        with open(self.calls, 'r') as fh:
+            calls = fh.read().splitlines()
+        script = os.path.join(self.logdir, "array.sh")
+        self.assertEqual(calls, ["qsub -t 1-3 " + script])
+        
+        env = dict(os.environ, PBS_ARRAYID = "3")
+        res = subprocess.run(['bash', script], env = env, stdout = subprocess.DEVNULL)
+        self.assertEqual(res.returncode, 0)
+        with open(os.path.join(self.tmpdir, "out2"), 'r') as fh:
+            self.assertEqual(fh.read(), "2\n")
+    
+    def test_array_task_failure(self):
+        """Test the script of a failing task exits with its status"""
+        for submit in (io.qsub_submissions, io.sbatch_submissions):
+            submit([["true"], ["false"]], self.logdir, array = True)
+            script = os.path.join(self.logdir, "array.sh")
+            env = dict(os.environ, PBS_ARRAYID = "2", SLURM_ARRAY_TASK_ID = "2")
+            res = subprocess.run(['bash', script], env = env,
+                                 stdout = subprocess.DEVNULL,
+                                 stderr = subprocess.DEVNULL)
+            self.assertEqual(res.returncode, 1)
+        
+class TestPackCommands(unittest.TestCase):
+    """Test pack_commands"""
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix = 'temp_test_pack_commands')
+        self.commands = [("touch {}/out{}".format(self.path, i), seconds, 100 * (i + 1))
+                         for i, seconds in enumerate([60, 50, 40, 30, 20, 10])]
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def read_headers(self, submission):
+        with open(submission, 'r') as fh:
+            return([line.rstrip() for line in fh if line.startswith("#SBATCH")
+                    or line.startswith("#PBS")])
+    
+    def test_pack_commands_njobs(self):
+        """Test jobs are balanced and request their time and memory"""
+        subs = io.pack_commands(self.commands, self.path + "/subs", njobs = 2)
+        self.assertEqual(len(subs), 2)
+        headers = self.read_headers(subs[0])
+        self.assertIn("#SBATCH --time=0:02:12", headers)
+        self.assertIn("#SBATCH --mem=500M", headers)
+        self.assertIn("#SBATCH -c 1", headers)
+    
+    def test_pack_commands_walltime_parallel(self):
+        """Test packing by walltime with commands run in parallel"""
+        subs = io.pack_commands(self.commands, self.path + "/subs",
+                                walltime = "0:01:10", cpus = 2,
+                                parallel = True, scheduler = 'pbs')
+        self.assertEqual(len(subs), 2)
+        headers = self.read_headers(subs[0])
+        self.assertIn("#PBS -l nodes=1:ppn=2", headers)
+        self.assertIn("#PBS -l mem=1100mb", headers)
+        # 60 and 50 start together, then 20 and 10 follow 50, so the
+        # job is predicted to end at the walltime, 0:01:10 * 1.2
+        self.assertIn("#PBS -l walltime=0:01:24", headers)
+        self.assertIn("#PBS -l walltime=0:00:48", self.read_headers(subs[1]))
+        
+        for submission in subs:
+            res = subprocess.run(['bash', submission], stdout = subprocess.DEVNULL)
+            self.assertEqual(res.returncode, 0)
+        for i in range(len(self.commands)):
+            self.assertTrue(os.path.isfile("{}/out{}".format(self.path, i)))
+    
+    def test_pack_commands_parallel_failure(self):
+        """Test a parallel job fails if any of its commands fails"""
+        commands = [("exit 3", 1), ("sleep 0.2", 1), ("true", 1)]
+        subs = io.pack_commands(commands, self.path + "/subs", njobs = 1,
+                                cpus = 2, parallel = True)
+        res = subprocess.run(['bash', subs[0]], stdout = subprocess.DEVNULL)
+        self.assertEqual(res.returncode, 1)
+    
+    def test_pack_commands_arguments(self):
+        with self.assertRaises(ValueError):
+            io.pack_commands(self.commands, self.path)
+        
+class TestRunSubmissionsLocally(unittest.TestCase):
+    """Test parse_submission and run_submissions_locally"""
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix = 'temp_test_run_locally')
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def test_parse_submission(self):
+        slurm = os.path.join(self.path, "slurm.sh")
+        with open(slurm, 'w') as fh:
+            io.write_slurm_submission(fh, ['true'], dir = self.path, name = "a",
+                                      cpus = "4", memory = "2G")
+        self.assertEqual(io.parse_submission(slurm),
+                         {'scheduler': 'slurm', 'name': 'a', 'workdir': self.path,
+                          'output': '%j.log', 'error': '%j.err', 'cpus': 4,
+                          'memory': 2048})
+        pbs = os.path.join(self.path, "pbs.sh")
+        with open(pbs, 'w') as fh:
+            io.write_qsub_submission(fh, ['true'], dir = self.path, name = "b",
+                                     memory = "500mb", nodes = "nodes=1:ppn=3")
+        options = io.parse_submission(pbs)
+        self.assertEqual([options['scheduler'], options['name'], options['cpus'],
+                          options['memory']], ['pbs', 'b', 3, 500])
+    
+    def test_run_submissions_locally(self):
+        """Test jobs run in their workdir, log to their files and respect CPUs"""
+        submissions = []
+        for i in range(4):
+            submissions.append(os.path.join(self.path, "job{}.sh".format(i)))
+            with open(submissions[-1], 'w') as fh:
+                io.write_slurm_submission(fh, ["echo job{} $SLURM_CPUS_PER_TASK".format(i),
+                                               "date +%s.%N > start{}".format(i),
+                                               "sleep 0.3",
+                                               "exit {}".format(i % 2)],
+                                          dir = self.path, name = "job{}".format(i),
+                                          cpus = "2", logfile = "%x.log")
+        res = io.run_submissions_locally(submissions, max_cpus = 4)
+        self.assertEqual([r.returncode for r in res], [0, 1, 0, 1])
+        with open(os.path.join(self.path, "job3.log"), 'r') as fh:
+            self.assertIn("job3 2\n", fh.read())
+        self.assertTrue(os.path.isfile(os.path.join(self.path, "2.err")))
+        
+        # Only two jobs of 2 CPUs fit at once
+        starts = []
+        for i in range(4):
+            with open(os.path.join(self.path, "start{}".format(i)), 'r') as fh:
+                starts.append(float(fh.read()))
+        self.assertGreater(min(starts[2:]) - max(starts[:2]), 0.2)
+        
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files of the server, honoring Range headers"""
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        self.server.connections.add(self.client_address)
+        if self.server.failures.get(self.path, 0) > 0:
+            self.server.failures[self.path] -= 1
+            self.send_error(503)
+            return
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        body = self.server.files[self.path]
+        byte_range = self.headers.get('Range')
+        if byte_range is not None and self.server.ranges:
+            start = int(byte_range[len('bytes='):-1])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start,
+                                                                      len(body) - 1,
+                                                                      len(body)))
+            body = body[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+class HTTPTestCase(unittest.TestCase):
+    """Starts a local HTTP server with a binary file"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.files = {'/data.bin': bytes(range(256)) * 1000}
+        self.server.ranges = True
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.failures = {}
+        self.thread = threading.Thread(target = self.server.serve_forever,
+                                       kwargs = {'poll_interval': 0.05})
+        self.thread.start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+class TestDownloadFile(HTTPTestCase):
+    """Test download_file and write_download"""
+    
+    def test_download_file(self):
+        outfile = os.path.join(self.tmpdir, "data.bin")
+        body = self.server.files['/data.bin']
+        res = io.download_file(self.url + "/data.bin", outfile, chunk_size = 1000)
+        with open(outfile, 'rb') as fh:
+            self.assertEqual(fh.read(), body)
+        self.assertEqual(res.nbytes, len(body))
+        self.assertEqual(res.checksum, hashlib.md5(body).hexdigest())
+        self.assertFalse(os.path.exists(outfile + io.PART_SUFFIX))
+    
+    def test_download_file_resume(self):
+        outfile = os.path.join(self.tmpdir, "data.bin")
+        body = self.server.files['/data.bin']
+        with open(outfile + io.PART_SUFFIX, 'wb') as fh:
+            fh.write(body[:1000])
+        res = io.download_file(self.url + "/data.bin", outfile)
+        self.assertEqual(self.server.requests[-1][1], 'bytes=1000-')
+        self.assertEqual(res.resumed, 1000)
+        self.assertEqual(res.checksum, hashlib.md5(body).hexdigest())
+        with open(outfile, 'rb') as fh:
+            self.assertEqual(fh.read(), body)
+        
+        # Server ignores the range
+        self.server.ranges = False
+        with open(outfile + io.PART_SUFFIX, 'wb') as fh:
+            fh.write(b'garbage')
+        res = io.download_file(self.url + "/data.bin", outfile)
+        self.assertEqual(res.resumed, 0)
+        with open(outfile, 'rb') as fh:
+            self.assertEqual(fh.read(), body)
+    
+    def test_download_file_error(self):
+        outfile = os.path.join(self.tmpdir, "missing.bin")
+        with self.assertRaises(io.DownloadError):
+            io.download_file(self.url + "/missing.bin", outfile)
+        self.assertFalse(os.path.exists(outfile))
+    
+    def test_write_download(self):
+        outfile = os.path.join(self.tmpdir, "data.bin")
+        body = self.server.files['/data.bin']
+        with open(os.path.join(self.tmpdir, "in.bin"), 'wb') as fh:
+            fh.write(body)
+        with open(os.path.join(self.tmpdir, "in.bin"), 'rb') as fh:
+            res = io.write_download(fh, outfile, checksum = 'sha1')
+        self.assertEqual(res.checksum, hashlib.sha1(body).hexdigest())
+        with open(outfile, 'rb') as fh:
+            self.assertEqual(fh.read(), body)
+        
+        class Text(object):
+            text = "sample\trun\n"
+        io.write_download(Text(), outfile)
+        with open(outfile, 'r') as fh:
+            self.assertEqual(fh.read(), "sample\trun\n")
+
+class TestFetchFiles(HTTPTestCase):
+    """Test fetch_files"""
+    
+    def test_fetch_files(self):
+        pairs = []
+        for i in range(6):
+            self.server.files['/{}.txt'.format(i)] = "file {}\n".format(i).encode()
+            pairs.append((self.url + "/{}.txt".format(i),
+                          os.path.join(self.tmpdir, "{}.txt".format(i))))
+        with open(pairs[0][1], 'w') as fh:
+            fh.write("old\n")
+        
+        res = io.fetch_files(pairs, max_workers = 4, per_host = 1,
+                             verbose = False)
+        self.assertEqual([r.ok for r in res], [True] * 6)
+        self.assertTrue(res[0].skipped)
+        for i in range(1, 6):
+            with open(pairs[i][1], 'r') as fh:
+                self.assertEqual(fh.read(), "file {}\n".format(i))
+        # One keep-alive connection
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(len(self.server.requests), 5)
+        
+        # 404 is not retried
+        res = io.fetch_files([(self.url + "/missing.txt",
+                               os.path.join(self.tmpdir, "missing.txt"))],
+                             verbose = False)
+        self.assertEqual(res[0].error.status, 404)
+        self.assertEqual(len(self.server.requests), 6)
+    
+    def test_fetch_files_retry(self):
+        self.server.failures['/data.bin'] = 2
+        outfile = os.path.join(self.tmpdir, "data.bin")
+        res = io.fetch_files([(self.url + "/data.bin", outfile)],
+                             backoff = 0.01, verbose = False)
+        self.assertTrue(res[0].ok)
+        self.assertEqual(len(self.server.requests), 3)
+        res = io.fetch_files([(self.url + "/data.bin", outfile)],
+                             skip_existing = False, retries = 0,
+                             verbose = False)
+        self.assertEqual(res[0].nbytes, len(self.server.files['/data.bin']))
+        self.server.failures['/data.bin'] = 1
+        res = io.fetch_files([(self.url + "/data.bin", outfile)],
+                             skip_existing = False, retries = 0,
+                             verbose = False)
+        self.assertEqual(res[0].error.status, 503)
+
+class TestJobTracker(FakeProgramTestCase):
+    """Test JobTracker against a fake scheduler"""
+    
+    # Jobs 11 and 12 run for two queries, then 11 completes, 12 fails,
+    # and array job 13 has one task still running until the third query.
+    programs = {'squeue': 'calls="$(dirname "$0")/calls.txt"\n'
+                          'echo "squeue $@" >> "$calls"\n'
+                          'n=$(grep -c squeue "$calls")\n'
+                          'if [ $n -le 2 ]; then echo "11 RUNNING"; echo "12 PENDING"; fi\n'
+                          'if [ $n -le 3 ]; then echo "13_2 RUNNING"; fi\n',
+                'sacct': 'echo "sacct $@" >> "$(dirname "$0")/calls.txt"\n'
+                         'echo "11|COMPLETED"; echo "12|FAILED"\n'
+                         'echo "13_1|COMPLETED"; echo "13_2|CANCELLED by 0"\n',
+                'sbatch': 'echo "Submitted batch job 11"\n'}
+    
+    def setUp(self):
+        super().setUp()
+        self.calls = os.path.join(self.bindir, "calls.txt")
+    
+    def test_parse_job_ids(self):
+        self.assertEqual(io.parse_job_ids("Submitted batch job 5\n6;cluster\n"
+                                          "7.server\n8[].server\nnoise\n"),
+                         ['5', '6', '7.server', '8[].server'])
+    
+    def test_sbatch_submissions_ids(self):
+        script = os.path.join(self.tmpdir, "job.sh")
+        open(script, 'w').close()
+        self.assertEqual(io.sbatch_submissions([script], self.tmpdir), ['11'])
+    
+    def test_job_tracker(self):
+        """Test one batched query per update and final states"""
+        tracker = io.JobTracker(['11', '12', '13'], interval = 0.01,
+                                max_interval = 0.05)
+        self.assertEqual(tracker.status(), {'11': 'RUNNING', '12': 'PENDING',
+                                            '13': 'RUNNING'})
+        # Cached until the interval passes
+        tracker.interval = tracker._delay = 60
+        tracker.status()
+        tracker.interval = tracker._delay = 0.01
+        
+        done = list(tracker.as_completed(timeout = 10))
+        self.assertEqual(sorted(done), [('11', 'COMPLETED'), ('12', 'FAILED'),
+                                        ('13', 'CANCELLED')])
+        self.assertEqual(tracker.wait_all(), {'11': 'COMPLETED', '12': 'FAILED',
+                                              '13': 'CANCELLED'})
+        with open(self.calls, 'r') as fh:
+            calls = fh.read().splitlines()
+        self.assertEqual(calls[0], "squeue -h -o %i %T -j 11,12,13")
+        self.assertEqual(len([c for c in calls if c.startswith("squeue")]), 4)
+    
+    def test_job_tracker_failed_query(self):
+        """Test jobs keep their state when the scheduler does not answer"""
+        for name in ('squeue', 'sacct'):
+            write_fake_program(self.bindir, name,
+                               'echo "{0} error: Socket timed out" >&2\n'
+                               'exit 1\n'.format(name))
+        tracker = io.JobTracker(['11', '12'])
+        self.assertEqual(tracker.update(), [])
+        self.assertEqual(tracker.states, {'11': None, '12': None})
+        
+        # Jobs that are no longer known are asked to sacct
+        write_fake_program(self.bindir, 'squeue',
+                           'echo "slurm_load_jobs error: Invalid job id specified" >&2\n'
+                           'exit 1\n')
+        write_fake_program(self.bindir, 'sacct', 'echo "11|COMPLETED"\n')
+        self.assertEqual(tracker.update(), ['11', '12'])
+        self.assertEqual(tracker.states, {'11': 'COMPLETED', '12': 'UNKNOWN'})
+    
+    def test_job_tracker_pbs(self):
+        """Test only jobs that qstat reports as unknown are completed"""
+        write_fake_program(self.bindir, 'qstat',
+                           'echo "Job id  Name  User  Time  S  Queue"\n'
+                           'echo "11.server  job  user  0  R  batch"\n'
+                           'echo "qstat: Unknown Job Id 12.server" >&2\n'
+                           'exit 153\n')
+        tracker = io.JobTracker(['11.server', '12.server', '13.server'],
+                                scheduler = 'pbs')
+        tracker.update()
+        self.assertEqual(tracker.states, {'11': 'RUNNING', '12': 'COMPLETED',
+                                          '13': None})
+        
+        write_fake_program(self.bindir, 'qstat',
+                           'echo "qstat: cannot connect to server" >&2\n'
+                           'exit 1\n')
+        self.assertEqual(tracker.update(), [])
+        self.assertEqual(tracker.states, {'11': 'RUNNING', '12': 'COMPLETED',
+                                          '13': None})
+        
+class TestRemoveTree(unittest.TestCase):
+    """Test remove_tree"""
+    
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix = 'temp_test_remove_tree')
+        self.tree = os.path.join(self.path, "tree")
+        for i in range(3):
+            for j in range(4):
+                d = os.path.join(self.tree, "d{}".format(i), "e{}".format(j))
+                os.makedirs(d)
+                for k in range(5):
+                    with open(os.path.join(d, "f{}".format(k)), 'w') as fh:
+                        fh.write("x" * 10)
+        self.outside = os.path.join(self.path, "outside")
+        os.mkdir(self.outside)
+        with open(os.path.join(self.outside, "keep"), 'w') as fh:
+            fh.write("keep")
+        os.symlink(self.outside, os.path.join(self.tree, "link"))
+        self.link_size = os.lstat(os.path.join(self.tree, "link")).st_size
+    
+    def tearDown(self):
+        shutil.rmtree(self.path)
+    
+    def test_remove_tree_dry_run(self):
+        stats = io.remove_tree(self.tree, threads = 4, dry_run = True)
+        self.assertEqual([stats.ndirs, stats.nfiles], [16, 61])
+        self.assertTrue(os.path.isdir(self.tree))
+    
+    def test_remove_tree(self):
+        """Test files are removed and symlinks not followed"""
+        stats = io.remove_tree(self.tree, threads = 4)
+        self.assertEqual([stats.ndirs, stats.nfiles], [16, 61])
+        self.assertEqual(stats.nbytes, 600 + self.link_size)
+        self.assertFalse(os.path.exists(self.tree))
+        self.assertTrue(os.path.isfile(os.path.join(self.outside, "keep")))
+    
+    def test_remove_tree_symlink(self):
+        """Test a link to a directory is removed without following it"""
+        link = os.path.join(self.path, "top_link")
+        os.symlink(self.outside, link)
+        stats = io.remove_tree(link, threads = 4)
+        self.assertEqual([stats.ndirs, stats.nfiles], [0, 1])
+        self.assertFalse(os.path.lexists(link))
+        self.assertTrue(os.path.isfile(os.path.join(self.outside, "keep")))
         
+        os.symlink(self.outside, link)
+        io.clean_dirs([link])
+        self.assertFalse(os.path.lexists(link))
+        self.assertTrue(os.path.isfile(os.path.join(self.outside, "keep")))
         
 if __name__  == '__main__':
     unittest.main()
\ No newline at end of file
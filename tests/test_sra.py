@@ -0,0 +1,400 @@
+import unittest
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+from sutilspy import sra
+from sutilspy.all import IntegrityError, MissingFileError, ProcessError
+from test_io import FakeProgramTestCase
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+# Writes two spots per run, as <run>_1.fastq and <run>_2.fastq in the
+# -O directory, or interleaved to STDOUT with -Z. Fails halfway for runs
+# named BAD. Earlier runs take longer.
+FAKE_FASTQ_DUMP = """
+while [ $# -gt 1 ]; do
+    case "$1" in
+        -O) out=$2; shift;;
+        -Z) stdout=1;;
+    esac
+    shift
+done
+run=$(basename "$1" .sra)
+sleep $(cat "$1")
+record() {
+    printf '@%s.%s.%s %s length=4\\nACGT\\n+%s.%s.%s %s length=4\\nIIII\\n' \\
+        $run $1 $2 $1 $run $1 $2 $1
+}
+for spot in 1 2; do
+    if [ -n "$stdout" ]; then
+        record $spot 1
+        record $spot 2
+    else
+        record $spot 1 >> "$out/${run}_1.fastq"
+        record $spot 2 >> "$out/${run}_2.fastq"
+    fi
+    if [ "$run" = "BAD" ]; then exit 1; fi
+done
+"""
+
+# Logs every validated file, failing for runs named BAD
+FAKE_VDB_VALIDATE = """
+echo "$1" >> "$(dirname "$0")/validated"
+if [ "$(basename "$1")" = "BAD.sra" ]; then exit 3; fi
+"""
+
+# Logs its arguments and writes <run>.sra in the output directory.
+# Runs named BAD always fail, and runs named FLAKY fail the first time.
+FAKE_ASCP = """
+bindir=$(dirname "$0")
+echo "$@" >> "$bindir/ascp.log"
+source=${@: -2:1}
+out=${@: -1}
+run=$(basename "$source" .sra)
+if [ "$run" = "BAD" ]; then exit 1; fi
+if [ "$run" = "FLAKY" ] && [ ! -e "$bindir/flaky" ]; then
+    touch "$bindir/flaky"
+    exit 1
+fi
+echo "$run" > "$out/$run.sra"
+rm -f "$out/$run.sra.aspx"
+"""
+
+class TestAsperaDownload(FakeProgramTestCase):
+    """Test aspera_download"""
+    
+    programs = {"ascp": FAKE_ASCP}
+    
+    def setUp(self):
+        super().setUp()
+        self.outdir = os.path.join(self.tmpdir, "sra")
+        os.mkdir(self.outdir)
+    
+    def test_aspera_download(self):
+        # SRR2 is complete, and SRR3 is a partial transfer
+        for run in ["SRR2", "SRR3"]:
+            with open(os.path.join(self.outdir, run + ".sra"), 'w') as fh:
+                fh.write("old\n")
+        open(os.path.join(self.outdir, "SRR3.sra.aspx"), 'w').close()
+        groups = {'g1': ["SRR1", "FLAKY", "SRR2"], 'g2': ["BAD", "SRR3"]}
+        res = sra.aspera_download(groups, self.outdir, workers = 4, rate = 200,
+                                  retries = 1, backoff = 0.01)
+        self.assertEqual([os.path.basename(r.outfile) for r in res],
+                         ["SRR1.sra", "FLAKY.sra", "SRR2.sra", "BAD.sra",
+                          "SRR3.sra"])
+        self.assertEqual([r.ok for r in res], [True, True, True, False, True])
+        self.assertEqual([r.skipped for r in res], [False, False, True, False, False])
+        self.assertIsInstance(res[3].error, ProcessError)
+        self.assertEqual(res[4].nbytes, 5)
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, "SRR3.sra.aspx")))
+        
+        with open(os.path.join(self.bindir, "ascp.log"), 'r') as fh:
+            calls = fh.read().splitlines()
+        # FLAKY and BAD are tried twice
+        self.assertEqual(len(calls), 6)
+        self.assertTrue(all(" -l50m " in call for call in calls))
+
+class TestCreateSubmissionSets(unittest.TestCase):
+    """Test create_submission_sets"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.samples = {'A': ["SRR1", "SRR2"], 'B': ["SRR3"], 'C': ["SRR4"],
+                        'D': ["SRR5"], 'E': ["SRR6"]}
+        self.weights = {"SRR1": 5, "SRR2": 4, "SRR3": 8, "SRR4": 3,
+                        "SRR5": 2, "SRR6": 2}
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_create_submission_sets_groups(self):
+        groups = sra.create_submission_sets(self.samples, 'groups', 2)
+        self.assertEqual(groups, {'group0': ["SRR1", "SRR2", "SRR3", "SRR4"],
+                                  'group1': ["SRR5", "SRR6"]})
+    
+    def test_create_submission_sets_balanced(self):
+        expected = {'group0': ["SRR1", "SRR2"],
+                    'group1': ["SRR3"],
+                    'group2': ["SRR4", "SRR5", "SRR6"]}
+        self.assertEqual(sra.create_submission_sets(self.samples, 'balanced', 3,
+                                                    weights = self.weights),
+                         expected)
+        
+        table = os.path.join(self.tmpdir, "runinfo.tsv")
+        with open(table, 'w') as fh:
+            fh.write("Run\tspots\n")
+            for run, weight in self.weights.items():
+                fh.write("{}\t{}\n".format(run, weight * 1000))
+        self.assertEqual(sra.create_submission_sets(self.samples, 'balanced', 3,
+                                                    weights = table,
+                                                    weight_col = 'spots'),
+                         expected)
+        
+        # SRR6 has no file and gets the mean size
+        for run, weight in self.weights.items():
+            if run != "SRR6":
+                with open(os.path.join(self.tmpdir, run + ".sra"), 'w') as fh:
+                    fh.write("x" * weight)
+        groups = sra.create_submission_sets(self.samples, 'balanced', 3,
+                                            weights = self.tmpdir)
+        self.assertEqual(groups['group0'], ["SRR1", "SRR2"])
+        self.assertEqual(sorted(run for runs in groups.values() for run in runs),
+                         sorted(self.weights))
+
+def write_ebi_report(file, rows):
+    """Writes an EBI-like report with the study in column 4 and the
+    sample title in column 23"""
+    with open(file, 'w') as fh:
+        fh.write("\t".join("col{}".format(i + 1) for i in range(24)) + "\n")
+        for study, run, title in rows:
+            fields = ["x"] * 24
+            fields[3] = study
+            fields[0] = run
+            fields[22] = title
+            fh.write("\t".join(fields) + "\n")
+
+class TestProcessEbiMetadata(unittest.TestCase):
+    """Test process_ebi_metadata and process_ebi_metadata_batch"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.report = os.path.join(self.tmpdir, "report.tsv")
+        write_ebi_report(self.report,
+                         [("PRJ1", "SRR1", "containing sample 11 from participant 5"),
+                          ("PRJ2", "SRR2", "no subject"),
+                          ("PRJ1", "SRR3", "containing sample 12 from participant 6"),
+                          ("PRJ3", "SRR4", "containing sample 13 from participant 7")])
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    
+    def test_process_ebi_metadata(self):
+        header, rows, nruns = sra.process_ebi_metadata(self.report, "PRJ1")
+        self.assertEqual(header[-2:], ["col24", "subject_id"])
+        self.assertEqual(nruns, 2)
+        self.assertEqual([(row[0], row[-1]) for row in rows],
+                         [("SRR1", "11"), ("SRR3", "12")])
+    
+    def test_process_ebi_metadata_batch(self):
+        header, res = sra.process_ebi_metadata_batch(self.report,
+                                                     ["PRJ2", "PRJ1", "PRJ9"])
+        self.assertEqual(list(res), ["PRJ2", "PRJ1", "PRJ9"])
+        self.assertEqual([row[-1] for row in res['PRJ2']], ["NA"])
+        self.assertEqual([row[0] for row in res['PRJ1']], ["SRR1", "SRR3"])
+        self.assertEqual(res['PRJ9'], [])
+        
+        # Built on the first call and used by the second
+        for i in range(2):
+            cached = sra.process_ebi_metadata_batch(self.report,
+                                                    ["PRJ2", "PRJ1", "PRJ9"],
+                                                    cache = True)
+            self.assertEqual(cached, (header, res))
+            self.assertTrue(os.path.isfile(self.report + ".ebiidx"))
+        
+        # A changed report makes the index stale
+        write_ebi_report(self.report, [("PRJ9", "SRR9", "x")])
+        header, res = sra.process_ebi_metadata_batch(self.report, ["PRJ9"],
+                                                     cache = True)
+        self.assertEqual([row[0] for row in res['PRJ9']], ["SRR9"])
+    
+    def check_iter_ebi_metadata(self, engine):
+        header, res = sra.process_ebi_metadata_batch(self.report, ["PRJ1", "PRJ2"])
+        expected = sorted(res['PRJ1'] + res['PRJ2'], key = lambda row: row[0])
+        
+        gzipped = self.report + ".gz"
+        with open(self.report, 'rb') as fh, gzip.open(gzipped, 'wb') as out_fh:
+            out_fh.write(fh.read())
+        for infile in (self.report, gzipped):
+            found_header, rows = sra.iter_ebi_metadata(infile, ["PRJ1", "PRJ2"],
+                                                       chunk_size = 2,
+                                                       engine = engine)
+            self.assertEqual(found_header, header)
+            self.assertEqual(list(rows), expected)
+        
+        outfile = os.path.join(self.tmpdir, "out.tsv")
+        self.assertEqual(sra.filter_ebi_metadata(gzipped, ["PRJ1"], outfile,
+                                                 engine = engine), 3)
+        with open(outfile, 'r') as fh:
+            self.assertEqual([line.rstrip().split("\t")[-1] for line in fh],
+                             ["subject_id", "11", "12"])
+    
+    def test_iter_ebi_metadata(self):
+        self.check_iter_ebi_metadata('python')
+    
+    @unittest.skipUnless(pandas, "pandas is not installed")
+    def test_iter_ebi_metadata_pandas(self):
+        self.check_iter_ebi_metadata('pandas')
+
+class TestCheckSetOfRuns(FakeProgramTestCase):
+    """Test check_set_of_runs"""
+    
+    programs = {"vdb-validate": FAKE_VDB_VALIDATE}
+    
+    def setUp(self):
+        super().setUp()
+        self.indir = os.path.join(self.tmpdir, "sra")
+        os.mkdir(self.indir)
+        self.runs = ["SRR1", "SRR2", "SRR3", "BAD"]
+        for run in self.runs:
+            with open(os.path.join(self.indir, run + ".sra"), 'w') as fh:
+                fh.write(run + "\n")
+    
+    def validated(self):
+        """Returns the names of the validated files and clears the log"""
+        log = os.path.join(self.bindir, "validated")
+        if not os.path.exists(log):
+            return([])
+        with open(log, 'r') as fh:
+            files = sorted(os.path.basename(line.rstrip()) for line in fh)
+        os.remove(log)
+        return(files)
+    
+    def test_check_set_of_runs(self):
+        with self.assertRaises(IntegrityError):
+            sra.check_set_of_runs(self.runs, self.indir, workers = 4,
+                                  cache = True)
+        self.assertEqual(self.validated(),
+                         ["BAD.sra", "SRR1.sra", "SRR2.sra", "SRR3.sra"])
+        
+        # Only the failed run is validated again
+        with self.assertRaises(IntegrityError):
+            sra.check_set_of_runs(self.runs, self.indir, workers = 4,
+                                  cache = True)
+        self.assertEqual(self.validated(), ["BAD.sra"])
+        self.assertEqual(sra.check_set_of_runs(self.runs[:3], self.indir,
+                                               cache = True), [])
+        self.assertEqual(self.validated(), [])
+        
+        # Changed files and files without a recorded hash are validated
+        with open(os.path.join(self.indir, "SRR2.sra"), 'a') as fh:
+            fh.write("more\n")
+        res = sra.check_set_of_runs(self.runs[:3], self.indir, cache = True)
+        self.assertEqual([r.args[1] for r in res],
+                         [os.path.join(self.indir, "SRR2.sra")])
+        self.assertEqual(self.validated(), ["SRR2.sra"])
+        sra.check_set_of_runs(self.runs[:3], self.indir, cache = True,
+                              checksum = 'md5')
+        self.assertEqual(self.validated(), ["SRR1.sra", "SRR2.sra", "SRR3.sra"])
+        sra.check_set_of_runs(self.runs[:3], self.indir, cache = True,
+                              checksum = 'md5')
+        self.assertEqual(self.validated(), [])
+        
+        sra.check_set_of_runs(self.runs[:1], self.indir)
+        self.assertEqual(self.validated(), ["SRR1.sra"])
+    
+    def test_check_set_of_runs_unwritable_cache(self):
+        """Test results are returned when the cache cannot be written"""
+        cache = os.path.join(self.tmpdir, "missing", "cache.json")
+        res = sra.check_set_of_runs(self.runs[:3], self.indir, cache = cache)
+        self.assertEqual(len(res), 3)
+        self.assertFalse(os.path.exists(cache))
+    
+    def test_check_set_of_runs_missing(self):
+        with self.assertRaises(MissingFileError):
+            sra.check_set_of_runs(["SRR4"], self.indir)
+
+class TestFastqDumpRuns(FakeProgramTestCase):
+    """Test fastq_dump_runs"""
+    
+    programs = {"fastq-dump": FAKE_FASTQ_DUMP}
+    
+    def setUp(self):
+        super().setUp()
+        self.indir = os.path.join(self.tmpdir, "sra")
+        self.outdir = os.path.join(self.tmpdir, "fastq")
+        os.mkdir(self.indir)
+        self.runs = ["SRR3", "SRR1", "SRR2", "BAD"]
+        for i, run in enumerate(self.runs):
+            with open(os.path.join(self.indir, run + ".sra"), 'w') as fh:
+                fh.write("0.{}\n".format(3 - i))
+    
+    def test_fastq_dump_runs(self):
+        files = sra.fastq_dump_runs(self.runs[:3], self.indir, self.outdir,
+                                    False, compress = False, workers = 3)
+        self.assertEqual(files, [[self.outdir + "/" + run + "_" + read + ".fastq"
+                                  for run in self.runs[:3]]
+                                 for read in ("1", "2")])
+        for file in files[0] + files[1]:
+            self.assertTrue(os.path.isfile(file))
+    
+    def test_fastq_dump_runs_failed(self):
+        with self.assertRaises(ProcessError):
+            sra.fastq_dump_runs(self.runs, self.indir, self.outdir, False,
+                                compress = False, workers = 2)
+        self.assertEqual(sorted(os.listdir(self.outdir)),
+                         sorted(run + "_" + read + ".fastq"
+                                for run in self.runs[:3] for read in ("1", "2")))
+    
+    def test_fastq_dump_runs_missing(self):
+        with self.assertRaises(MissingFileError):
+            sra.fastq_dump_runs(self.runs + ["SRR4"], self.indir, self.outdir,
+                                False, workers = 2)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+class TestProcessSamples(FakeProgramTestCase):
+    """Test process_samples"""
+    
+    programs = {"fastq-dump": FAKE_FASTQ_DUMP,
+                "vdb-validate": FAKE_VDB_VALIDATE}
+    
+    def setUp(self):
+        super().setUp()
+        self.indir = os.path.join(self.tmpdir, "sra")
+        os.mkdir(self.indir)
+        for run in ["SRR1", "SRR2", "SRR3", "SRR4", "BAD"]:
+            with open(os.path.join(self.indir, run + ".sra"), 'w') as fh:
+                fh.write("0\n")
+    
+    def test_process_samples(self):
+        samples = {'A': ["SRR2", "SRR1"], 'B': ["BAD"], 'C': ["SRR5"],
+                   'D': ["SRR3"], 'E': ["SRR4"]}
+        outdir = os.path.join(self.tmpdir, "out")
+        results, failed = sra.process_samples(samples, self.indir,
+                                              os.path.join(self.tmpdir, "fastq"),
+                                              outdir, processes = 2,
+                                              validate_workers = 2,
+                                              dump_workers = 2,
+                                              concatenate_workers = 2,
+                                              queue_size = 1)
+        self.assertEqual(list(results), ['A', 'D', 'E'])
+        self.assertEqual(sorted(failed), ['B', 'C'])
+        self.assertIsInstance(failed['B'], ProcessError)
+        self.assertEqual(results['A'], [outdir + "/A_read1.fastq.bz2",
+                                        outdir + "/A_read2.fastq.bz2"])
+        with bz2.open(results['A'][1], 'rt') as fh:
+            self.assertEqual([line.split()[0] for line in fh][::4],
+                             ["@SRR2.1.2", "@SRR2.2.2", "@SRR1.1.2", "@SRR1.2.2"])
+        # Uncompressed files of the runs are removed
+        self.assertEqual([file for file in os.listdir(os.path.join(self.tmpdir, "fastq"))
+                          if file.startswith("SRR")], [])
+    
+    def test_process_sample_stream(self):
+        files = sra.process_sample('A', ["SRR2", "SRR1"], self.indir,
+                                   os.path.join(self.tmpdir, "fastq"),
+                                   os.path.join(self.tmpdir, "out"),
+                                   keep = True, processes = 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, "fastq"))),
+                         ["SRR1_1.fastq", "SRR1_2.fastq",
+                          "SRR2_1.fastq", "SRR2_2.fastq"])
+        streamed = sra.process_sample('A', ["SRR2", "SRR1"], self.indir, None,
+                                      os.path.join(self.tmpdir, "stream"),
+                                      processes = 2, stream = True)
+        self.assertEqual(len(streamed), 2)
+        for file, streamed_file in zip(files, streamed):
+            with bz2.open(file, 'rb') as fh1, bz2.open(streamed_file, 'rb') as fh2:
+                self.assertEqual(fh1.read(), fh2.read())
+        
+        with self.assertRaises(ProcessError):
+            sra.process_sample('B', ["SRR3", "BAD"], self.indir, None,
+                               os.path.join(self.tmpdir, "stream"),
+                               stream = True)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmpdir, "stream"))),
+                         ["A_read1.fastq.bz2", "A_read2.fastq.bz2"])
+
+if __name__  == '__main__':
+    unittest.main()